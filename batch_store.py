@@ -0,0 +1,222 @@
+import numpy as np
+import os
+import shutil
+import time
+
+from cp_evaluation import default_band_edges
+from ngram_counts import bits_per_index, load_arrays, pack_indices, save_header
+
+
+class BatchStore(object):
+    def __init__(self, dirname, mmap=True):
+        '''
+        Sparse tensor batches materialized on disk by `BatchStore.materialize`, replayed at disk speed by `batches`.
+
+        Each batch is either an (indices, values) pair or, for joint decompositions, a pair of lists
+            ([indices_2d, indices_3d, ...], [values_2d, values_3d, ...]) with one "part" per order.
+            Every part is stored as flat indices/values arrays plus an offsets array marking where each batch starts.
+        '''
+        self.dirname = dirname
+        header, self.arrays = load_arrays(dirname, mmap=mmap)
+        self.ndims = header['ndims']
+        self.joint = header['joint']
+        self.num_batches = header['num_batches']
+
+    def __len__(self):
+        return self.num_batches
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, 'header.json'))
+
+    @classmethod
+    def materialize(cls, dirname, batches):
+        '''
+        Writes every batch of the `batches` generator to `dirname`, then opens it as a BatchStore.
+        Batches are streamed to disk as they come, and the store only shows up at `dirname` once it's complete.
+        '''
+        t = time.time()
+        tmp_dirname = dirname + '.tmp'
+        if os.path.exists(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        files = None
+        ndims, joint = None, None
+        lengths = None
+        offsets = None
+        num_batches = 0
+        try:
+            for indices, values in batches:
+                if files is None:
+                    joint = isinstance(indices, (list, tuple))
+                    ndims = [np.shape(ix)[-1] for ix in indices] if joint else [np.shape(indices)[-1]]
+                    files = [
+                        (open(os.path.join(tmp_dirname, 'indices_{}.bin'.format(part)), 'wb'),
+                         open(os.path.join(tmp_dirname, 'values_{}.bin'.format(part)), 'wb'))
+                        for part in range(len(ndims))
+                    ]
+                    lengths = [0] * len(ndims)
+                    offsets = [[0] for _ in ndims]
+                if not joint:
+                    indices, values = [indices], [values]
+                for part, (part_indices, part_values) in enumerate(zip(indices, values)):
+                    part_indices = np.asarray(part_indices, dtype=np.int32).reshape(-1, ndims[part])
+                    part_indices.tofile(files[part][0])
+                    np.asarray(part_values, dtype=np.float32).tofile(files[part][1])
+                    lengths[part] += len(part_indices)
+                    offsets[part].append(lengths[part])
+                num_batches += 1
+        finally:
+            for indices_file, values_file in files or []:
+                indices_file.close()
+                values_file.close()
+        if files is None:
+            raise ValueError('no batches to materialize')
+
+        array_infos = {}
+        for part in range(len(ndims)):
+            np.asarray(offsets[part], dtype=np.int64).tofile(os.path.join(tmp_dirname, 'offsets_{}.bin'.format(part)))
+            array_infos['indices_{}'.format(part)] = (np.int32, lengths[part] * ndims[part])
+            array_infos['values_{}'.format(part)] = (np.float32, lengths[part])
+            array_infos['offsets_{}'.format(part)] = (np.int64, num_batches + 1)
+        header = {
+            'format': 'batch_store',
+            'ndims': ndims,
+            'joint': joint,
+            'num_batches': num_batches,
+        }
+        save_header(tmp_dirname, header, array_infos)
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+        print('Materializing {} batches to {} took {} secs'.format(num_batches, dirname, time.time() - t))
+        return cls(dirname)
+
+    def get_batch(self, i):
+        batch_indices, batch_values = [], []
+        for part, ndims in enumerate(self.ndims):
+            offsets = self.arrays['offsets_{}'.format(part)]
+            start, stop = offsets[i], offsets[i + 1]
+            batch_indices.append(np.asarray(self.arrays['indices_{}'.format(part)][start * ndims:stop * ndims]).reshape(-1, ndims))
+            batch_values.append(np.asarray(self.arrays['values_{}'.format(part)][start:stop]))
+        if self.joint:
+            return (batch_indices, batch_values)
+        return (batch_indices[0], batch_values[0])
+
+    def batches(self, num_epochs=1, shuffle=True, seed=None):
+        '''
+        Replays the stored batches `num_epochs` times, in a new random order each epoch if `shuffle`.
+        '''
+        random_state = np.random.RandomState(seed)
+        for epoch in range(num_epochs):
+            order = random_state.permutation(self.num_batches) if shuffle else range(self.num_batches)
+            for i in order:
+                yield self.get_batch(i)
+
+
+class TensorSampler(object):
+    def __init__(self, indices, values, vocab_len, batch_size=1000, strategy='importance', power=0.5, mix=0.1,
+                 band_edges=None, neg_sample_percent=0.25, seed=None):
+        '''
+        Draws fixed-size mini-batches of `batch_size` entries (with replacement) from a materialized sparse symmetric
+            tensor, e.g. the full PPMI tensor, instead of taking whatever entries the next text chunks happen to hold.
+            Every batch comes with per-entry loss weights that undo the sampling bias, so the weighted batch loss is an
+            unbiased estimate of the mean loss over the whole tensor.
+
+        `strategy`:
+            'uniform': every entry is equally likely (all weights are 1).
+            'importance': entry i is drawn with probability p_i proportional to |value_i|^`power`, mixed with `mix` of the
+                uniform distribution to bound the weights, and weighed by 1 / (N * p_i).
+            'stratified': the entries are split into frequency bands by their rarest index (at `band_edges`, see
+                cp_evaluation.default_band_edges), and every non-empty band gets an equal share of each batch.
+                An entry of band s is weighed by (N_s / N) / (n_s / batch_size).
+
+        `neg_sample_percent` * batch_size zero-valued entries that aren't in the tensor are added to every batch
+            (with weight 1), drawn in vectorized rounds and rejected against the packed keys of the tensor.
+        '''
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float32).ravel()
+        self.indices = self.indices.reshape(len(self.values), -1)
+        self.vocab_len = vocab_len
+        self.ndims = self.indices.shape[1]
+        self.batch_size = batch_size
+        self.strategy = strategy
+        self.neg_sample_percent = neg_sample_percent
+        self.random_state = np.random.RandomState(seed)
+        self.bits = bits_per_index(vocab_len, self.ndims)
+        self.keys = np.sort(pack_indices(self.indices, self.bits))
+
+        num_entries = len(self.values)
+        if strategy == 'uniform':
+            pass
+        elif strategy == 'importance':
+            scores = np.abs(self.values.astype(np.float64)) ** power
+            probs = (1. - mix) * scores / scores.sum() + mix / num_entries
+            self.cdf = np.cumsum(probs)
+            self.cdf /= self.cdf[-1]
+            self.entry_weights = (1. / (num_entries * probs)).astype(np.float32)
+        elif strategy == 'stratified':
+            if band_edges is None:
+                band_edges = default_band_edges(vocab_len)
+            bands = np.searchsorted(band_edges, self.indices.max(axis=1), side='right') - 1
+            order = np.argsort(bands, kind='mergesort')
+            band_sizes = np.bincount(bands, minlength=len(band_edges) - 1)
+            self.strata = [members for members in np.split(order, np.cumsum(band_sizes)[:-1]) if len(members)]
+            shares = np.full(len(self.strata), batch_size // len(self.strata))
+            shares[:batch_size % len(self.strata)] += 1
+            self.shares = shares
+            self.stratum_weights = [
+                np.float32((len(members) / num_entries) / (share / batch_size)) for members, share in zip(self.strata, shares)
+            ]
+        else:
+            raise ValueError('unknown sampling strategy {}'.format(strategy))
+
+    def sample_positions(self):
+        '''
+        Positions of the next batch's entries in the tensor, and their weights.
+        '''
+        if self.strategy == 'uniform':
+            return self.random_state.randint(0, len(self.values), size=self.batch_size), np.ones(self.batch_size, dtype=np.float32)
+        if self.strategy == 'importance':
+            positions = np.searchsorted(self.cdf, self.random_state.random_sample(self.batch_size), side='right')
+            positions = np.minimum(positions, len(self.values) - 1)
+            return positions, self.entry_weights[positions]
+        positions, weights = [], []
+        for members, share, weight in zip(self.strata, self.shares, self.stratum_weights):
+            if share:
+                positions.append(members[self.random_state.randint(0, len(members), size=share)])
+                weights.append(np.full(share, weight, dtype=np.float32))
+        return np.concatenate(positions), np.concatenate(weights)
+
+    def negative_samples(self, num_samples):
+        '''
+        `num_samples` random sorted index tuples that aren't entries of the tensor.
+        '''
+        negatives = []
+        num_found = 0
+        while num_found < num_samples:
+            num_draws = int(1.25 * (num_samples - num_found)) + 16
+            candidates = np.sort(self.random_state.randint(0, self.vocab_len, size=(num_draws, self.ndims)), axis=1).astype(np.int32)
+            keys = pack_indices(candidates, self.bits)
+            positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            candidates = candidates[self.keys[positions] != keys]
+            negatives.append(candidates)
+            num_found += len(candidates)
+        return np.concatenate(negatives)[:num_samples]
+
+    def sample(self):
+        '''
+        One (indices, values, weights) batch.
+        '''
+        positions, weights = self.sample_positions()
+        indices, values = self.indices[positions], self.values[positions]
+        num_negatives = int(self.neg_sample_percent * self.batch_size)
+        if num_negatives > 0:
+            indices = np.vstack((indices, self.negative_samples(num_negatives)))
+            values = np.concatenate((values, np.zeros(num_negatives, dtype=np.float32)))
+            weights = np.concatenate((weights, np.ones(num_negatives, dtype=np.float32)))
+        return indices, values, weights
+
+    def batches(self, num_batches):
+        for _ in range(num_batches):
+            yield self.sample()
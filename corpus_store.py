@@ -0,0 +1,111 @@
+import numpy as np
+import os
+import shutil
+import time
+
+from ngram_counts import load_arrays, save_header, vocab_hash
+
+
+class CompiledCorpus(object):
+    def __init__(self, dirname, mmap=True):
+        '''
+        A corpus compiled by `CompiledCorpus.compile` against a fixed vocab: one flat int32 stream of vocab indices
+            (out-of-vocab tokens already dropped), plus an int64 offsets array where document i spans
+            tokens[offsets[i]:offsets[i+1]]. With `mmap`, passes over it are just reads of the mapped pages.
+        '''
+        self.dirname = dirname
+        header, self.arrays = load_arrays(dirname, mmap=mmap)
+        self.vocab_hash = header['vocab_hash']
+        self.num_docs = header['num_docs']
+        self.num_tokens = header['num_tokens']
+        self.tokens = self.arrays['tokens']
+        self.offsets = self.arrays['offsets']
+
+    def __len__(self):
+        return self.num_docs
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, 'header.json'))
+
+    @classmethod
+    def compile(cls, dirname, vocab_model, sentences):
+        '''
+        Maps every token of the `sentences` generator (one list of words per document) to its index in `vocab_model`
+            once, and streams the indices to `dirname`. The corpus only shows up at `dirname` once it's complete.
+        '''
+        t = time.time()
+        tmp_dirname = dirname + '.tmp'
+        if os.path.exists(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        word_indices = {word: vocab.index for word, vocab in vocab_model.vocab.items()}
+        offsets = [0]
+        num_tokens = 0
+        with open(os.path.join(tmp_dirname, 'tokens.bin'), 'wb') as tokens_file:
+            for sentence in sentences:
+                indices = np.fromiter((word_indices[w] for w in sentence if w in word_indices), dtype=np.int32)
+                indices.tofile(tokens_file)
+                num_tokens += len(indices)
+                offsets.append(num_tokens)
+        np.asarray(offsets, dtype=np.int64).tofile(os.path.join(tmp_dirname, 'offsets.bin'))
+        header = {
+            'format': 'compiled_corpus',
+            'vocab_hash': vocab_hash(vocab_model.index2word),
+            'num_docs': len(offsets) - 1,
+            'num_tokens': num_tokens,
+        }
+        save_header(tmp_dirname, header, {'tokens': (np.int32, num_tokens), 'offsets': (np.int64, len(offsets))})
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+        print('Compiling {} documents ({} tokens) to {} took {} secs'.format(len(offsets) - 1, num_tokens, dirname, time.time() - t))
+        return cls(dirname)
+
+    def matches(self, vocab_model):
+        return self.vocab_hash == vocab_hash(vocab_model.index2word)
+
+    def documents(self, num_docs=None):
+        '''
+        Yields the first `num_docs` documents (all of them, by default) as int32 views into the token stream.
+        '''
+        num_docs = self.num_docs if num_docs is None else min(int(num_docs), self.num_docs)
+        offsets = np.asarray(self.offsets[:num_docs + 1])
+        tokens = np.asarray(self.tokens)  # plain ndarray views of the mapped pages: slicing an np.memmap is slow
+        for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+            yield tokens[start:stop]
+
+    def chunk_batches(self, window, batch_size, num_docs=None):
+        '''
+        The batches of gensim_utils.index_batch_generator(self.documents(num_docs), window, batch_size), i.e. whole
+            documents cut into chunks of 1 + 2*window tokens until there are at least `batch_size` chunks, but each
+            batch is a (matrix, lengths) pair: a (num_chunks, 1 + 2*window) int32 matrix with one chunk per row,
+            padded with -1, and the length of every chunk. Every matrix is one gather off the token stream, so there
+            are no per-chunk (let alone per-token) Python objects.
+        '''
+        chunk_len = 1 + 2*window
+        num_docs = self.num_docs if num_docs is None else min(int(num_docs), self.num_docs)
+        offsets = np.asarray(self.offsets[:num_docs + 1])
+        tokens = np.asarray(self.tokens)
+        doc_chunks = -(-np.diff(offsets) // chunk_len)
+        chunk_offsets = np.concatenate(([0], np.cumsum(doc_chunks)))  # the chunks of document i are chunk_offsets[i]:chunk_offsets[i+1]
+        columns = np.arange(chunk_len)
+        start_doc = 0
+        while start_doc < num_docs:
+            end_doc = min(int(np.searchsorted(chunk_offsets, chunk_offsets[start_doc] + batch_size)), num_docs)
+            counts = doc_chunks[start_doc:end_doc]
+            if chunk_offsets[end_doc] > chunk_offsets[start_doc]:
+                chunk_ix = np.arange(chunk_offsets[start_doc], chunk_offsets[end_doc]) - np.repeat(chunk_offsets[start_doc:end_doc], counts)
+                starts = np.repeat(offsets[start_doc:end_doc], counts) + chunk_ix * chunk_len
+                lengths = np.minimum(np.repeat(offsets[start_doc + 1:end_doc + 1], counts) - starts, chunk_len).astype(np.int32)
+                matrix = np.take(tokens, starts[:, None] + columns, mode='clip')
+                matrix[columns >= lengths[:, None]] = -1  # the tail of each document's last chunk
+                yield matrix, lengths
+            start_doc = end_doc
+
+    def sentences(self, index2word, num_docs=None):
+        '''
+        The documents as lists of words again, for code that wants strings (e.g. gensim's own training).
+        '''
+        for document in self.documents(num_docs):
+            yield [index2word[ix] for ix in document]
@@ -0,0 +1,224 @@
+import collections
+import multiprocessing
+import numpy as np
+import time
+
+from ngram_counts import bits_per_index, pack_indices
+
+
+class ReconstructionReport(collections.namedtuple('ReconstructionReport', ['num_entries', 'mse', 'rmse', 'mae', 'bands'])):
+    '''
+    `bands` is a list of (low, high, num_entries, rmse): the error over the entries whose rarest index
+        (i.e. largest, since the vocab is sorted by descending count) falls in [low, high).
+    '''
+    def __str__(self):
+        bandstring = '; '.join(
+            '[{}, {}): {:.3f} ({} entries)'.format(low, high, rmse, num_entries)
+            for low, high, num_entries, rmse in self.bands if num_entries > 0
+        )
+        return 'RMSE {:.4f}, MAE {:.4f} over {} entries (by rarest index: {})'.format(self.rmse, self.mae, self.num_entries, bandstring)
+
+
+def predict(factors, indices):
+    '''
+    CP reconstruction sum_r prod_d factors[d][indices[:, d], r] of every row of `indices`.
+    '''
+    prods = factors[0][indices[:, 0]].astype(np.float64)
+    for d in range(1, indices.shape[1]):
+        prods *= factors[d][indices[:, d]]
+    return prods.sum(axis=1)
+
+
+def chunk_errors(factors, indices, values):
+    return predict(factors, indices) - values
+
+
+_worker_factors = None
+
+
+def _init_worker(factors):
+    global _worker_factors
+    _worker_factors = factors
+
+
+def _chunk_errors_worker(chunk):
+    return chunk_errors(_worker_factors, *chunk)
+
+
+def reconstruction_errors(indices, values, factors, chunk_size=2**18, processes=1):
+    '''
+    Signed errors (prediction - value) of the CP model given by `factors` on every entry, computed `chunk_size`
+        entries at a time so the gathered rows never take more than chunk_size * R floats per factor.
+    `factors` is one matrix per mode, or a single matrix for a symmetric decomposition.
+    With `processes` > 1, chunks are spread over a pool of forked workers.
+    '''
+    indices = np.asarray(indices)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if indices.ndim != 2:  # a squeezed single entry
+        indices = indices.reshape(len(values), -1)
+    if isinstance(factors, np.ndarray):
+        factors = [factors] * indices.shape[1]
+    chunks = [
+        (indices[start:start+chunk_size], values[start:start+chunk_size])
+        for start in range(0, len(values), chunk_size)
+    ]
+    if processes is None or processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(factors,))
+        try:
+            errors = pool.map(_chunk_errors_worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [chunk_errors(factors, *chunk) for chunk in chunks]
+    if not errors:
+        return np.zeros(0)
+    return np.concatenate(errors)
+
+
+def default_band_edges(vocab_len):
+    edges = [0]
+    edge = 100
+    while edge < vocab_len:
+        edges.append(edge)
+        edge *= 10
+    edges.append(vocab_len)
+    return edges
+
+
+def evaluate_cp(indices, values, factors, band_edges=None, chunk_size=2**18, processes=1):
+    '''
+    Reconstruction error report (see ReconstructionReport) of the CP model given by `factors` on a sparse tensor.
+    Frequency bands are split at `band_edges` (powers of 10 from 100 up to the vocab size, by default).
+    '''
+    t = time.time()
+    indices = np.asarray(indices)
+    values = np.asarray(values).ravel()
+    if indices.ndim != 2:  # a squeezed single entry
+        indices = indices.reshape(len(values), -1)
+    errors = reconstruction_errors(indices, values, factors, chunk_size=chunk_size, processes=processes)
+    squared_errors = errors ** 2
+    num_entries = len(errors)
+    mse = float(squared_errors.mean()) if num_entries else 0.0
+
+    vocab_len = (factors if isinstance(factors, np.ndarray) else factors[0]).shape[0]
+    if band_edges is None:
+        band_edges = default_band_edges(vocab_len)
+    band_ix = np.searchsorted(band_edges, indices.max(axis=1), side='right') - 1 if num_entries else np.zeros(0, dtype=int)
+    band_counts = np.bincount(band_ix, minlength=len(band_edges) - 1)
+    band_sums = np.bincount(band_ix, weights=squared_errors, minlength=len(band_edges) - 1)
+    bands = [
+        (band_edges[b], band_edges[b+1], int(band_counts[b]), float(np.sqrt(band_sums[b] / band_counts[b])) if band_counts[b] else 0.0)
+        for b in range(len(band_edges) - 1)
+    ]
+    report = ReconstructionReport(
+        num_entries=num_entries,
+        mse=mse,
+        rmse=float(np.sqrt(mse)),
+        mae=float(np.abs(errors).mean()) if num_entries else 0.0,
+        bands=bands,
+    )
+    print('Evaluating {} entries took {:.2f} secs'.format(num_entries, time.time() - t))
+    return report
+
+
+def evaluate_joint(tensors, U, dimlist, **kwargs):
+    '''
+    One report per order for a joint symmetric decomposition: `tensors` has an (indices, values) pair per order in `dimlist`.
+    '''
+    reports = []
+    for (indices, values), dim in zip(tensors, dimlist):
+        reports.append(evaluate_cp(indices, values, [U] * dim, **kwargs))
+    return reports
+
+
+class ValidationMonitor(object):
+    def __init__(self, indices, values, vocab_len, evaluate_every=1000, patience=5, lr_patience=2, lr_decay=0.5, min_delta=1e-4, keep_best=True):
+        '''
+        Held-out reconstruction loss for online CP training.
+        (`indices`, `values`) is the cached validation sample (see `ValidationMonitor.sample`), which `filter_batches`
+            keeps out of the training batches. Every `evaluate_every` steps, the decomposition calls `check`, which
+            scores the whole sample in one vectorized pass (gather, Hadamard product, sum).
+
+        After `lr_patience` checks without improving the best RMSE by `min_delta`, `check` asks for the learning rate
+            to be multiplied by `lr_decay`. After `patience` checks without improvement, it asks for training to stop.
+        With `keep_best`, the best factors seen so far are kept in `self.best_factors`.
+        '''
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64).ravel()
+        self.vocab_len = vocab_len
+        self.bits = bits_per_index(vocab_len, self.indices.shape[1])
+        self.keys = np.sort(pack_indices(self.indices, self.bits))
+        self.evaluate_every = evaluate_every
+        self.patience = patience
+        self.lr_patience = lr_patience
+        self.lr_decay = lr_decay
+        self.min_delta = min_delta
+        self.keep_best = keep_best
+
+        self.history = []
+        self.best_rmse = float('inf')
+        self.best_step = None
+        self.best_factors = None
+        self.checks_since_best = 0
+        self.checks_since_decay = 0
+        self.should_stop = False
+
+    @classmethod
+    def sample(cls, indices, values, vocab_len, sample_size=10000, seed=0, **kwargs):
+        '''
+        Reserves a fixed random sample of `sample_size` entries of a sparse tensor for validation.
+        '''
+        indices = np.asarray(indices)
+        values = np.asarray(values).ravel()
+        random_state = np.random.RandomState(seed)
+        chosen = random_state.choice(len(values), size=min(sample_size, len(values)), replace=False)
+        return cls(indices[chosen], values[chosen], vocab_len, **kwargs)
+
+    def is_held_out(self, indices):
+        keys = pack_indices(np.asarray(indices).reshape(-1, self.indices.shape[1]), self.bits)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+    def filter_batches(self, batches):
+        '''
+        Drops the validation entries from every (indices, values) batch of the `batches` generator.
+        Any further per-entry arrays in a batch (e.g. sampling weights) get filtered along with them.
+        '''
+        for batch in batches:
+            indices = np.asarray(batch[0])
+            values = np.asarray(batch[1])
+            keep = ~self.is_held_out(indices) if len(values) else np.ones(0, dtype=bool)
+            yield (indices.reshape(len(values), -1)[keep], values[keep]) + tuple(np.asarray(extra)[keep] for extra in batch[2:])
+
+    def evaluate(self, factors):
+        errors = chunk_errors(factors if isinstance(factors, list) else [factors] * self.indices.shape[1], self.indices, self.values)
+        return float(np.sqrt(np.mean(errors ** 2))) if len(errors) else 0.0
+
+    def check(self, step, factors):
+        '''
+        Scores `factors` on the validation sample. Returns 'stop', 'decay' (the learning rate) or None.
+        '''
+        rmse = self.evaluate(factors)
+        self.history.append((step, rmse))
+        action = None
+        if rmse < self.best_rmse - self.min_delta:
+            self.best_rmse = rmse
+            self.best_step = step
+            self.checks_since_best = 0
+            self.checks_since_decay = 0
+            if self.keep_best:
+                self.best_factors = [np.array(factor) for factor in factors] if isinstance(factors, list) else np.array(factors)
+        else:
+            self.checks_since_best += 1
+            self.checks_since_decay += 1
+            if self.checks_since_best >= self.patience:
+                self.should_stop = True
+                action = 'stop'
+            elif self.checks_since_decay >= self.lr_patience:
+                self.checks_since_decay = 0
+                action = 'decay'
+        print('Validation RMSE at step {}: {:.4f} (best: {:.4f} at step {}){}'.format(
+            int(step), rmse, self.best_rmse, self.best_step, '; {}'.format(action) if action else '',
+        ))
+        return action
@@ -19,9 +19,14 @@ module.
 
 
 import bz2
+import io
 import logging
+import os
 import re
-from xml.etree.cElementTree import iterparse  # LXML isn't faster, so let's go with the built-in solution
+try:
+    from xml.etree.cElementTree import iterparse  # LXML isn't faster, so let's go with the built-in solution
+except ImportError:  # cElementTree is gone in Python 3.9; ElementTree uses the C accelerator by itself
+    from xml.etree.ElementTree import iterparse
 import multiprocessing
 
 from gensim import utils
@@ -53,6 +58,10 @@ RE_P13 = re.compile('\n(\||\!)(.*?\|)*([^|]*?)', re.UNICODE)  # table cell forma
 RE_P14 = re.compile('\[\[Category:[^][]*\]\]', re.UNICODE)  # categories
 # Remove File and Image template
 RE_P15 = re.compile('\[\[([fF]ile:|[iI]mage)[^]]*(\]\])', re.UNICODE)
+RE_BRACES = re.compile('[{}]', re.UNICODE)  # template delimiters, see remove_template
+
+# start of every bz2 stream: the 'BZh' signature, the block size digit, and the magic number of its first block
+RE_BZ2_STREAM = re.compile(b'BZh[1-9]\x31\x41\x59\x26\x53\x59')
 
 # MediaWiki namespaces (https://www.mediawiki.org/wiki/Manual:Namespace) that
 # ought to be ignored
@@ -74,28 +83,40 @@ def filter_wiki(raw):
 
 
 def remove_markup(text):
-    text = re.sub(RE_P2, "", text)  # remove the last list (=languages)
+    text = remove_language_links(text)  # remove the last list (=languages)
     # the wiki markup is recursive (markup inside markup etc)
     # instead of writing a recursive grammar, here we deal with that by removing
     # markup in a loop, starting with inner-most expressions and working outwards,
     # for as long as something changes.
     text = remove_template(text)
     text = remove_file(text)
+    # every pattern below needs some literal substring to match; checking for that
+    # substring first is much cheaper than a regex scan that can't match anything.
     iters = 0
     while True:
         old, iters = text, iters + 1
-        text = re.sub(RE_P0, "", text)  # remove comments
-        text = re.sub(RE_P1, '', text)  # remove footnotes
-        text = re.sub(RE_P9, "", text)  # remove outside links
-        text = re.sub(RE_P10, "", text)  # remove math content
-        text = re.sub(RE_P11, "", text)  # remove all remaining tags
-        text = re.sub(RE_P14, '', text)  # remove categories
-        text = re.sub(RE_P5, '\\3', text)  # remove urls, keep description
-        text = re.sub(RE_P6, '\\2', text)  # simplify links, keep description only
+        if '<' in text:
+            if '<!--' in text:
+                text = RE_P0.sub("", text)  # remove comments
+            if '<ref' in text:
+                text = RE_P1.sub('', text)  # remove footnotes
+            if '<nowiki' in text:
+                text = RE_P9.sub("", text)  # remove outside links
+            if '<math' in text:
+                text = RE_P10.sub("", text)  # remove math content
+            text = RE_P11.sub("", text)  # remove all remaining tags
+        if '[' in text:
+            if '[[Category:' in text:
+                text = RE_P14.sub('', text)  # remove categories
+            if '://' in text:
+                text = RE_P5.sub('\\3', text)  # remove urls, keep description
+            if '|' in text:
+                text = RE_P6.sub('\\2', text)  # simplify links, keep description only
         # remove table markup
-        text = text.replace('||', '\n|')  # each table cell on a separate line
-        text = re.sub(RE_P12, '\n', text)  # remove formatting lines
-        text = re.sub(RE_P13, '\n\\3', text)  # leave only cell content
+        if '|' in text or '!' in text:
+            text = text.replace('||', '\n|')  # each table cell on a separate line
+            text = RE_P12.sub('\n', text)  # remove formatting lines
+            text = RE_P13.sub('\n\\3', text)  # leave only cell content
         # remove empty mark-up
         text = text.replace('[]', '')
         if old == text or iters > 2:  # stop if nothing changed between two iterations or after a fixed number of iterations
@@ -107,6 +128,23 @@ def remove_markup(text):
     return text
 
 
+def remove_language_links(text):
+    """Remove the list of links to other languages at the end of `text`.
+
+    Same as `RE_P2.sub("", text)`, but only tries to match where the list can
+    start (a '\\n[[') instead of at every character.
+    """
+    if not text.endswith((']]', ']]\n')):
+        return text
+    start = text.find('\n[[')
+    while start != -1:
+        match = RE_P2.match(text, start)
+        if match:
+            return text[:start] + text[match.end():]
+        start = text.find('\n[[', start + 1)
+    return text
+
+
 def remove_template(s):
     """Remove template wikimedia markup.
 
@@ -119,27 +157,21 @@ def remove_template(s):
     """
 
     # Find the start and end position of each template by finding the opening
-    # '{{' and closing '}}'
-    n_open, n_close = 0, 0
+    # '{{' and the '}' that balances all the braces since. Only the braces
+    # matter, so jump straight from one to the next.
     starts, ends = [], []
-    in_template = False
-    prev_c = None
-    for i, c in enumerate(iter(s)):
-        if not in_template:
-            if c == '{' and c == prev_c:
-                starts.append(i - 1)
-                in_template = True
-                n_open = 1
-        if in_template:
-            if c == '{':
-                n_open += 1
-            elif c == '}':
-                n_close += 1
-            if n_open == n_close:
-                ends.append(i)
-                in_template = False
-                n_open, n_close = 0, 0
-        prev_c = c
+    start = s.find('{{')
+    while start != -1:
+        starts.append(start)
+        depth = 2
+        for match in RE_BRACES.finditer(s, start + 2):
+            depth += 1 if match.group() == '{' else -1
+            if depth == 0:
+                ends.append(match.start())
+                break
+        else:
+            break  # unclosed template: drop everything after its start
+        start = s.find('{{', ends[-1] + 1)
 
     # Remove all the templates
     s = ''.join([s[end + 1:start] for start, end in
@@ -233,6 +265,92 @@ def extract_pages(f, filter_namespaces=False):
 _extract_pages = extract_pages  # for backward compatibility
 
 
+def find_bz2_streams(fname, block_size=16 * 1024 * 1024):
+    """
+    Return the byte offsets of all the bz2 streams concatenated in `fname`.
+
+    Multistream Wikipedia dumps (\*pages-articles-multistream.xml.bz2) are made of
+    many small streams of ~100 pages each, which can be decompressed independently.
+    A regular dump is a single stream, so this returns just [0] for it.
+    """
+    offsets = []
+    overlap = 9  # one byte short of a signature, so a signature straddling two blocks is found exactly once
+    with open(fname, 'rb') as f:
+        pos, tail = 0, b''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = tail + block
+            base = pos - len(tail)
+            offsets.extend(base + m.start() for m in RE_BZ2_STREAM.finditer(data))
+            tail = data[-overlap:]
+            pos += len(block)
+    return offsets
+
+
+def read_multistream_index(index_fname):
+    """
+    Return the sorted stream offsets listed in a multistream dump index file
+    (lines of `offset:pageid:title`, optionally bz2-compressed).
+    """
+    opener = bz2.BZ2File if index_fname.endswith('.bz2') else open
+    offsets = set()
+    with opener(index_fname, 'rb') as f:
+        for line in f:
+            offsets.add(int(line.split(b':', 1)[0]))
+    return sorted(offsets)
+
+
+def stream_ranges(offsets, file_size, min_bytes=1024 * 1024):
+    """
+    Group consecutive bz2 streams starting at `offsets` into (start, end) byte
+    ranges of at least `min_bytes` each (except maybe the last one).
+    """
+    ranges = []
+    start = offsets[0]
+    for offset in offsets[1:] + [file_size]:
+        if offset - start >= min_bytes or offset == file_size:
+            ranges.append((start, offset))
+            start = offset
+    return ranges
+
+
+def get_dump_namespace(fname, offsets):
+    """Read the MediaWiki namespace off the header of a multistream dump."""
+    with open(fname, 'rb') as f:
+        f.seek(offsets[0])
+        data = f.read((offsets[1] if len(offsets) > 1 else os.path.getsize(fname)) - offsets[0])
+    header = bz2.BZ2Decompressor().decompress(data)
+    m = re.search(b'<mediawiki[^>]*xmlns="([^"]*)"', header)
+    namespace = m.group(1).decode('utf8') if m else ""
+    return get_namespace("{%s}" % namespace)
+
+
+def extract_range(args):
+    """
+    Decompress the bz2 streams in one byte range of a multistream dump and
+    parse every `<page>` in it (see `extract_pages` and `process_article`).
+
+    Pages never straddle streams, so the range holds only whole pages, plus the
+    XML header or footer if it's the first or last range.
+    Return a list of (tokens, title, pageid) triplets, in dump order.
+    """
+    fname, start, end, namespace, lemmatize, filter_namespaces = args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = bz2.decompress(data)  # handles the concatenated streams
+    first, last = text.find(b'<page>'), text.rfind(b'</page>')
+    if first < 0:
+        return []
+    body = b''.join([b'<mediawiki xmlns="', namespace.encode('utf8'), b'">', text[first:last + len(b'</page>')], b'</mediawiki>'])
+    return [
+        process_article((text, lemmatize, title, pageid))
+        for title, text, pageid in extract_pages(io.BytesIO(body), filter_namespaces)
+    ]
+
+
 def process_article(args):
     """
     Parse a wikipedia article, returning its content as a list of tokens
@@ -258,7 +376,10 @@ class WikiCorpus(TextCorpus):
     >>> MmCorpus.serialize('wiki_en_vocab200k.mm', wiki) # another 8h, creates a file in MatrixMarket format plus file with id->word
 
     """
-    def __init__(self, fname, processes=None, lemmatize=utils.has_pattern(), dictionary=None, filter_namespaces=('0',)):
+    ingest_range_bytes = 1024 * 1024  # compressed bytes per worker task with `parallel_ingest`
+
+    def __init__(self, fname, processes=None, lemmatize=utils.has_pattern(), dictionary=None, filter_namespaces=('0',),
+                 parallel_ingest=False, index_fname=None):
         """
         Initialize the corpus. Unless a dictionary is provided, this scans the
         corpus once, to determine its vocabulary.
@@ -267,6 +388,14 @@ class WikiCorpus(TextCorpus):
         token lemmas. Otherwise, use simple regexp tokenization. You can override
         this automatic logic by forcing the `lemmatize` parameter explicitly.
 
+        With `parallel_ingest`, a multistream dump is split at its bz2 stream
+        boundaries (read from the multistream index `index_fname` if given, or
+        found by scanning the dump), and the worker processes decompress and
+        parse whole ranges of streams, instead of only processing the articles
+        that a single thread decompressed and parsed for them. The articles come
+        out in the same order either way. A regular single-stream dump falls back
+        to the serial reader.
+
         """
         self.fname = fname
         self.filter_namespaces = filter_namespaces
@@ -275,6 +404,8 @@ class WikiCorpus(TextCorpus):
             processes = max(1, multiprocessing.cpu_count() - 1)
         self.processes = processes
         self.lemmatize = lemmatize
+        self.parallel_ingest = parallel_ingest
+        self.index_fname = index_fname
         if dictionary is None:
             self.dictionary = Dictionary(self.get_texts())
         else:
@@ -296,23 +427,19 @@ class WikiCorpus(TextCorpus):
         """
         articles, articles_all = 0, 0
         positions, positions_all = 0, 0
-        texts = ((text, self.lemmatize, title, pageid) for title, text, pageid in extract_pages(bz2.BZ2File(self.fname), self.filter_namespaces))
         pool = multiprocessing.Pool(self.processes)
-        # process the corpus in smaller chunks of docs, because multiprocessing.Pool
-        # is dumb and would load the entire input into RAM at once...
-        for group in utils.chunkize(texts, chunksize=10 * self.processes, maxsize=1):
-            for tokens, title, pageid in pool.imap(process_article, group):  # chunksize=10):
-                articles_all += 1
-                positions_all += len(tokens)
-                # article redirects and short stubs are pruned here
-                if len(tokens) < ARTICLE_MIN_WORDS or any(title.startswith(ignore + ':') for ignore in IGNORED_NAMESPACES):
-                    continue
-                articles += 1
-                positions += len(tokens)
-                if self.metadata:
-                    yield (tokens, (pageid, title))
-                else:
-                    yield tokens
+        for tokens, title, pageid in self.processed_articles(pool):
+            articles_all += 1
+            positions_all += len(tokens)
+            # article redirects and short stubs are pruned here
+            if len(tokens) < ARTICLE_MIN_WORDS or any(title.startswith(ignore + ':') for ignore in IGNORED_NAMESPACES):
+                continue
+            articles += 1
+            positions += len(tokens)
+            if self.metadata:
+                yield (tokens, (pageid, title))
+            else:
+                yield tokens
         pool.terminate()
 
         logger.info(
@@ -320,4 +447,34 @@ class WikiCorpus(TextCorpus):
             " (total %i articles, %i positions before pruning articles shorter than %i words)",
             articles, positions, articles_all, positions_all, ARTICLE_MIN_WORDS)
         self.length = articles  # cache corpus length
+
+    def stream_offsets(self):
+        if self.index_fname is not None:
+            # the index lists the page streams only: the XML header is its own stream at offset 0
+            return sorted(set([0] + read_multistream_index(self.index_fname)))
+        return find_bz2_streams(self.fname)
+
+    def processed_articles(self, pool):
+        """
+        Iterate over (tokens, title, pageid) of every article in the dump, in order.
+        """
+        if self.parallel_ingest:
+            offsets = self.stream_offsets()
+            if len(offsets) > 1:
+                namespace = get_dump_namespace(self.fname, offsets)
+                ranges = stream_ranges(offsets, os.path.getsize(self.fname), self.ingest_range_bytes)
+                logger.info("ingesting %i bz2 streams in %i ranges with %i processes", len(offsets), len(ranges), self.processes)
+                tasks = ((self.fname, start, end, namespace, self.lemmatize, self.filter_namespaces) for start, end in ranges)
+                for results in pool.imap(extract_range, tasks):
+                    for result in results:
+                        yield result
+                return
+            logger.warning("%s is a single bz2 stream, so it can't be ingested in parallel", self.fname)
+
+        texts = ((text, self.lemmatize, title, pageid) for title, text, pageid in extract_pages(bz2.BZ2File(self.fname), self.filter_namespaces))
+        # process the corpus in smaller chunks of docs, because multiprocessing.Pool
+        # is dumb and would load the entire input into RAM at once...
+        for group in utils.chunkize(texts, chunksize=10 * self.processes, maxsize=1):
+            for result in pool.imap(process_article, group):  # chunksize=10):
+                yield result
 # endclass WikiCorpus
@@ -9,13 +9,17 @@ Automated tests for checking the WikiCorpus
 """
 
 
+import bz2
+import hashlib
 import os
 import sys
 import types
 import logging
+import tempfile
 import unittest
 
-from gensim.corpora.wikicorpus import WikiCorpus
+from gensim.corpora.wikicorpus import WikiCorpus, extract_pages, filter_wiki, find_bz2_streams, read_multistream_index, \
+    remove_markup, remove_template, stream_ranges
 
 
 module_path = os.path.dirname(__file__) # needed because sample data files are located in the same folder
@@ -24,6 +28,31 @@ FILENAME = 'enwiki-latest-pages-articles1.xml-p000000010p000030302-shortened.bz2
 
 logger = logging.getLogger(__name__)
 
+
+def write_multistream(fname, pages_per_stream=10):
+    """
+    Rewrite the sample dump as a multistream dump (the XML header, then streams of
+    `pages_per_stream` pages, then the footer, each its own bz2 stream), like
+    \*pages-articles-multistream.xml.bz2, plus its index.
+    Return (dump filename, index filename, stream offsets).
+    """
+    with bz2.BZ2File(datapath(FILENAME)) as f:
+        xml = f.read()
+    first, last = xml.find(b'  <page>'), xml.rfind(b'</page>') + len(b'</page>\n')
+    pages = [b'  <page>' + page for page in xml[first:last].split(b'  <page>')[1:]]
+    streams = [xml[:first]]
+    streams += [b''.join(pages[i:i + pages_per_stream]) for i in range(0, len(pages), pages_per_stream)]
+    streams.append(xml[last:])
+    offsets = []
+    index_fname = fname + '.index.txt'
+    with open(fname, 'wb') as dump, open(index_fname, 'wb') as index:
+        for i, stream in enumerate(streams):
+            offsets.append(dump.tell())
+            if 0 < i < len(streams) - 1:
+                index.write(b'%i:%i:title\n' % (offsets[-1], i))
+            dump.write(bz2.compress(stream))
+    return fname, index_fname, offsets
+
 class TestWikiCorpus(unittest.TestCase):
 
     # #TODO: sporadic failure to be investigated
@@ -55,6 +84,70 @@ class TestWikiCorpus(unittest.TestCase):
         self.assertTrue(b"autism" in next(l))
 
 
+class TestParallelIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname, self.index_fname, self.offsets = write_multistream(os.path.join(self.tmpdir, 'multistream.xml.bz2'))
+
+    def tearDown(self):
+        for fname in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, fname))
+        os.rmdir(self.tmpdir)
+
+    def serial_texts(self):
+        return list(WikiCorpus(datapath(FILENAME), processes=2, lemmatize=False, dictionary={}).get_texts())
+
+    def test_find_bz2_streams(self):
+        self.assertEqual(find_bz2_streams(self.fname), self.offsets)
+        self.assertEqual(find_bz2_streams(self.fname, block_size=4096), self.offsets)
+        self.assertEqual(find_bz2_streams(datapath(FILENAME)), [0])
+
+    def test_read_multistream_index(self):
+        self.assertEqual(read_multistream_index(self.index_fname), self.offsets[1:-1])
+
+    def test_stream_ranges(self):
+        self.assertEqual(stream_ranges([0, 10, 20, 30], 40, min_bytes=15), [(0, 20), (20, 40)])
+        self.assertEqual(stream_ranges([0, 10, 20, 30], 40, min_bytes=1), [(0, 10), (10, 20), (20, 30), (30, 40)])
+        self.assertEqual(stream_ranges([0], 40), [(0, 40)])
+
+    def test_parallel_ingest_matches_serial(self):
+        expected = self.serial_texts()
+        for kwargs in ({}, {'index_fname': self.index_fname}):
+            wc = WikiCorpus(self.fname, processes=2, lemmatize=False, dictionary={}, parallel_ingest=True, **kwargs)
+            wc.ingest_range_bytes = 4096  # several ranges, even for the small sample
+            self.assertEqual(list(wc.get_texts()), expected)
+
+    def test_single_stream_falls_back_to_serial(self):
+        wc = WikiCorpus(datapath(FILENAME), processes=2, lemmatize=False, dictionary={}, parallel_ingest=True)
+        self.assertEqual(list(wc.get_texts()), self.serial_texts())
+
+
+class TestFilterWiki(unittest.TestCase):
+    # sha1 of the filter_wiki output of every page in the sample dump, joined by '\x00', as produced by the
+    # original character-by-character remove_template and unguarded regex loop
+    SAMPLE_SHA1 = '1c147f3bb4a82dcbddcfba963ac63edcbe939503'
+
+    def test_sample_dump_unchanged(self):
+        texts = [filter_wiki(text) for _, text, _ in extract_pages(bz2.BZ2File(datapath(FILENAME)))]
+        self.assertEqual(len(texts), 206)
+        self.assertEqual(hashlib.sha1(u'\x00'.join(texts).encode('utf8')).hexdigest(), self.SAMPLE_SHA1)
+
+    def test_remove_template(self):
+        self.assertEqual(remove_template(u'a{{b}}c'), u'ac')
+        self.assertEqual(remove_template(u'a{{b{{c}}d}}e'), u'ae')
+        self.assertEqual(remove_template(u'{{a}}{{b}}'), u'')
+        self.assertEqual(remove_template(u'x}}{{y}} {z}'), u'x}} {z}')
+        self.assertEqual(remove_template(u'a{{{b}}}c{{d'), u'ac')  # an unclosed template eats the rest
+
+    def test_remove_markup(self):
+        self.assertEqual(remove_markup(u'text\n[[en:Foo]]\n[[de:Bar]]\n'), u'text\n')
+        self.assertEqual(remove_markup(u'text\n[[en:Foo]] tail'), u'text\nen:Foo tail')
+        self.assertEqual(
+            remove_markup(u'[[Category:X]] {{cite|a}} <ref>r</ref>word [http://x.org desc] [[a|b]]'),
+            u'  word  desc b',
+        )
+
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.DEBUG)
     unittest.main()
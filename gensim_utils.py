@@ -80,6 +80,22 @@ def batch_generator2(model, sentences, batch_size):
     if batch:
         yield batch
 
+def index_batch_generator(documents, window, batch_size):
+    '''
+    `batch_generator2` for documents that are already arrays of vocab indices (e.g. corpus_store.CompiledCorpus.documents),
+        so there's no per-token vocab lookup. Chunks are views into the documents.
+    '''
+    batch = []
+    chunk_len = 1 + 2*window
+    for document in documents:
+        for i in range(0, len(document), chunk_len):
+            batch.append(document[i:i+chunk_len])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 if __name__ == '__main__':
     def sentences_generator(num_sents=5e6):
         num_sents = int(num_sents)
@@ -0,0 +1,176 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+
+class WorkerStats(object):
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.num_batches = 0
+        self.num_entries = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.last_losses = None
+
+    def throughput(self):
+        return self.num_entries / max(self.busy_time, 1e-9)
+
+    def __str__(self):
+        return 'worker {}: {} batches, {} entries, {:.0f} entries/sec (busy {:.1f} secs, waited {:.1f} secs for batches)'.format(
+            self.worker_id, self.num_batches, self.num_entries, self.throughput(), self.busy_time, self.wait_time,
+        )
+
+
+def batch_size(values):
+    if isinstance(values, (list, tuple)):  # joint batches have one values array per order
+        return sum(len(v) for v in values)
+    return len(values)
+
+
+def hogwild_worker(decomp, worker_id, tasks, print_every, results=None):
+    '''
+    Pulls batches off `tasks` until it gets None, applying each one's sparse update to the shared parameters of
+        `decomp` without any locking. (stats, None) gets put on `results` when it's done, or (stats, traceback) as
+        soon as anything fails.
+    '''
+    stats = WorkerStats(worker_id)
+    error = None
+    try:
+        while True:
+            t = time.time()
+            batch = tasks.get()
+            stats.wait_time += time.time() - t
+            if batch is None:
+                break
+            t = time.time()
+            losses, row_grads = decomp.batch_gradients(*batch)  # (indices, values) or (indices, values, weights)
+            decomp.apply_gradients(row_grads)
+            stats.busy_time += time.time() - t
+            stats.num_batches += 1
+            stats.num_entries += batch_size(batch[1])
+            stats.last_losses = losses
+            if stats.num_batches % print_every == 0:
+                errstring = '; '.join('{:.3f}'.format(loss) for loss in losses)
+                print('worker {}: batch {}: Errs: {} ({:.0f} entries/sec)'.format(worker_id, stats.num_batches, errstring, stats.throughput()))
+    except Exception:
+        error = traceback.format_exc()
+    if results is not None:
+        results.put((stats, error))
+    return stats
+
+
+def poll_results(workers, results, collected, timeout=None):
+    '''
+    Moves the stats the workers have put on `results` (waiting up to `timeout` secs for them) to `collected`.
+    Raises if a worker failed or died, rather than waiting for batches or stats that will never get picked up.
+    '''
+    try:
+        stats, error = results.get(timeout=timeout) if timeout else results.get_nowait()
+    except queue.Empty:
+        dead = [worker for worker in workers if getattr(worker, 'exitcode', None) not in (None, 0)]
+        if dead:
+            raise RuntimeError('Hogwild worker process {} died with exit code {}'.format(dead[0].pid, dead[0].exitcode))
+        if timeout and not any(worker.is_alive() for worker in workers):
+            raise RuntimeError('Hogwild workers exited with only {} of {} results'.format(len(collected), len(workers)))
+        return
+    if error is not None:
+        raise RuntimeError('Hogwild worker {} failed:\n{}'.format(stats.worker_id, error))
+    collected.append(stats)
+
+
+class HogwildTrainer(object):
+    def __init__(self, decomp, num_workers=None, use_processes=False, queue_depth=None, print_every=100):
+        '''
+        Trains a numpy_decomp decomposition Hogwild-style: `num_workers` threads (or forked processes, if
+            `use_processes`) each pull sparse batches off one bounded queue and apply lazy row updates (see
+            NumpyDecomp.sparse_updates) straight to the shared factor matrix, without locks.
+            Batches rarely share rows, so the occasional lost update doesn't hurt convergence.
+
+        Threads share `decomp` as is, and scale as far as the NumPy kernels release the GIL.
+        Processes get the parameters and optimizer slots through shared memory (see NumpyDecomp.share_memory),
+            at the cost of pickling every batch through the queue.
+        If any worker fails, `train` raises a RuntimeError with its traceback (and terminates the worker processes).
+
+        Only the first-order optimizers (adam, sgd, adagrad) have the per-row slots the workers update; the
+            expected-tensor updates of 'sals' and '2sgd' are full-batch, and get rejected.
+        '''
+        optimizer_type = getattr(decomp, 'optimizer_type', None)
+        if optimizer_type not in decomp.learning_rates:
+            raise ValueError('Hogwild training needs one of the {} optimizers, not {}'.format(
+                '/'.join(sorted(decomp.learning_rates)), optimizer_type,
+            ))
+        self.decomp = decomp
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.use_processes = use_processes
+        self.queue_depth = queue_depth or 4 * self.num_workers
+        self.print_every = print_every
+        self.worker_stats = []
+
+    def train(self, expected_tensors, results_file=None, write_loss=False):
+        '''
+        Feeds every batch of the `expected_tensors` generator to the workers, and returns the per-worker stats.
+        '''
+        decomp = self.decomp
+        decomp.sparse_updates = True  # dense updates of the whole matrix would make every worker collide
+        decomp.start_training(results_file, write_loss=write_loss, checkpoint_every=None)
+        if self.use_processes:
+            decomp.share_memory()
+            context = multiprocessing.get_context('fork')
+            tasks = context.Queue(self.queue_depth)
+            results = context.Queue()
+            workers = [
+                context.Process(target=hogwild_worker, args=(decomp, i, tasks, self.print_every, results))
+                for i in range(self.num_workers)
+            ]
+        else:
+            tasks = queue.Queue(self.queue_depth)
+            results = queue.Queue()
+            workers = [
+                threading.Thread(target=hogwild_worker, args=(decomp, i, tasks, self.print_every, results))
+                for i in range(self.num_workers)
+            ]
+        print('Starting Hogwild training with {} {}...'.format(self.num_workers, 'processes' if self.use_processes else 'threads'))
+        t = time.time()
+        for worker in workers:
+            worker.daemon = True  # so a failed run can't leave threads blocked on the task queue behind
+            worker.start()
+        num_batches = 0
+        collected = []
+        try:
+            for batch in itertools.chain((tuple(batch) for batch in expected_tensors), [None] * len(workers)):
+                while True:
+                    try:
+                        tasks.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        poll_results(workers, results, collected)
+                poll_results(workers, results, collected)
+                num_batches += batch is not None
+            while len(collected) < len(workers):
+                poll_results(workers, results, collected, timeout=0.1)
+        except Exception:
+            if self.use_processes:
+                # the batches still buffered in `tasks` will never be read: don't let its feeder thread block the exit on them
+                tasks.cancel_join_thread()
+                tasks.close()
+                for worker in workers:
+                    worker.terminate()
+            raise
+        self.worker_stats = sorted(collected, key=lambda stats: stats.worker_id)
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - t
+        decomp.global_step += num_batches
+        decomp.batch_num += num_batches
+
+        num_entries = sum(stats.num_entries for stats in self.worker_stats)
+        for stats in self.worker_stats:
+            print(stats)
+        print('Hogwild training on {} batches took {:.1f} secs ({:.0f} entries/sec overall)'.format(num_batches, elapsed, num_entries / max(elapsed, 1e-9)))
+        if results_file is not None:
+            print('avg batch time: {}'.format(elapsed / max(num_batches, 1)), file=results_file)
+        decomp.finish_training()
+        return self.worker_stats
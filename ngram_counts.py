@@ -0,0 +1,634 @@
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import queue
+import time
+import traceback
+
+KEY_DTYPE = np.uint64
+COUNT_DTYPE = np.uint32  # a co-occurrence count can't exceed the number of chunks in the corpus
+FORMAT_VERSION = 1  # bump whenever save_arrays/load_arrays stop being able to read older directories
+
+
+def bits_per_index(vocab_len, n):
+    '''
+    Number of bits each vocab index takes up inside a packed key.
+    All `n` indices of a tuple have to fit into a single uint64.
+    '''
+    bits = max(1, int(vocab_len - 1).bit_length())
+    if bits * n > 64:
+        raise ValueError('Cannot pack {}-tuples of a {} word vocab into 64 bits'.format(n, vocab_len))
+    return bits
+
+
+def pack_indices(indices, bits):
+    '''
+    Packs an (N, n) array of sorted index tuples into N uint64 keys.
+    The first index goes into the most significant bits, so sorting the keys sorts the tuples lexicographically.
+    '''
+    indices = np.asarray(indices)
+    keys = np.zeros(len(indices), dtype=KEY_DTYPE)
+    shift = KEY_DTYPE(bits)
+    for d in range(indices.shape[1]):
+        keys <<= shift
+        keys |= indices[:, d].astype(KEY_DTYPE)
+    return keys
+
+
+def unpack_keys(keys, n, bits, dtype=np.int32):
+    ''' Inverse of `pack_indices`. Returns an (N, n) array of index tuples. '''
+    keys = np.array(keys, dtype=KEY_DTYPE)
+    indices = np.zeros((len(keys), n), dtype=dtype)
+    mask = KEY_DTYPE((1 << bits) - 1)
+    shift = KEY_DTYPE(bits)
+    for d in range(n - 1, -1, -1):
+        indices[:, d] = keys & mask
+        keys >>= shift
+    return indices
+
+
+def reduce_sorted(keys, counts):
+    '''
+    Sums the counts of equal keys. `keys` must already be sorted.
+    '''
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts).astype(COUNT_DTYPE, copy=False)
+
+
+def count_keys(keys):
+    '''
+    Returns the sorted unique `keys` and how many times each of them occurs.
+    '''
+    keys = np.sort(keys)
+    if len(keys) == 0:
+        return keys, np.zeros(0, dtype=COUNT_DTYPE)
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys))).astype(COUNT_DTYPE)
+    return keys[starts], counts
+
+
+def merge_counts(runs):
+    '''
+    Merges a list of (keys, counts) runs into a single sorted run, summing the counts of shared keys.
+    '''
+    runs = [run for run in runs if len(run[0])]
+    if not runs:
+        return np.zeros(0, dtype=KEY_DTYPE), np.zeros(0, dtype=COUNT_DTYPE)
+    if len(runs) == 1:
+        return runs[0]
+    keys = np.concatenate([k for k, _ in runs])
+    counts = np.concatenate([c for _, c in runs])
+    order = np.argsort(keys, kind='mergesort')  # the runs are already sorted, which mergesort exploits
+    return reduce_sorted(keys[order], counts[order])
+
+
+def pad_chunks(batch, width=None, pad=-1):
+    '''
+    Turns a batch of sentence chunks (lists of vocab indices, see gensim_utils.batch_generator2)
+        into a single int32 matrix with one chunk per row, padded with `pad`.
+    (matrix, lengths) batches (see corpus_store.CompiledCorpus.chunk_batches) are already padded with -1.
+    '''
+    if isinstance(batch, tuple):
+        return batch[0]
+    if isinstance(batch, np.ndarray):
+        return batch
+    if width is None:
+        width = max((len(chunk) for chunk in batch), default=0)
+    matrix = np.full((len(batch), width), pad, dtype=np.int32)
+    for i, chunk in enumerate(batch):
+        matrix[i, :len(chunk)] = chunk
+    return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def combination_template(length, n):
+    '''
+    All sorted n-combinations of the positions 0..length-1, as a (C(length, n), n) array, in itertools order.
+    '''
+    return np.array(list(itertools.combinations(range(length), n)), dtype=np.intp).reshape(-1, n)
+
+
+@functools.lru_cache(maxsize=None)
+def permutation_template(n):
+    '''
+    (n!, n) array whose row j puts a sorted tuple into the j-th (itertools) permutation of its positions,
+        i.e. `tup[template[j]][perm[k]] == tup[k]`.
+    '''
+    return np.array([np.argsort(perm) for perm in itertools.permutations(range(n))], dtype=np.intp).reshape(-1, n)
+
+
+def expand_permutations(indices, values):
+    '''
+    Expands each sorted index tuple (and its value) into all n! permutations of it, for non-symmetric decompositions.
+    Row `n!*i + j` of the result is the j-th permutation of `indices[i]`.
+    '''
+    indices = np.asarray(indices, dtype=np.int32).reshape(len(values), -1)
+    template = permutation_template(indices.shape[1])
+    return indices[:, template].reshape(-1, indices.shape[1]), np.repeat(values, len(template))
+
+
+def pack_joint_batch(indices, values, width=None):
+    '''
+    Turns a joint batch with one part per order ([indices_2d, indices_3d, ...], [values_2d, values_3d, ...]) into a
+        single packed batch: an (N, width) int32 index matrix whose rows are padded with -1 past their order, and the
+        (N,) values. `width` defaults to the highest order.
+    '''
+    if width is None:
+        width = max(np.shape(ix)[-1] for ix in indices)
+    packed_indices, packed_values = [], []
+    for part_indices, part_values in zip(indices, values):
+        part_values = np.asarray(part_values, dtype=np.float32).ravel()
+        part_indices = np.asarray(part_indices, dtype=np.int32).reshape(len(part_values), -1)
+        padded = np.full((len(part_values), width), -1, dtype=np.int32)
+        padded[:, :part_indices.shape[1]] = part_indices
+        packed_indices.append(padded)
+        packed_values.append(part_values)
+    return np.concatenate(packed_indices), np.concatenate(packed_values)
+
+
+def joint_order_slots(indices, dimlist):
+    '''
+    Position in `dimlist` of the order of every row of a packed joint batch (see pack_joint_batch).
+    '''
+    slot_of_order = np.full(max(dimlist) + 1, -1, dtype=np.int32)
+    slot_of_order[list(dimlist)] = np.arange(len(dimlist))
+    return slot_of_order[(np.asarray(indices) >= 0).sum(axis=1)]
+
+
+def sorted_unique_rows(matrix, pad=-1):
+    '''
+    Sorts every row of a padded chunk matrix and drops repeated indices within a row.
+    Returns (rows, lengths): the unique indices of each row in ascending order, left-aligned and padded with `pad`,
+        and how many unique indices each row has.
+    '''
+    sentinel = np.iinfo(np.int32).max
+    rows = np.where(matrix < 0, sentinel, matrix).astype(np.int32)
+    rows.sort(axis=1)
+    if rows.shape[1] > 1:
+        repeated = np.zeros(rows.shape, dtype=bool)
+        repeated[:, 1:] = rows[:, 1:] == rows[:, :-1]
+        rows[repeated] = sentinel
+        rows.sort(axis=1)
+    empty = rows == sentinel
+    lengths = rows.shape[1] - empty.sum(axis=1)
+    rows[empty] = pad
+    return rows, lengths
+
+
+def chunk_combinations(rows, lengths, n):
+    '''
+    All sorted n-tuples of distinct indices within each row of `rows` (as returned by `sorted_unique_rows`).
+    Rows with fewer than `n` unique indices contribute nothing. Returns an (N, n) int32 array.
+    '''
+    combinations = []
+    for length in np.unique(lengths[lengths >= n]):
+        same_length = rows[lengths == length, :length]
+        combinations.append(same_length[:, combination_template(int(length), n)].reshape(-1, n))
+    if not combinations:
+        return np.zeros((0, n), dtype=np.int32)
+    return np.concatenate(combinations)
+
+
+PruneReport = collections.namedtuple('PruneReport', ['strategy', 'entries_before', 'entries_after', 'bytes_reclaimed', 'mass_dropped'])
+PruneReport.__str__ = lambda self: '{}: {} -> {} n_counts, reclaimed {:.1f} MB, dropped {:.3%} of the count mass'.format(
+    self.strategy, self.entries_before, self.entries_after, self.bytes_reclaimed / 2**20, self.mass_dropped)
+
+
+def threshold_mask(counts, min_count):
+    ''' Keeps the entries with a count > `min_count`. '''
+    return counts > min_count
+
+
+def top_k_mask(keys, counts, k):
+    '''
+    Keeps the `k` entries with the highest counts. Ties at the cutoff go to the smallest keys, so the result is deterministic.
+    '''
+    if k >= len(counts):
+        return np.ones(len(counts), dtype=bool)
+    if k <= 0:
+        return np.zeros(len(counts), dtype=bool)
+    cutoff = np.partition(counts, len(counts) - k)[len(counts) - k]
+    keep = counts > cutoff
+    tied = np.flatnonzero(counts == cutoff)  # already in key order, since keys are sorted
+    keep[tied[:k - keep.sum()]] = True
+    return keep
+
+
+class CountMinSketch(object):
+    def __init__(self, width=2**24, depth=4, seed=0):
+        '''
+        Count-min sketch over packed keys: `depth` rows of `width` counters, each indexed by a multiply-shift hash.
+        Estimates never undercount, so pruning by estimate never drops a key that is really above the cutoff.
+        '''
+        assert width & (width - 1) == 0, 'width must be a power of two'
+        self.width = width
+        self.shift = KEY_DTYPE(64 - (width.bit_length() - 1))
+        random_state = np.random.RandomState(seed)
+        self.multipliers = random_state.randint(1, 2**62, size=depth).astype(KEY_DTYPE) * KEY_DTYPE(2) + KEY_DTYPE(1)  # odd
+        self.table = np.zeros((depth, width), dtype=COUNT_DTYPE)
+
+    def _buckets(self, keys, row):
+        return ((keys * self.multipliers[row]) >> self.shift).astype(np.intp)
+
+    def update(self, keys, counts):
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        for row in range(len(self.table)):
+            np.add.at(self.table[row], self._buckets(keys, row), counts)
+
+    def estimate(self, keys):
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        return np.min([self.table[row][self._buckets(keys, row)] for row in range(len(self.table))], axis=0)
+
+
+def chunk_unigrams(rows, lengths, n, vocab_len):
+    '''
+    Unigram counts and number of samples contributed by the rows of `sorted_unique_rows` that have at least `n` unique indices.
+    '''
+    kept = rows[lengths >= n]
+    return np.bincount(kept[kept >= 0], minlength=vocab_len), int(lengths[lengths >= n].sum())
+
+
+def tree_reduce(runs):
+    ''' Merges (keys, counts) runs pairwise, in rounds, until only one is left. '''
+    runs = list(runs)
+    if not runs:
+        return merge_counts([])
+    while len(runs) > 1:
+        runs = [merge_counts(runs[i:i + 2]) for i in range(0, len(runs), 2)]
+    return runs[0]
+
+
+def _count_worker(n, vocab_len, buffer_size, tasks, results):
+    '''
+    Counts batches off `tasks` until it gets None, then puts ('ok', partial counts) on `results`,
+        or ('error', traceback) as soon as anything fails.
+    '''
+    try:
+        counter = PackedCounter(n, vocab_len, buffer_size=buffer_size)
+        uni_counts = np.zeros(vocab_len, dtype=np.int64)
+        num_samples = 0
+        while True:
+            matrix = tasks.get()
+            if matrix is None:
+                break
+            rows, lengths = sorted_unique_rows(matrix)
+            counter.update(chunk_combinations(rows, lengths, n))
+            batch_uni_counts, batch_samples = chunk_unigrams(rows, lengths, n, vocab_len)
+            uni_counts += batch_uni_counts
+            num_samples += batch_samples
+        counter.flush()
+        results.put(('ok', (counter.keys, counter.counts, uni_counts, num_samples)))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def _poll_count_results(workers, results, partials, timeout=None):
+    '''
+    Moves whatever the count workers have put on `results` (waiting up to `timeout` secs for it) to `partials`.
+    Raises if a worker failed or died, rather than waiting for results that will never come.
+    '''
+    try:
+        status, payload = results.get(timeout=timeout) if timeout else results.get_nowait()
+    except queue.Empty:
+        dead = [worker for worker in workers if worker.exitcode not in (None, 0)]
+        if dead:
+            raise RuntimeError('count worker {} died with exit code {}'.format(dead[0].pid, dead[0].exitcode))
+        if timeout and all(worker.exitcode is not None for worker in workers):
+            raise RuntimeError('count workers exited with only {} of {} results'.format(len(partials), len(workers)))
+        return
+    if status == 'error':
+        raise RuntimeError('count worker failed:\n{}'.format(payload))
+    partials.append(payload)
+
+
+def count_parallel(batches, n, vocab_len, processes=None, queue_depth=None, buffer_size=2**24):
+    '''
+    Map-reduce counting of the n-grams in `batches` (sent chunk lists or padded chunk matrices).
+    The parent only pads each batch into a compact int32 matrix and queues it; each worker process keeps its own PackedCounter,
+        and the workers' partial counts are tree-reduced at the end.
+    If a worker fails (or dies), the rest get terminated and a RuntimeError carries its traceback.
+    Returns (counter, uni_counts, num_samples).
+    '''
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+    if queue_depth is None:
+        queue_depth = 4 * processes
+    tasks = multiprocessing.Queue(maxsize=queue_depth)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_count_worker, args=(n, vocab_len, buffer_size, tasks, results))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    partials = []
+    try:
+        for task in itertools.chain((pad_chunks(batch) for batch in batches), [None] * len(workers)):
+            while True:
+                try:
+                    tasks.put(task, timeout=0.1)
+                    break
+                except queue.Full:
+                    _poll_count_results(workers, results, partials)
+            _poll_count_results(workers, results, partials)
+        while len(partials) < len(workers):  # drain before joining, or the workers can't exit
+            _poll_count_results(workers, results, partials, timeout=0.1)
+    finally:
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+
+    counter = PackedCounter(n, vocab_len, buffer_size=buffer_size)
+    counter.keys, counter.counts = tree_reduce((keys, counts) for keys, counts, _, _ in partials)
+    uni_counts = sum(uni for _, _, uni, _ in partials)
+    num_samples = sum(samples for _, _, _, samples in partials)
+    return counter, uni_counts, num_samples
+
+
+def vocab_hash(index2word):
+    ''' Fingerprint of a vocab (words and their order), so saved counts don't get used with the wrong vocab. '''
+    return hashlib.sha1('\n'.join(index2word).encode('utf8')).hexdigest()
+
+
+def save_arrays(dirname, header, arrays):
+    '''
+    Saves `arrays` (name -> 1D numpy array) as raw binary files in `dirname`, plus a header.json holding
+        `header`, the format version, and the dtype/length of each array.
+    '''
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    array_infos = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        array.tofile(os.path.join(dirname, name + '.bin'))
+        array_infos[name] = (array.dtype, len(array))
+    save_header(dirname, header, array_infos)
+
+
+def save_header(dirname, header, array_infos):
+    '''
+    Writes the header.json of a `save_arrays` directory whose .bin files were written some other way (e.g. streamed).
+    `array_infos` maps each array name to its (dtype, length).
+    '''
+    header = dict(header, version=FORMAT_VERSION, arrays={})
+    for name, (dtype, length) in array_infos.items():
+        header['arrays'][name] = {'dtype': np.dtype(dtype).str, 'length': int(length)}
+    with open(os.path.join(dirname, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=2)  # written last, so a half-written directory never looks complete
+
+
+def load_arrays(dirname, mmap=True):
+    '''
+    Loads a directory written by `save_arrays`. Returns (header, arrays).
+    With `mmap`, arrays are read-only np.memmaps, so loading is instant and the pages are shared between processes.
+    '''
+    with open(os.path.join(dirname, 'header.json')) as f:
+        header = json.load(f)
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError('{} was saved with format version {}, but only versions <= {} can be read'.format(dirname, header['version'], FORMAT_VERSION))
+    arrays = {}
+    for name, info in header['arrays'].items():
+        fname = os.path.join(dirname, name + '.bin')
+        dtype = np.dtype(info['dtype'])
+        if not mmap or info['length'] == 0:  # can't mmap an empty file
+            arrays[name] = np.fromfile(fname, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(fname, dtype=dtype, mode='r', shape=(info['length'],))
+    return header, arrays
+
+
+def write_run(prefix, keys, counts):
+    ''' Writes a sorted (keys, counts) run as two raw binary files, `prefix`.keys and `prefix`.counts '''
+    keys.astype(KEY_DTYPE, copy=False).tofile(prefix + '.keys')
+    counts.astype(COUNT_DTYPE, copy=False).tofile(prefix + '.counts')
+
+
+def open_run(prefix, mode='r'):
+    ''' Memory-maps a run written by `write_run` (or `merge_runs`). '''
+    if os.path.getsize(prefix + '.keys') == 0:  # can't mmap an empty file
+        return np.zeros(0, dtype=KEY_DTYPE), np.zeros(0, dtype=COUNT_DTYPE)
+    return np.memmap(prefix + '.keys', dtype=KEY_DTYPE, mode=mode), np.memmap(prefix + '.counts', dtype=COUNT_DTYPE, mode=mode)
+
+
+def merge_runs(prefixes, out_prefix, min_count=0, block_size=2**22):
+    '''
+    k-way merges the sorted runs at `prefixes` into a single run at `out_prefix`, keeping only counts > `min_count`.
+    At most about `block_size` entries per run are in memory at once.
+
+    Each round takes the next block of every run, and merges everything up to the smallest last key of those blocks.
+        That key's block is used up entirely, and no key can be split between two rounds.
+    Returns the number of entries written.
+    '''
+    runs = [open_run(prefix) for prefix in prefixes]
+    cursors = [0] * len(runs)
+    num_written = 0
+    with open(out_prefix + '.keys', 'wb') as keys_file, open(out_prefix + '.counts', 'wb') as counts_file:
+        while True:
+            active = [i for i, (keys, _) in enumerate(runs) if cursors[i] < len(keys)]
+            if not active:
+                break
+            frontier = min(runs[i][0][min(cursors[i] + block_size, len(runs[i][0])) - 1] for i in active)
+            pieces = []
+            for i in active:
+                keys, counts = runs[i]
+                start = cursors[i]
+                stop = start + np.searchsorted(keys[start:start + block_size], frontier, side='right')
+                pieces.append((np.asarray(keys[start:stop]), np.asarray(counts[start:stop])))
+                cursors[i] = stop
+            keys, counts = merge_counts(pieces)
+            keep = counts > min_count
+            keys[keep].tofile(keys_file)
+            counts[keep].tofile(counts_file)
+            num_written += int(keep.sum())
+    return num_written
+
+
+class PackedCounter(object):
+    def __init__(self, n, vocab_len, buffer_size=2**24):
+        '''
+        Counts sorted n-tuples of vocab indices.
+        Every tuple is packed into a single uint64 key. The keys are kept in a sorted array alongside their counts,
+            so each entry costs 12 bytes instead of the ~100+ bytes of a tuple-keyed dict.
+
+        Updates are buffered as per-batch (unique keys, counts) runs and merged into the sorted arrays
+            once more than `buffer_size` pending keys have accumulated.
+        '''
+        self.n = n
+        self.vocab_len = vocab_len
+        self.bits = bits_per_index(vocab_len, n)
+        self.buffer_size = buffer_size
+        self.keys = np.zeros(0, dtype=KEY_DTYPE)
+        self.counts = np.zeros(0, dtype=COUNT_DTYPE)
+        self._pending = []
+        self._num_pending = 0
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        self.flush()
+        return self.keys.nbytes + self.counts.nbytes
+
+    def pack(self, indices):
+        return pack_indices(np.asarray(indices).reshape(-1, self.n), self.bits)
+
+    def unpack(self, keys, dtype=np.int32):
+        return unpack_keys(keys, self.n, self.bits, dtype=dtype)
+
+    def update(self, indices):
+        '''
+        `indices` is an (N, n) array (or list) of sorted index tuples. Each row counts once.
+        '''
+        self.update_keys(self.pack(indices))
+
+    def update_keys(self, keys, counts=None):
+        if counts is None:
+            keys, counts = count_keys(keys)
+        if not len(keys):
+            return
+        self._pending.append((keys, counts))
+        self._num_pending += len(keys)
+        if self._num_pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.keys, self.counts = merge_counts([(self.keys, self.counts)] + self._pending)
+        self._pending = []
+        self._num_pending = 0
+
+    def find(self, keys):
+        '''
+        Returns (positions, found): where each key sits in `self.keys`, and whether it is actually there.
+        '''
+        self.flush()
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys
+        return positions, found
+
+    def lookup(self, keys):
+        ''' Counts of `keys` (0 for keys that were never seen). '''
+        positions, found = self.find(keys)
+        return np.where(found, self.counts[positions], 0).astype(COUNT_DTYPE)
+
+    def select(self, mask):
+        ''' Keeps only the entries where `mask` is True. '''
+        self.flush()
+        self.keys = self.keys[mask]
+        self.counts = self.counts[mask]
+
+    def prune(self, min_count):
+        ''' Drops every entry with a count <= `min_count`. Returns a PruneReport. '''
+        self.flush()
+        return self.select_and_report(threshold_mask(self.counts, min_count), 'count <= {}'.format(min_count))
+
+    def select_and_report(self, mask, strategy):
+        ''' `select`, reporting how many entries, bytes and how much of the total count got dropped. '''
+        self.flush()
+        entries_before = len(self.keys)
+        total = float(self.counts.sum(dtype=np.int64))
+        dropped = float(self.counts[~mask].sum(dtype=np.int64))
+        self.select(mask)
+        return PruneReport(
+            strategy=strategy,
+            entries_before=entries_before,
+            entries_after=len(self.keys),
+            bytes_reclaimed=(entries_before - len(self.keys)) * (self.keys.itemsize + self.counts.itemsize),
+            mass_dropped=dropped / total if total else 0.0,
+        )
+
+    def shrink(self, max_entries, strategy='threshold', sketch=None):
+        '''
+        Deterministically prunes down to at most `max_entries` entries. Returns a PruneReport.
+            'threshold': drops counts <= m, for the smallest m that leaves few enough
+            'top_k': keeps the `max_entries` highest counts
+            'heavy_hitters': keeps the `max_entries` highest count-min `sketch` estimates, i.e. counts over everything seen so far,
+                including what previous prunes dropped
+        '''
+        self.flush()
+        if strategy == 'threshold':
+            m = 0
+            if len(self.counts) > max_entries:  # smallest m that leaves <= max_entries counts > m
+                m = np.partition(self.counts, len(self.counts) - max_entries - 1)[len(self.counts) - max_entries - 1]
+            return self.select_and_report(threshold_mask(self.counts, m), 'count <= {}'.format(m))
+        elif strategy == 'top_k':
+            return self.select_and_report(top_k_mask(self.keys, self.counts, max_entries), 'top {}'.format(max_entries))
+        elif strategy == 'heavy_hitters':
+            estimates = sketch.estimate(self.keys)
+            return self.select_and_report(top_k_mask(self.keys, estimates, max_entries), 'top {} sketch estimates'.format(max_entries))
+        raise ValueError('undefined prune strategy {}'.format(strategy))
+
+    def kill(self, p=0.5, m=1):
+        ''' Drops each entry with a count <= `m` with probability `p`. '''
+        self.flush()
+        self.select(~((self.counts <= m) & (np.random.random(len(self.counts)) < p)))
+
+
+class SpillingCounter(PackedCounter):
+    def __init__(self, n, vocab_len, spill_dir, memory_budget=2**30, buffer_size=2**24):
+        '''
+        A PackedCounter for corpora whose counts don't fit in RAM.
+        Whenever the merged counts take up more than `memory_budget` bytes, they're written to `spill_dir` as a sorted run
+            and counting starts over from empty. `finalize` k-way merges all runs into a single memory-mapped count file,
+            so the counts are exact (nothing is randomly dropped along the way).
+        '''
+        super(SpillingCounter, self).__init__(n, vocab_len, buffer_size=buffer_size)
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.runs = []
+        self.finalized = False
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def flush(self):
+        super(SpillingCounter, self).flush()
+        if not self.finalized and len(self.keys) * (self.keys.itemsize + self.counts.itemsize) > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        prefix = os.path.join(self.spill_dir, 'run_{:05d}'.format(len(self.runs)))
+        print('spilling {} n_counts to {}...'.format(len(self.keys), prefix))
+        write_run(prefix, self.keys, self.counts)
+        self.runs.append(prefix)
+        self.keys = np.zeros(0, dtype=KEY_DTYPE)
+        self.counts = np.zeros(0, dtype=COUNT_DTYPE)
+
+    def find(self, keys):
+        if self.runs and not self.finalized:
+            raise RuntimeError('SpillingCounter has to be finalized before looking anything up')
+        return super(SpillingCounter, self).find(keys)
+
+    def finalize(self, min_count=0, out_prefix=None):
+        '''
+        Merges all the runs (keeping counts > `min_count`) into `out_prefix` (defaults to `spill_dir`/counts),
+            deletes the runs, and memory-maps the result as this counter's keys and counts.
+        '''
+        super(SpillingCounter, self).flush()
+        if len(self.keys):
+            self.spill()
+        if out_prefix is None:
+            out_prefix = os.path.join(self.spill_dir, 'counts')
+        t = time.time()
+        num_entries = merge_runs(self.runs, out_prefix, min_count=min_count)
+        print('merging {} runs into {} n_counts took {} secs'.format(len(self.runs), num_entries, time.time() - t))
+        for prefix in self.runs:
+            os.remove(prefix + '.keys')
+            os.remove(prefix + '.counts')
+        self.runs = []
+        self.finalized = True
+        self.keys, self.counts = open_run(out_prefix)
@@ -0,0 +1,858 @@
+import datetime
+import math
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import os
+import scipy.linalg
+import time
+
+from ngram_counts import joint_order_slots
+
+
+def segment_sum(rows, values):
+    '''
+    Sums together the entries of `values` that share the same entry of `rows` (like tf.unsorted_segment_sum, but only
+        for the segments that show up). Returns (unique_rows, sums), with `unique_rows` in sorted order.
+    '''
+    if len(rows) == 0:
+        return rows, values
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    return rows[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+def leave_one_out_products(vects):
+    '''
+    `vects` is an (N, d, R) array of the factor rows of N tensor entries.
+    Returns an (N, d, R) array whose [:, i] slice is the Hadamard product of every vects[:, j] with j != i,
+        which is the gradient of sum_r prod_j vects[:, j, r] w.r.t. vects[:, i].
+    Built from prefix and suffix products, so zeros in `vects` are fine.
+    '''
+    n, d, r = vects.shape
+    prods = np.empty_like(vects)
+    prods[:, 0] = 1.
+    for i in range(1, d):
+        np.multiply(prods[:, i-1], vects[:, i-1], out=prods[:, i])
+    suffix = np.ones((n, r), dtype=vects.dtype)
+    for i in range(d - 1, 0, -1):
+        prods[:, i] *= suffix
+        suffix *= vects[:, i]
+    prods[:, 0] *= suffix
+    return prods
+
+
+def sparse_cp_loss(vects, values, weights=None, offsets=None):
+    '''
+    Mean squared error of the CP model on the entries whose factor rows are `vects` (see leave_one_out_products).
+    `weights` optionally weighs the error of each entry, and `offsets` gets added to each prediction (e.g. GloVe biases).
+
+    Returns (loss, entry_grads, coefs):
+        `entry_grads` (N, d, R) is the gradient of the loss w.r.t. every row of `vects`
+        `coefs` (N,) is the gradient of the loss w.r.t. every prediction
+    '''
+    if len(values) == 0:
+        return 0.0, np.zeros_like(vects), np.zeros(0, dtype=vects.dtype)
+    prods = leave_one_out_products(vects)
+    predicted = np.einsum('nr,nr->n', prods[:, 0], vects[:, 0])
+    if offsets is not None:
+        predicted += offsets
+    errors = predicted - values
+    squared_errors = errors ** 2
+    if weights is not None:
+        squared_errors *= weights
+        errors *= weights
+    coefs = errors * (2. / len(values))
+    prods *= coefs[:, None, None]
+    return float(squared_errors.mean()), prods, coefs
+
+
+def shared_array(array):
+    '''
+    Copies `array` into shared memory, so that processes forked afterwards all read and write the same buffer.
+    '''
+    raw = multiprocessing.RawArray(np.ctypeslib.as_ctypes_type(array.dtype), max(array.size, 1))
+    shared = np.frombuffer(raw, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
+class AdamOptimizer(object):
+    def __init__(self, learning_rate=1e-3, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        '''
+        Same update as tf.train.AdamOptimizer, with the moments kept per parameter name and updated in place.
+        '''
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.t = 0
+        self.slots = {}
+
+    def step(self):
+        self.t += 1
+
+    def apply(self, name, param, grad):
+        '''
+        Updates `param` in place. `grad` gets used as scratch space.
+        '''
+        if name not in self.slots:
+            self.slots[name] = (np.zeros_like(param), np.zeros_like(param))
+        m, v = self.slots[name]
+        lr_t = self.learning_rate * np.sqrt(1. - self.beta2 ** self.t) / (1. - self.beta1 ** self.t)
+        m *= self.beta1
+        m += (1. - self.beta1) * grad
+        v *= self.beta2
+        np.square(grad, out=grad)
+        grad *= (1. - self.beta2)
+        v += grad
+        np.sqrt(v, out=grad)
+        grad += self.epsilon
+        np.divide(m, grad, out=grad)
+        grad *= lr_t
+        param -= grad
+
+    def create_sparse_slots(self, name, param):
+        self.slots[name] = (np.zeros_like(param), np.zeros_like(param))
+        self.slots[name + '/t'] = np.zeros(len(param), dtype=np.int64)
+
+    def apply_rows(self, name, param, rows, grad):
+        '''
+        Lazy Adam: only updates `rows` of `param` and of its moments, with `grad` the gradient of those rows.
+        Every row keeps its own step count, so the bias correction of a row matches the number of updates it has seen.
+        '''
+        if name not in self.slots:
+            self.create_sparse_slots(name, param)
+        m, v = self.slots[name]
+        t_rows = self.slots[name + '/t']
+        t_rows[rows] += 1
+        t = t_rows[rows].reshape((-1,) + (1,) * (grad.ndim - 1))
+        lr_t = self.learning_rate * np.sqrt(1. - self.beta2 ** t) / (1. - self.beta1 ** t)
+        m_rows = self.beta1 * m[rows] + (1. - self.beta1) * grad
+        v_rows = self.beta2 * v[rows] + (1. - self.beta2) * np.square(grad)
+        m[rows] = m_rows
+        v[rows] = v_rows
+        param[rows] -= lr_t * m_rows / (np.sqrt(v_rows) + self.epsilon)
+
+
+class AdagradOptimizer(object):
+    def __init__(self, learning_rate=.05, initial_accumulator_value=0.1):
+        '''
+        Same update as tf.train.AdagradOptimizer, with the accumulators kept per parameter name and updated in place.
+        '''
+        self.learning_rate = learning_rate
+        self.initial_accumulator_value = initial_accumulator_value
+        self.t = 0
+        self.slots = {}
+
+    def step(self):
+        self.t += 1
+
+    def apply(self, name, param, grad):
+        if name not in self.slots:
+            self.slots[name] = (np.full_like(param, self.initial_accumulator_value), np.empty_like(param))
+        accumulator, scratch = self.slots[name]
+        np.square(grad, out=scratch)
+        accumulator += scratch
+        np.sqrt(accumulator, out=scratch)
+        np.divide(grad, scratch, out=grad)
+        grad *= self.learning_rate
+        param -= grad
+
+    def create_sparse_slots(self, name, param):
+        self.slots[name] = (np.full_like(param, self.initial_accumulator_value), None)
+
+    def apply_rows(self, name, param, rows, grad):
+        '''
+        Only updates `rows` of `param` and of its accumulator (the other rows have a zero gradient, which
+            wouldn't change them anyway).
+        '''
+        if name not in self.slots:
+            self.create_sparse_slots(name, param)
+        accumulator, _ = self.slots[name]
+        accumulator_rows = accumulator[rows] + np.square(grad)
+        accumulator[rows] = accumulator_rows
+        param[rows] -= self.learning_rate * grad / np.sqrt(accumulator_rows)
+
+
+class SGDOptimizer(object):
+    def __init__(self, learning_rate=1.):
+        self.learning_rate = learning_rate
+        self.t = 0
+
+    def step(self):
+        self.t += 1
+
+    def create_sparse_slots(self, name, param):
+        pass
+
+    def apply(self, name, param, grad):
+        grad *= self.learning_rate
+        param -= grad
+
+    def apply_rows(self, name, param, rows, grad):
+        param[rows] -= self.learning_rate * grad
+
+
+class NumpyDecomp(object):
+    '''
+    Training loop shared by the NumPy decompositions. Subclasses fill in `self.params` (name -> float32 array) and
+        implement `batch_gradients`, which returns the batch losses and the gradient of their (weighted) sum as
+        {param name: (unique rows, gradient of those rows)}, and `reg_loss`/`add_reg_gradient` for the regularizer.
+
+    No graph, session or feed_dict: every step is a handful of vectorized gathers, Hadamard products and segment sums,
+        and the optimizer state gets updated in place.
+
+    With `self.sparse_updates`, only the rows a batch touches get updated (along with their optimizer slots),
+        so a step costs O(batch nnz * R) instead of O(|V| * R). The regularizer is then applied lazily too:
+        a row only gets regularized on the steps that touch it.
+    '''
+    learning_rates = {'adam': 1e-3, 'sgd': 1e-0, 'adagrad': .05}
+
+    @property
+    def U(self):
+        return self.params['U']
+
+    def share_memory(self):
+        '''
+        Moves the parameters and the (sparse) optimizer slots into shared memory, for lock-free training by several
+            forked processes (see hogwild.HogwildTrainer). Call after `init_optimizer`.
+        '''
+        for name, param in self.params.items():
+            self.params[name] = shared_array(param)
+            if name not in self.optimizer.slots:
+                self.optimizer.create_sparse_slots(name, self.params[name])
+        for name, slot in self.optimizer.slots.items():
+            if isinstance(slot, tuple):
+                self.optimizer.slots[name] = tuple(None if a is None else shared_array(a) for a in slot)
+            else:
+                self.optimizer.slots[name] = shared_array(slot)
+
+    def init_optimizer(self):
+        learning_rate = self.learning_rates.get(self.optimizer_type)
+        if self.optimizer_type == 'adam':
+            self.optimizer = AdamOptimizer(learning_rate=learning_rate)
+        elif self.optimizer_type == 'sgd':
+            self.optimizer = SGDOptimizer(learning_rate=learning_rate)
+        elif self.optimizer_type == 'adagrad':
+            self.optimizer = AdagradOptimizer(learning_rate=learning_rate)
+        else:
+            raise ValueError('optimizer_type {} is not supported by the numpy backend'.format(self.optimizer_type))
+        if not self.sparse_updates:
+            self.grads = {name: np.zeros_like(param) for name, param in self.params.items()}
+
+    def reg_loss(self):
+        return 0.0
+
+    def add_reg_gradient(self, name, param, grad):
+        pass
+
+    def apply_gradients(self, row_grads):
+        self.optimizer.step()
+        if self.sparse_updates:
+            for name, param in self.params.items():
+                rows, row_grad = row_grads[name]
+                self.add_reg_gradient(name, param[rows], row_grad)
+                self.optimizer.apply_rows(name, param, rows, row_grad)
+            return
+        for name, param in self.params.items():
+            grad = self.grads[name]
+            grad.fill(0.)
+            self.add_reg_gradient(name, param, grad)
+            rows, row_grad = row_grads[name]
+            grad[rows] += row_grad
+            self.optimizer.apply(name, param, grad)
+
+    def update(self, indices, values, weights=None):
+        losses, row_grads = self.batch_gradients(indices, values, weights=weights)
+        self.apply_gradients(row_grads)
+        return losses
+
+    def apply_batch(self, indices, values, weights=None):
+        '''
+        `weights` optionally weighs the loss of each entry (e.g. the importance weights of batch_store.TensorSampler).
+        '''
+        losses = self.update(indices, values, weights=weights)
+        self.global_step += 1
+        if self.write_loss:
+            print('{}\t{}'.format(self.global_step, '\t'.join(str(loss) for loss in losses)), file=self.loss_file)
+        if self.checkpoint_every is not None:
+            if self.global_step % self.checkpoint_every == 0:
+                t = time.time()
+                print('Saving checkpoint at step {}...'.format(self.global_step))
+                path = self.save_checkpoint()
+                print('Saved model checkpoint to {} (it took {} secs)'.format(path, time.time() - t))
+        return losses
+
+    def get_factors(self):
+        '''
+        The factor matrix (or list of them) the model predicts with.
+        '''
+        return np.maximum(self.U, 0.) if self.nonneg else self.U
+
+    def set_factors(self, factors):
+        self.params['U'][...] = factors
+
+    def validate(self, validation):
+        '''
+        Runs the cp_evaluation.ValidationMonitor `validation` check if one is due, decaying the learning rate
+            if it asks to. Returns True if training should stop.
+        '''
+        if validation is None or self.global_step % validation.evaluate_every != 0:
+            return False
+        action = validation.check(self.global_step, self.get_factors())
+        if action == 'decay' and getattr(self.optimizer, 'learning_rate', None) is not None:
+            self.optimizer.learning_rate *= validation.lr_decay
+            print('Decayed the learning rate to {:.2E}'.format(self.optimizer.learning_rate))
+        return action == 'stop'
+
+    def finish_validation(self, validation):
+        if validation is None:
+            return
+        if validation.best_factors is not None:
+            print('Restoring the factors from step {} (validation RMSE {:.4f})'.format(validation.best_step, validation.best_rmse))
+            self.set_factors(validation.best_factors)
+
+    def save_checkpoint(self):
+        path = '{}-{}.npz'.format(self.checkpoint_prefix, self.global_step)
+        np.savez(path, **self.params)
+        return path
+
+    def start_training(self, results_file, write_loss, checkpoint_every):
+        self.batch_num = 0
+        self.global_step = 0
+        self.results_file = results_file
+        self.init_optimizer()
+        self.write_loss = write_loss
+        self.checkpoint_every = checkpoint_every
+        out_dir = None
+        if self.write_loss or self.checkpoint_every is not None:
+            timestamp = str(datetime.datetime.now())
+            out_dir = os.path.abspath(os.path.join(os.path.curdir, 'np_logs', timestamp))
+            os.makedirs(out_dir)
+        if self.write_loss:
+            print('Writing losses to {}.'.format(out_dir))
+            self.loss_file = open(os.path.join(out_dir, 'losses.tsv'), 'w')
+        if self.checkpoint_every is not None:
+            checkpoint_dir = os.path.join(out_dir, 'checkpoints')
+            os.makedirs(checkpoint_dir)
+            self.checkpoint_prefix = os.path.join(checkpoint_dir, 'model')
+
+    def finish_training(self):
+        if self.checkpoint_every is not None:
+            path = self.save_checkpoint()
+            print('Saved FINAL model checkpoint to {}'.format(path))
+        if self.write_loss:
+            self.loss_file.close()
+
+
+class NumpySymmetricCPDecomp(NumpyDecomp):
+    def __init__(self, dim, rank, sess=None, ndims=3, optimizer_type='adam', reg_param=1e-10, nonneg=True, gpu=True, is_glove=False, mean_value=None, seed=None, sparse_updates=False):
+        '''
+        NumPy version of tensor_decomp.SymmetricCPDecomp, with the same constructor and `train` contract.
+        `sess` and `gpu` are only there for compatibility and get ignored.
+        `sparse_updates` turns on lazy, per-row optimizer updates (see NumpyDecomp).
+
+        `self.U` is a plain (dim, rank) float32 array (before the relu, if `nonneg`).
+        '''
+        self.rank = rank
+        self.optimizer_type = optimizer_type
+        self.shape = [dim] * ndims
+        self.ndims = ndims
+        self.sess = sess
+        self.nonneg = nonneg
+        self.reg_param = reg_param
+        self.gpu = gpu
+        self.mean_value = mean_value
+        self.is_glove = is_glove
+        self.random_state = np.random.RandomState(seed)
+        self.sparse_updates = sparse_updates
+
+        if self.mean_value is None:
+            mu = 10.0
+        else:
+            mu = self.mean_value
+        mean = ((1. / self.rank) * mu) ** (1/self.ndims)
+        self.params = {'U': self.random_state.normal(mean, mean / 5, size=(dim, self.rank)).astype(np.float32)}
+        if self.is_glove:
+            self.params['b1s'] = self.random_state.uniform(-1.0, 1.0, size=dim).astype(np.float32)
+            self.params['b2s'] = self.random_state.uniform(-1.0, 1.0, size=dim).astype(np.float32)
+
+    def gather(self, indices):
+        vects = self.U[indices]
+        if self.nonneg:
+            np.maximum(vects, 0., out=vects)
+        return vects
+
+    def factor_gradients(self, indices, values, weight=1.0, weights=None):
+        '''
+        Returns (loss, rows, row_grads, coefs) for one sparse tensor, with the gradients scaled by `weight`
+            and each entry's error weighed by `weights`.
+        '''
+        indices = np.asarray(indices, dtype=np.intp).reshape(len(values), -1)
+        values = np.asarray(values, dtype=np.float32)
+        offsets = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float32)
+        if self.is_glove:
+            offsets = self.params['b1s'][indices[:, 0]] + self.params['b2s'][indices[:, 1]]
+            glove_weights = np.minimum(1., (np.exp(values) / 100.) ** 0.75)  # values[i] is log(X_ij)
+            weights = glove_weights if weights is None else weights * glove_weights
+        loss, entry_grads, coefs = sparse_cp_loss(self.gather(indices), values, weights=weights, offsets=offsets)
+        if weight != 1.0:
+            entry_grads *= weight
+            coefs *= weight
+        rows, row_grads = segment_sum(indices.ravel(), entry_grads.reshape(-1, self.rank))
+        return loss, rows, row_grads, (indices, coefs)
+
+    def mask_nonneg(self, rows, row_grads):
+        if self.nonneg:
+            row_grads *= (self.U[rows] > 0.)
+        return rows, row_grads
+
+    def batch_gradients(self, indices, values, weights=None):
+        loss, rows, row_grads, (indices, coefs) = self.factor_gradients(indices, values, weights=weights)
+        grads = {'U': self.mask_nonneg(rows, row_grads)}
+        if self.is_glove:
+            grads['b1s'] = segment_sum(indices[:, 0], coefs)
+            grads['b2s'] = segment_sum(indices[:, 1], coefs)
+        return [loss], grads
+
+    def reg_loss(self):
+        if self.reg_param <= 0.0:
+            return 0.0
+        if self.nonneg:
+            return float(self.reg_param * np.maximum(self.U, 0.).sum())
+        return float(.25 * self.reg_param * np.square(self.U).sum())  # .5 * reg_param * l2_loss(U)
+
+    def add_reg_gradient(self, name, param, grad):
+        if name != 'U' or self.reg_param <= 0.0:
+            return
+        if self.nonneg:
+            grad += self.reg_param * (param > 0.)
+        else:
+            grad += (.5 * self.reg_param) * param
+
+    def train_step(self, approx_tensor, print_every=10, validate_indices=False):
+        '''
+        `approx_tensor` is an (indices, values) pair, or an (indices, values, weights) triple.
+        '''
+        approx_indices, approx_values = approx_tensor[:2]
+        approx_weights = approx_tensor[2] if len(approx_tensor) > 2 else None
+        if not hasattr(self, 'prev_time'):
+            self.prev_time = time.time()
+            self.avg_time = 0.0
+        if validate_indices:
+            for ix in approx_indices:
+                assert ((sorted(ix) - ix) == 0).all(), 'Indices must be fed in only in sorted order. offending ix: {}'.format(ix)
+        err, = self.apply_batch(approx_indices, approx_values, weights=approx_weights)
+        step = self.global_step
+
+        if step % print_every == 0:
+            reg = self.reg_loss()
+            batch_time = (time.time() - self.prev_time) / print_every
+            print("Err at step {}: {:.3f}; Reg loss: {:.3f} (lambda = {:.1E}) (Avg batch time: {:.3f})".format(int(step), err, reg, self.reg_param, batch_time))
+            self.prev_time = time.time()
+
+    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None, validation=None):
+        '''
+        Assumes `expected_tensors` is a generator of sparse tensor values.
+        `validation` is an optional cp_evaluation.ValidationMonitor, for early stopping and learning rate decay.
+        '''
+        self.start_training(results_file, write_loss, checkpoint_every)
+        print('looping through batches...')
+        for expected_tensor in expected_tensors:
+            self.train_step(expected_tensor)
+            self.batch_num += 1
+            if self.validate(validation):
+                print('Stopping early at step {}'.format(self.global_step))
+                break
+        self.finish_validation(validation)
+        self.finish_training()
+
+
+class NumpyJointSymmetricCPDecomp(NumpySymmetricCPDecomp):
+    def __init__(self, size, rank, sess=None, dimlist=[2,3], dimweights=[1., 1.], reg_param=1e-10, nonneg=True, gpu=True, seed=None, sparse_updates=False):
+        '''
+        NumPy version of tensor_decomp.JointSymmetricCPDecomp, with the same constructor and `train` contract.
+        '''
+        self.dimlist = dimlist
+        self.dimweights = dimweights
+        assert len(dimlist) == len(dimweights)
+        self.rank = rank
+        self.optimizer_type = 'adam'
+        self.sess = sess
+        self.nonneg = nonneg
+        self.reg_param = reg_param
+        self.gpu = gpu
+        self.is_glove = False
+        self.random_state = np.random.RandomState(seed)
+        self.sparse_updates = sparse_updates
+
+        mu = 15.0
+        mean = ((1. / self.rank) * mu) ** (1/2)
+        self.params = {'U': self.random_state.normal(mean, mean / 5, size=(size, self.rank)).astype(np.float32)}
+        print('nonneg: {}'.format(self.nonneg))
+
+    def batch_gradients(self, indices, values, weights=None):
+        '''
+        `indices`, `values` (and `weights`) are either one part per order in `self.dimlist`, or a single packed batch
+            (see ngram_counts.pack_joint_batch), which gets all orders' losses out of one gather.
+        '''
+        if not isinstance(indices, (list, tuple)):
+            return self.packed_batch_gradients(indices, values, weights=weights)
+        if weights is None:
+            weights = [None] * len(self.dimlist)
+        losses = []
+        all_rows = []
+        all_row_grads = []
+        for ixes, vals, entry_weights, weight in zip(indices, values, weights, self.dimweights):
+            loss, rows, row_grads, _ = self.factor_gradients(ixes, vals, weight=weight, weights=entry_weights)
+            losses.append(weight * loss)
+            all_rows.append(rows)
+            all_row_grads.append(row_grads)
+        rows, row_grads = segment_sum(np.concatenate(all_rows), np.concatenate(all_row_grads))
+        return losses, {'U': self.mask_nonneg(rows, row_grads)}
+
+    def packed_batch_gradients(self, indices, values, weights=None):
+        '''
+        Same losses and gradients as `batch_gradients` on the unpacked parts: the padding slots get a factor row of
+            all ones, and weighting each entry by dimweight * N / N_order turns the overall mean into the per-order means.
+        '''
+        values = np.asarray(values, dtype=np.float32).ravel()
+        indices = np.asarray(indices, dtype=np.intp).reshape(len(values), -1)
+        slots = joint_order_slots(indices, self.dimlist)
+        order_sizes = np.bincount(slots, minlength=len(self.dimlist))
+        entry_weights = (np.asarray(self.dimweights, dtype=np.float32) * len(values) / np.maximum(order_sizes, 1))[slots]
+        if weights is not None:
+            entry_weights *= np.asarray(weights, dtype=np.float32)
+        padding = indices < 0
+        vects = self.gather(np.where(padding, 0, indices))
+        vects[padding] = 1.
+        _, entry_grads, coefs = sparse_cp_loss(vects, values, weights=entry_weights)
+        errors = coefs * (len(values) / 2.) / np.maximum(entry_weights, 1e-30)
+        if weights is not None:  # the reported losses are weighed like the unpacked ones
+            errors *= np.sqrt(np.asarray(weights, dtype=np.float32))
+        order_losses = np.bincount(slots, weights=errors ** 2, minlength=len(self.dimlist)) / np.maximum(order_sizes, 1)
+        losses = [float(weight * loss) for weight, loss in zip(self.dimweights, order_losses)]
+        rows, row_grads = segment_sum(indices[~padding], entry_grads[~padding])
+        return losses, {'U': self.mask_nonneg(rows, row_grads)}
+
+    def train_step(self, approx_tensor, print_every=10):
+        approx_indices, approx_values = approx_tensor[:2]
+        approx_weights = approx_tensor[2] if len(approx_tensor) > 2 else None
+        if not hasattr(self, 'prev_time'):
+            self.prev_time = time.time()
+            self.avg_time = 0.0
+            self.total_recordings = 0
+        errs = self.apply_batch(approx_indices, approx_values, weights=approx_weights)
+        step = self.global_step
+
+        if step % print_every == 0:
+            reg = self.reg_loss()
+            batch_time = (time.time() - self.prev_time) / print_every
+            # string formatting to print the errors for each dimension
+            errstring = '; '.join(['{}d: {:.2f}'.format(dim, err) for dim, err in zip(self.dimlist, errs)])
+            print("{}: Errs: {}; Reg loss: {:.2f} (lambda={:.1E}) (Avg time: {:.2f})".format(int(step), errstring, reg, self.reg_param, batch_time))
+            self.prev_time = time.time()
+            self.total_recordings += 1
+
+
+class NumpyCPDecomp(NumpyDecomp):
+    def __init__(self, shape, rank, sess=None, ndims=3, optimizer_type='adam', reg_param=1e-10, is_glove=False, nonneg=False, seed=None, sparse_updates=False):
+        '''
+        NumPy version of tensor_decomp.CPDecomp, with the same constructor and `train` contract.
+            Unlike the TF version, the loss works for any `ndims`.
+
+        The factors are plain float32 arrays: `self.U`, `self.V` and (if ndims > 2) `self.W`, then `self.factors[3:]`.
+        '''
+        self.rank = rank
+        self.optimizer_type = optimizer_type
+        self.shape = shape
+        self.ndims = ndims
+        self.sess = sess
+        self.is_glove = is_glove
+        self.nonneg = nonneg
+        self.reg_param = reg_param
+        self.random_state = np.random.RandomState(seed)
+        self.sparse_updates = sparse_updates
+
+        # Goal: X_ijk == sum_{r=1}^{R} U_{ir} V_{jr} W_{kr}
+        self.factor_names = ['U', 'V', 'W'] + ['F{}'.format(i) for i in range(3, self.ndims)]
+        self.factor_names = self.factor_names[:self.ndims]
+        self.params = {
+            name: self.random_state.uniform(-1.0, 1.0, size=(self.shape[i], self.rank)).astype(np.float32)
+            for i, name in enumerate(self.factor_names)
+        }
+        if self.is_glove:
+            self.params['b1s'] = self.random_state.uniform(-1.0, 1.0, size=self.shape[0]).astype(np.float32)
+            self.params['b2s'] = self.random_state.uniform(-1.0, 1.0, size=self.shape[0]).astype(np.float32)
+
+    @property
+    def V(self):
+        return self.params['V']
+
+    @property
+    def W(self):
+        return self.params['W']
+
+    @property
+    def factors(self):
+        return [self.params[name] for name in self.factor_names]
+
+    def init_optimizer(self):
+        if self.optimizer_type in ('sals', '2sgd'):
+            self.optimizer = None
+        else:
+            super(NumpyCPDecomp, self).init_optimizer()
+
+    def update(self, indices, values, weights=None):
+        if self.optimizer_type in ('sals', '2sgd'):
+            return self.expected_tensor_update(indices, values, sequential=(self.optimizer_type == 'sals'))
+        return super(NumpyCPDecomp, self).update(indices, values, weights=weights)
+
+    def expected_tensor_update(self, indices, values, rho=1e-3, sequential=False):
+        '''
+        See 2SGD/SALS algorithms in Expected Tensor Decomp paper, and CPDecomp.get_update_UVW_ops_for_2sgd_sals.
+        Every factor moves towards mttkrp * inv(gamma + rho*I), where the sparse MTTKRP is a segment sum of Hadamard
+            products of the gathered rows of the other factors, and the RxR system gets a Cholesky solve.
+        If `sequential` (SALS), each factor's update sees the factors updated before it.
+        '''
+        values = np.asarray(values, dtype=np.float32)
+        indices = np.asarray(indices, dtype=np.intp).reshape(len(values), self.ndims)
+        loss, _, _ = sparse_cp_loss(np.stack([factor[indices[:, i]] for i, factor in enumerate(self.factors)], axis=1), values)
+        t = self.global_step + 1
+        alpha = .25  # smaller => decays slower (more quickly get updates from the gradients)
+        eta_t = 1. / (1. + t**alpha)
+
+        factors = self.factors
+        grad_values = []
+        for mode in range(self.ndims):
+            others = [d for d in range(self.ndims) if d != mode]
+            prods = values[:, None] * factors[others[0]][indices[:, others[0]]]
+            gamma = np.dot(factors[others[0]].T, factors[others[0]])
+            for d in others[1:]:
+                prods *= factors[d][indices[:, d]]
+                gamma *= np.dot(factors[d].T, factors[d])
+            rows, sums = segment_sum(indices[:, mode], prods)
+            mttkrp = np.zeros_like(factors[mode])
+            mttkrp[rows] = sums
+            gamma[np.diag_indices(self.rank)] += rho
+            # gamma is symmetric, so mttkrp * inv(gamma) == (inv(gamma) * mttkrp^T)^T
+            grad_value = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gamma), mttkrp.T).T
+            if sequential:
+                factors[mode] *= (1 - eta_t)
+                factors[mode] += eta_t * grad_value
+            else:
+                grad_values.append(grad_value)
+        for factor, grad_value in zip(factors, grad_values):
+            factor *= (1 - eta_t)
+            factor += eta_t * grad_value
+        return [loss]
+
+    def batch_gradients(self, indices, values, weights=None):
+        values = np.asarray(values, dtype=np.float32)
+        indices = np.asarray(indices, dtype=np.intp).reshape(len(values), self.ndims)
+        vects = np.stack([factor[indices[:, i]] for i, factor in enumerate(self.factors)], axis=1)
+        if self.nonneg:
+            np.maximum(vects[:, 0], 0., out=vects[:, 0])
+        offsets = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float32)
+        if self.is_glove:
+            offsets = self.params['b1s'][indices[:, 0]] + self.params['b2s'][indices[:, 1]]
+            glove_weights = np.minimum(1., (np.exp(values) / 100.) ** 0.75)  # values[i] is log(X_ij)
+            weights = glove_weights if weights is None else weights * glove_weights
+        loss, entry_grads, coefs = sparse_cp_loss(vects, values, weights=weights, offsets=offsets)
+        grads = {}
+        for i, name in enumerate(self.factor_names):
+            grads[name] = segment_sum(indices[:, i], entry_grads[:, i])
+        if self.nonneg:
+            rows, row_grads = grads['U']
+            row_grads *= (self.U[rows] > 0.)
+        if self.is_glove:
+            grads['b1s'] = segment_sum(indices[:, 0], coefs)
+            grads['b2s'] = segment_sum(indices[:, 1], coefs)
+        return [loss], grads
+
+    def reg_loss(self):
+        if self.reg_param > 0.0 and self.ndims > 2:
+            return float(.25 * self.reg_param * sum(np.square(factor).sum() for factor in self.factors))
+        if not self.is_glove:
+            U = np.maximum(self.U, 0.) if self.nonneg else self.U
+            return float(self.reg_param * np.abs(U).sum())
+        return 0.0
+
+    def add_reg_gradient(self, name, param, grad):
+        if self.reg_param <= 0.0 or name not in self.factor_names:
+            return
+        if self.ndims > 2:
+            grad += (.5 * self.reg_param) * param
+        elif name == 'U' and not self.is_glove:
+            grad += self.reg_param * (param > 0.) if self.nonneg else self.reg_param * np.sign(param)
+
+    def train_step(self, approx_indices, approx_values, print_every=1):
+        if not hasattr(self, 'prev_time'):
+            self.prev_time = time.time()
+            self.avg_time = 0.0
+            self.total_recordings = 0
+        t = time.time()
+        err, = self.apply_batch(approx_indices, approx_values)
+        step = self.global_step
+        if step % print_every == 0:
+            print('step {} took {} secs'.format(step, time.time() - t))
+            batch_time = (time.time() - self.prev_time) / print_every
+            print("Err at step {}: {}; (avg batch time: {})".format(step, err, batch_time))
+            self.prev_time = time.time()
+            self.avg_time = (batch_time + self.total_recordings * self.avg_time) / (self.total_recordings + 1.0)
+            self.total_recordings += 1
+
+    def get_factors(self):
+        factors = self.factors
+        if self.nonneg:
+            factors[0] = np.maximum(factors[0], 0.)
+        return factors
+
+    def set_factors(self, factors):
+        for name, factor in zip(self.factor_names, factors):
+            self.params[name][...] = factor
+
+    def train(self, expected_tensors, true_X=None, evaluate_every=100, results_file=None, write_loss=True, checkpoint_every=None, validation=None):
+        '''
+        Assumes `expected_tensors` is a generator of sparse tensor values.
+        `validation` is an optional cp_evaluation.ValidationMonitor, for early stopping and learning rate decay.
+        '''
+        self.start_training(results_file, write_loss, checkpoint_every)
+        print("Starting ASYMMETRIC CP Decomp training")
+        print('looping through batches...')
+        for expected_indices, expected_values in expected_tensors:
+            self.train_step(expected_indices, expected_values, print_every=100)
+            self.batch_num += 1
+            if self.validate(validation):
+                print('Stopping early at step {}'.format(self.global_step))
+                break
+        self.finish_validation(validation)
+        if hasattr(self, 'avg_time') and results_file is not None:
+            print('avg batch time: {}'.format(self.avg_time), file=results_file)
+        self.finish_training()
+
+
+
+def permutation_counts(indices):
+    '''
+    Number of distinct permutations of every row of `indices` (n! / the factorials of the multiplicities),
+        i.e. how many entries of the full symmetric tensor each stored entry stands for.
+    '''
+    n = indices.shape[1]
+    counts = np.full(len(indices), float(math.factorial(n)))
+    for d in range(1, n):
+        # a run of m equal values divides by 1 * 2 * ... * m = m!
+        counts /= (indices[:, :d+1] == indices[:, d:d+1]).sum(axis=1)
+    return counts
+
+
+class SymmetricCPALS(object):
+    def __init__(self, dim, rank, dimlist=[3], dimweights=[1.], reg_param=1e-3, damping=0.5, nonneg=False, mean_value=None,
+                 num_threads=None, block_size=2**16, seed=None):
+        '''
+        Full-batch ALS for symmetric (or joint symmetric, with several orders in `dimlist`) CP decomposition
+            of sparse tensors given by their sorted entries, e.g. the full PMI tensor from PMIGatherer.create_pmi_tensor.
+            Unlike the online decompositions, entries that aren't stored count as zeros of the full symmetric tensor.
+
+        Every sweep solves U <- M * inv(G + reg_param*I), with
+            M = sum_n w_n * n * MTTKRP(X_n, U, ..., U)  (each stored entry weighed by its number of permutations)
+            G = sum_n w_n * n * (U^T U)^{n-1}           (Hadamard powers)
+            and moves U `damping` of the way back to where it was (the factors are tied, so undamped updates oscillate).
+        The MTTKRPs run over blocks of `block_size` entries on `num_threads` threads.
+        '''
+        assert len(dimlist) == len(dimweights)
+        self.rank = rank
+        self.dimlist = dimlist
+        self.dimweights = dimweights
+        self.reg_param = reg_param
+        self.damping = damping
+        self.nonneg = nonneg
+        self.num_threads = num_threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.random_state = np.random.RandomState(seed)
+
+        mu = 10.0 if mean_value is None else mean_value
+        mean = ((1. / self.rank) * mu) ** (1/max(dimlist))
+        self.U = self.random_state.normal(mean, mean / 5, size=(dim, self.rank))
+        self.fits = []
+
+    def block_mttkrp(self, indices, coefs, values):
+        '''
+        Returns (rows, sums, inner) for one block of entries:
+            the segment-summed MTTKRP contributions weighed by `coefs`, and sum(coefs * values * predictions).
+        '''
+        vects = self.U[indices]
+        prods = leave_one_out_products(vects)
+        predicted = np.einsum('nr,nr->n', prods[:, 0], vects[:, 0])
+        prods *= (coefs * values)[:, None, None]
+        rows, sums = segment_sum(indices.ravel(), prods.reshape(-1, self.rank))
+        return rows, sums, float(np.dot(coefs * values, predicted))
+
+    def mttkrp(self, pool, blocks):
+        M = np.zeros_like(self.U)
+        inner = 0.0
+        for rows, sums, block_inner in pool.imap_unordered(lambda block: self.block_mttkrp(*block), blocks):
+            M[rows] += sums
+            inner += block_inner
+        return M, inner
+
+    def fit(self, tensors, max_sweeps=50, tol=1e-4, print_every=1):
+        '''
+        `tensors` has one (indices, values) pair per order in `self.dimlist`.
+        Stops once the relative fit 1 - ||X - X_hat|| / ||X|| changes by less than `tol`. Returns the final fit.
+        '''
+        blocks = []
+        norms = []
+        for (indices, values), dim in zip(tensors, self.dimlist):
+            indices = np.asarray(indices, dtype=np.intp).reshape(len(values), dim)
+            values = np.asarray(values, dtype=np.float64)
+            perms = permutation_counts(indices)
+            norms.append(float(np.dot(perms, values ** 2)))  # ||X_n||^2 over the full symmetric tensor
+            blocks.append([
+                (indices[start:start+self.block_size], perms[start:start+self.block_size], values[start:start+self.block_size])
+                for start in range(0, len(values), self.block_size)
+            ])
+        total_norm = np.sqrt(sum(w * norm for w, norm in zip(self.dimweights, norms)))
+
+        fit = None
+        pool = multiprocessing.pool.ThreadPool(self.num_threads)
+        try:
+            for sweep in range(max_sweeps):
+                t = time.time()
+                gram = np.dot(self.U.T, self.U)
+                lhs = self.reg_param * np.eye(self.rank)
+                rhs = np.zeros_like(self.U)
+                residual = 0.0
+                errs = []
+                for dim, weight, norm, dim_blocks in zip(self.dimlist, self.dimweights, norms, blocks):
+                    # perms * x * prod(U_j) summed over the stored entries == <X, X_hat>, and M picks up perms/dim per position
+                    M, inner = self.mttkrp(pool, [(ix, perms / dim, vals) for ix, perms, vals in dim_blocks])
+                    inner *= dim
+                    model_norm = float((gram ** dim).sum())  # ||X_hat||^2
+                    err = max(norm - 2 * inner + model_norm, 0.0)
+                    errs.append(np.sqrt(err / norm) if norm > 0 else 0.0)
+                    residual += weight * err
+                    rhs += (weight * dim) * M
+                    lhs += (weight * dim) * gram ** (dim - 1)
+                prev_fit, fit = fit, 1. - np.sqrt(residual) / total_norm
+                self.fits.append(fit)
+                new_U = scipy.linalg.cho_solve(scipy.linalg.cho_factor(lhs), rhs.T).T
+                if self.nonneg:
+                    np.maximum(new_U, 0., out=new_U)
+                self.U *= self.damping
+                self.U += (1. - self.damping) * new_U
+                if sweep % print_every == 0:
+                    errstring = '; '.join(['{}d: {:.4f}'.format(dim, err) for dim, err in zip(self.dimlist, errs)])
+                    print('ALS sweep {}: fit {:.5f} (relative errs: {}) ({:.2f} secs)'.format(sweep, fit, errstring, time.time() - t))
+                if prev_fit is not None and abs(fit - prev_fit) < tol:
+                    print('Converged after {} sweeps (fit {:.5f})'.format(sweep + 1, fit))
+                    break
+        finally:
+            pool.close()
+        return fit
@@ -0,0 +1,271 @@
+import multiprocessing
+import numpy as np
+import queue
+import threading
+import time
+import traceback
+
+
+_STOP = '__pipeline_stop__'
+
+
+class StageStats(object):
+    def __init__(self, stage_name, worker_id):
+        self.stage_name = stage_name
+        self.worker_id = worker_id
+        self.items_in = 0
+        self.items_out = 0
+        self.total_time = 0.0
+        self.wait_in = 0.0   # starved: waiting for the previous stage
+        self.wait_out = 0.0  # blocked: waiting for room in the next stage's queue
+
+    @property
+    def busy_time(self):
+        return max(self.total_time - self.wait_in - self.wait_out, 0.0)
+
+    def add(self, other):
+        self.items_in += other.items_in
+        self.items_out += other.items_out
+        self.total_time += other.total_time
+        self.wait_in += other.wait_in
+        self.wait_out += other.wait_out
+
+
+class Stage(object):
+    def __init__(self, name, transform, num_workers=1, queue_depth=None, use_processes=False):
+        '''
+        One stage of a Pipeline. Each of its `num_workers` workers runs `transform(items)`, where `items` iterates over
+            the share of the previous stage's outputs that worker pulls off the input queue, and puts whatever
+            `transform` yields on the queue of the next stage. So a stage can be stateful (e.g. regroup its inputs
+            into batches, like gensim_utils.batch_generator2) as long as any worker's share will do.
+        `queue_depth` bounds the stage's input queue (2 * num_workers, by default).
+        With `use_processes`, the workers are forked processes, and every item crossing in or out of the stage gets pickled.
+        '''
+        self.name = name
+        self.transform = transform
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth or 2 * num_workers
+        self.use_processes = use_processes
+
+    @classmethod
+    def map(cls, name, fn, **kwargs):
+        '''
+        A stateless stage putting `fn(item)` on the next queue for every item.
+        '''
+        def transform(items):
+            for item in items:
+                yield fn(item)
+        return cls(name, transform, **kwargs)
+
+
+def _get(tasks, stopped):
+    while not stopped.is_set():
+        try:
+            return tasks.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _STOP
+
+
+def _put(outputs, item, stopped):
+    while not stopped.is_set():
+        try:
+            outputs.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _timed_items(tasks, stats, stopped):
+    while True:
+        t = time.time()
+        item = _get(tasks, stopped)
+        stats.wait_in += time.time() - t
+        if isinstance(item, str) and item == _STOP:
+            return
+        stats.items_in += 1
+        yield item
+
+
+def _stage_worker(stage, stage_ix, worker_id, tasks, outputs, control, stopped):
+    '''
+    Runs one worker of `stage` until its input runs dry (or the pipeline gets `stopped`), then reports its stats
+        (or exception) on `control`.
+    '''
+    if stage.use_processes:
+        np.random.seed()  # forked workers would otherwise all draw the same negative samples
+    stats = StageStats(stage.name, worker_id)
+    start = time.time()
+    try:
+        for output in stage.transform(_timed_items(tasks, stats, stopped)):
+            t = time.time()
+            delivered = _put(outputs, output, stopped)
+            stats.wait_out += time.time() - t
+            if not delivered:
+                break
+            stats.items_out += 1
+        stats.total_time = time.time() - start
+        control.put((stage_ix, stats, None))
+    except Exception:
+        stats.total_time = time.time() - start
+        control.put((stage_ix, stats, traceback.format_exc()))
+
+
+class Pipeline(object):
+    def __init__(self, source, stages, name='source', output_queue_depth=4):
+        '''
+        A bounded producer/consumer pipeline: a thread feeds every item of the `source` iterable to the first of
+            `stages`, each stage feeds the next through its own bounded queue, and iterating over the Pipeline yields
+            the last stage's outputs from a queue of depth `output_queue_depth`. The consumer (e.g. the decomposition's
+            `train`) is the final stage, so the optimizer only waits for batches when the stages in front of it can't
+            keep up, and the bounded queues keep any stage from running too far ahead.
+        Outputs come out in whatever order the workers finish them.
+
+        Every worker times how long it's busy, starved (waiting for input) and blocked (waiting for room downstream);
+            `report` prints the per-stage totals, and the stage with the most busy time per worker is the bottleneck.
+        '''
+        self.source = source
+        self.stages = stages
+        self.name = name
+        self.output_queue_depth = output_queue_depth
+        self.stats = {}
+        self.started = None  # (queues, control, stopped, processes, threads) between `start` and `__iter__`
+
+    def feed(self, tasks, control, stopped):
+        stats = StageStats(self.name, 0)
+        start = time.time()
+        try:
+            it = iter(self.source)
+            while True:
+                t = time.time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                stats.wait_in += time.time() - t
+                t = time.time()
+                delivered = _put(tasks, item, stopped)
+                stats.wait_out += time.time() - t
+                if not delivered:
+                    break
+                stats.items_out += 1
+            stats.total_time = time.time() - start
+            control.put((-1, stats, None))
+        except Exception:
+            stats.total_time = time.time() - start
+            control.put((-1, stats, traceback.format_exc()))
+
+    def start(self):
+        '''
+        Sets up the queues and forks the process workers, if it hasn't happened yet. `__iter__` does this by itself,
+            but forking from a process with live threads (or a TF session) can deadlock the children on locks those
+            threads held, so callers can call `start` early on, before any of those exist. Returns self.
+        Process workers are always started before any thread of the pipeline itself.
+        '''
+        if self.started is not None:
+            return self
+        uses_processes = [stage.use_processes for stage in self.stages]
+        context = multiprocessing.get_context('fork') if any(uses_processes) else None
+
+        def make_queue(maxsize, shared):
+            # hand-offs between threads of this process don't need to be pickled
+            return context.Queue(maxsize) if shared else queue.Queue(maxsize)
+
+        stopped = context.Event() if context else threading.Event()
+        control = make_queue(0, context is not None)
+        # queues[i] feeds stages[i] (from the feeder thread, or stages[i-1]); the last one feeds the consumer
+        writer_is_process = [False] + uses_processes
+        reader_is_process = uses_processes + [False]
+        depths = [stage.queue_depth for stage in self.stages] + [self.output_queue_depth]
+        queues = [make_queue(depth, writes or reads) for depth, writes, reads in zip(depths, writer_is_process, reader_is_process)]
+
+        processes, threads = [], []
+        for stage_ix, stage in enumerate(self.stages):
+            for worker_id in range(stage.num_workers):
+                args = (stage, stage_ix, worker_id, queues[stage_ix], queues[stage_ix + 1], control, stopped)
+                if stage.use_processes:
+                    worker = context.Process(target=_stage_worker, args=args)
+                    processes.append(worker)
+                else:
+                    worker = threading.Thread(target=_stage_worker, args=args)
+                    threads.append(worker)
+                worker.daemon = True
+        for worker in processes:
+            worker.start()
+        self.started = (queues, control, stopped, processes, threads)
+        return self
+
+    def __iter__(self):
+        self.start()
+        queues, control, stopped, processes, threads = self.started
+        self.started = None  # a Pipeline runs once per start
+        feeder = threading.Thread(target=self.feed, args=(queues[0], control, stopped))
+        feeder.daemon = True
+        supervisor_errors = []
+        supervisor = threading.Thread(target=self.supervise, args=(control, queues, stopped, supervisor_errors))
+        supervisor.daemon = True
+
+        for worker in threads:
+            worker.start()
+        feeder.start()
+        supervisor.start()
+
+        consumer_stats = StageStats('consumer', 0)
+        self.stats = {}
+        start = time.time()
+        outputs = queues[-1]
+        try:
+            while True:
+                t = time.time()
+                item = outputs.get()
+                consumer_stats.wait_in += time.time() - t
+                if isinstance(item, str) and item == _STOP:
+                    break
+                consumer_stats.items_in += 1
+                yield item
+        finally:
+            # the consumer may stop early (e.g. on a validation early stop): unblock everything upstream
+            if supervisor.is_alive():
+                stopped.set()
+        consumer_stats.total_time = time.time() - start
+        supervisor.join()
+        for worker in processes + threads:
+            worker.join()
+        self.stats['consumer'] = consumer_stats
+        if supervisor_errors:
+            raise RuntimeError('pipeline worker failed:\n{}'.format(supervisor_errors[0]))
+        self.report()
+
+    def supervise(self, control, queues, stopped, errors):
+        '''
+        Collects the workers' stats as they finish. Once every worker of a stage is done, tells each worker of the
+            next stage (or the consumer) to stop.
+        On a worker failure, the consumer is stopped straight away.
+        '''
+        num_workers = [1] + [stage.num_workers for stage in self.stages]  # the feeder counts as stage -1
+        num_done = [0] * len(num_workers)
+        while sum(num_done) < sum(num_workers):
+            stage_ix, stats, error = control.get()
+            name = self.name if stage_ix < 0 else self.stages[stage_ix].name
+            self.stats.setdefault(name, StageStats(name, None)).add(stats)
+            num_done[stage_ix + 1] += 1
+            if error is not None and not stopped.is_set():
+                errors.append('{} worker {}: {}'.format(name, stats.worker_id, error))
+                stopped.set()
+                queues[-1].put(_STOP)
+            elif num_done[stage_ix + 1] == num_workers[stage_ix + 1] and not stopped.is_set():
+                next_workers = self.stages[stage_ix + 1].num_workers if stage_ix + 1 < len(self.stages) else 1
+                for _ in range(next_workers):
+                    queues[stage_ix + 1].put(_STOP)
+
+    def report(self):
+        rows = [(self.name, 1)] + [(stage.name, stage.num_workers) for stage in self.stages] + [('consumer', 1)]
+        bottleneck = max(rows, key=lambda row: self.stats[row[0]].busy_time / row[1])[0]
+        print('Pipeline timings (secs summed over workers):')
+        for name, num_workers in rows:
+            stats = self.stats[name]
+            print('  {:<12} x{:<3} {:>8} in {:>8} out   busy {:8.1f}   starved {:8.1f}   blocked {:8.1f}{}'.format(
+                name, num_workers, stats.items_in, stats.items_out, stats.busy_time, stats.wait_in, stats.wait_out,
+                '   <- bottleneck' if name == bottleneck else '',
+            ))
@@ -4,6 +4,8 @@ import os
 import tensorflow as tf
 import time
 
+from ngram_counts import joint_order_slots, pack_joint_batch
+
 class CPDecomp(object):
     def __init__(self, shape, rank, sess, ndims=3, optimizer_type='adam', reg_param=1e-10, is_glove=False, nonneg=False):
         '''
@@ -58,10 +60,11 @@ class CPDecomp(object):
             self.values: approx_values,
         }
         t = time.time()
-        _, step, *debug_tensies = self.sess.run(
+        _, step, err = self.sess.run(
             [
                 self.train_ops, # might need multiple train ops to be executed sequentially (see the case of sals)
                 self.global_step,
+                self.L,  # fetched along with the train ops, so reporting doesn't take a second pass
             ],
             feed_dict=feed_dict,
         )
@@ -75,15 +78,6 @@ class CPDecomp(object):
                 print('Saved model checkpoint to {} (it took {} secs)'.format(path, time.time() - t))
 
         if step % print_every == 0:
-            t = time.time()
-            err = self.sess.run(
-                [
-                    self.L,
-                ],
-                feed_dict=feed_dict,
-            )
-            #print('getting loss took {} secs'.format(time.time() - t))
-
             batch_time = (time.time() - self.prev_time) / print_every
             print("Err at step {}: {}; (avg batch time: {})".format(step, err, batch_time))
             self.prev_time = time.time()
@@ -100,8 +94,9 @@ class CPDecomp(object):
             X is a sparse tensor. U,V,W are dense. 
             """
             if self.ndims > 2:
-                raise NotImplementedError  # TODO: re-fix if need higher dims
-                predict_val_fn = lambda x: tf.reduce_sum(tf.gather(self.U, x[0]) * tf.gather(self.V, x[1]) * tf.gather(self.W, x[2]))
+                indices = tf.unstack(X.indices, num=self.ndims, axis=1)
+                prods = tf.gather(self.U, indices[0]) * tf.gather(self.V, indices[1]) * tf.gather(self.W, indices[2])
+                errs = tf.squared_difference(tf.reduce_sum(prods, axis=1), X.values)
             else:
                 if self.ndims == 2:
                     vects_1 = tf.nn.embedding_lookup(self.U, tf.gather(tf.transpose(X.indices), 0))
@@ -128,12 +123,12 @@ class CPDecomp(object):
                         errs = errs * tf.minimum(1., ((tf.exp(X.values)) / 100.) ** 0.75)  # X.values[i] is log(X_ij)
             return tf.reduce_mean(errs)
 
-        def reg():
+        def reg(U, V, W):
             # NOTE: l2_loss already squares the norms. So we don't need to square them.
             summed_norms = (
-                tf.nn.l2_loss(self.U, name="U_norm") +
-                tf.nn.l2_loss(self.V, name="V_norm") +
-                tf.nn.l2_loss(self.W, name="W_norm")
+                tf.nn.l2_loss(U, name="U_norm") +
+                tf.nn.l2_loss(V, name="V_norm") +
+                tf.nn.l2_loss(W, name="W_norm")
             )
             return (.5 * reg_param) * summed_norms
 
@@ -161,14 +156,21 @@ class CPDecomp(object):
         inc_t = tf.assign(self.global_step, self.global_step+1)
         return [*train_ops, inc_t]
 
-    def get_update_UVW_ops_for_2sgd_sals(self, rho):
+    def get_update_UVW_ops_for_2sgd_sals(self, rho, sequential=False):
         '''
         See 2SGD/SALS algorithms in Expected Tensor Decomp paper
+
+        Every factor update is a batched MTTKRP: gather the rows of the other factors for all nonzeros at once,
+            take their Hadamard products, and segment-sum them by index (so no per-nonzero loop),
+            followed by an RxR Cholesky solve against gamma + rho*I instead of inverting it.
+        If `sequential` (SALS), each factor's update sees the factors updated before it.
         '''
-        def gamma(A,B):
-            ATA = tf.matmul(A,A, transpose_a=True)  # A^T * A
-            BTB = tf.matmul(B,B, transpose_a=True)  # B^T * B
-            return tf.multiply(ATA, BTB)  # hadamard product of A^T*A and B^T*B
+        def gamma(*factors):
+            grams = [tf.matmul(A,A, transpose_a=True) for A in factors]  # A^T * A
+            prod = grams[0]
+            for gram in grams[1:]:
+                prod = tf.multiply(prod, gram)  # hadamard product of A^T*A and B^T*B
+            return prod
 
         X = self.X_t
         t = self.global_step + 1
@@ -177,82 +179,48 @@ class CPDecomp(object):
         batch_size = 1.
         eta_t = batch_size / (1. + t**alpha)
 
-        X_VW = tf.Variable(tf.constant(0.0, shape=[self.shape[0], self.rank]))
-        XU_W = tf.Variable(tf.constant(0.0, shape=[self.shape[1], self.rank]))
-        XUV_ = tf.Variable(tf.constant(0.0, shape=[self.shape[2], self.rank]))
-
-        def assign_zeroes():
-            a1 = tf.assign(X_VW, tf.constant(0.0, shape=[self.shape[0], self.rank]))
-            a2 = tf.assign(XU_W, tf.constant(0.0, shape=[self.shape[1], self.rank]))
-            a3 = tf.assign(XUV_, tf.constant(0.0, shape=[self.shape[2], self.rank]))
-            return tf.group(a1, a2, a3)
-
-        def body(ix, X_VW2,XU_W2,XUV_2,):
-            ijk = tf.gather(X.indices, ix)
-            val = tf.gather(X.values, ix)
-            Ui = tf.gather(self.U, ijk[0])  # R-dimensional
-            Vj = tf.gather(self.V, ijk[1])
-            Wk = tf.gather(self.W, ijk[2])
-
-            Xijk_Vj_Wk = val * tf.multiply(Vj, Wk) 
-            Xijk_Ui_Wk = val * tf.multiply(Ui, Wk) 
-            Xijk_Ui_Vj = val * tf.multiply(Ui, Vj) 
-
-            r1 = tf.scatter_add(X_VW, ijk[0], Xijk_Vj_Wk)  # add Xijk(Vj*Wk) to X_VW(i,:) (as vectors in \mathbb{R}^R)
-            r2 = tf.scatter_add(XU_W, ijk[1], Xijk_Ui_Wk)
-            r3 = tf.scatter_add(XUV_, ijk[2], Xijk_Ui_Vj)
-            new_ix = tf.add(ix, tf.constant(1))
-            return new_ix, r1, r2, r3
-
-        N = tf.shape(X.values)[0]
-        def cond(ix, *args):
-            ass = tf.cond(tf.equal(ix, tf.constant(0)), lambda: assign_zeroes(), lambda: tf.no_op())
-            with tf.control_dependencies([ass]):
-                return tf.less(ix, N)
-
-        printer = tf.Print(XUV_, [X_VW, XU_W, XUV_])
-        ix = tf.Variable(tf.constant(0, dtype=tf.int32))  # which index/value we're looking at
-        _, X_VW, XU_W, XUV_ = tf.while_loop(cond, body, [ix, X_VW, XU_W, XUV_])
-
-        U = self.U
-        V = self.V
-        W = self.W
-
-        self.D1 = X_VW
-        self.D2 = XU_W
-        self.D3 = XUV_
-
-        gamma_rho = gamma(V,W) + rho * tf.eye(self.rank)
-        self.gr1 = gamma_rho
-        inv_gamma_rho = tf.matrix_inverse(gamma_rho)
-        self.gr1inv = gamma_rho
-        self.grad_value_U = tf.matmul(X_VW, inv_gamma_rho)
-
-        gamma_rho = gamma(U,W) + rho * tf.eye(self.rank)
-        self.gr2 = gamma_rho
-        inv_gamma_rho = tf.matrix_inverse(gamma_rho)
-        self.grad_value_V = tf.matmul(XU_W, inv_gamma_rho)
-
-        gamma_rho = gamma(U,V) + rho * tf.eye(self.rank)
-        self.gr3 = gamma_rho
-        inv_gamma_rho = tf.matrix_inverse(gamma_rho)
-        self.grad_value_W = tf.matmul(XUV_, inv_gamma_rho)
-
-        update_U_op = tf.assign(U, (1-eta_t) * U + eta_t * self.grad_value_U)
-        update_V_op = tf.assign(V, (1-eta_t) * V + eta_t * self.grad_value_V)
-        update_W_op = tf.assign(W, (1-eta_t) * W + eta_t * self.grad_value_W)
-        return [update_U_op, update_V_op, update_W_op]
+        variables = [self.U, self.V, self.W][:self.ndims]
+        factors = list(variables)  # the values each update gets to see
+        indices = tf.unstack(X.indices, num=self.ndims, axis=1)
+        eye = tf.eye(self.rank)
+
+        def solve_mode(mode):
+            others = [d for d in range(self.ndims) if d != mode]
+            # MTTKRP: X_(mode) (khatri-rao product of the other factors), only over the nonzeros of X
+            prods = tf.expand_dims(X.values, 1)
+            for d in others:
+                prods = prods * tf.gather(factors[d], indices[d])
+            mttkrp = tf.unsorted_segment_sum(prods, indices[mode], num_segments=self.shape[mode])
+            gamma_rho = gamma(*[factors[d] for d in others]) + rho * eye
+            chol = tf.cholesky(gamma_rho)
+            # gamma_rho is symmetric, so mttkrp * inv(gamma_rho) == (inv(gamma_rho) * mttkrp^T)^T
+            return mttkrp, tf.transpose(tf.cholesky_solve(chol, tf.transpose(mttkrp)))
+
+        self.mttkrps = []
+        self.grad_values = []
+        update_ops = []
+        for mode, var in enumerate(variables):
+            mttkrp, grad_value = solve_mode(mode)
+            self.mttkrps.append(mttkrp)
+            self.grad_values.append(grad_value)
+            update_op = tf.assign(var, (1-eta_t) * var + eta_t * grad_value)
+            update_ops.append(update_op)
+            if sequential:
+                factors[mode] = update_op
+        self.grad_value_U, self.grad_value_V = self.grad_values[:2]
+        if self.ndims > 2:
+            self.grad_value_W = self.grad_values[2]
+        return update_ops
 
     def get_train_op_2sgd(self, rho=1e-3):
-        [update_U_op, update_V_op, update_W_op] = self.get_update_UVW_ops_for_2sgd_sals(rho)
-        # Update U,V,W simultaneously - I believe tf.group does this?
-        update_CP_op = tf.group(update_U_op, update_V_op, update_W_op)
+        update_ops = self.get_update_UVW_ops_for_2sgd_sals(rho)
+        # Update U,V,W simultaneously - every update only depends on the old factors
+        update_CP_op = tf.group(*update_ops)
         return update_CP_op
 
     def get_train_ops_sals(self, rho=1e-3):
-        [update_U_op, update_V_op, update_W_op] = self.get_update_UVW_ops_for_2sgd_sals(rho)
-        # update U,V,W in order
-        return [update_U_op, update_V_op, update_W_op]
+        # update U,V,W in order: each update reads the factors assigned before it
+        return self.get_update_UVW_ops_for_2sgd_sals(rho, sequential=True)
 
     def get_train_op_adam(self):
         return self.optimizer.minimize(self.loss)
@@ -393,6 +361,7 @@ class SymmetricCPDecomp(object):
             # t-th batch tensor
             self.indices = tf.placeholder(tf.int64, shape=[None, self.ndims], name='X_t_indices')  # always fed in in a sorted way
             self.values = tf.placeholder(tf.float32, shape=[None], name='X_t_values')
+            self.weights = tf.placeholder_with_default(tf.ones_like(self.values), shape=[None], name='X_t_weights')  # per-entry loss weights
             shape_sparse = np.array(self.shape, dtype=np.int64)
             
             self.X_t = tf.SparseTensorValue(self.indices, self.values, dense_shape=shape_sparse)
@@ -412,7 +381,10 @@ class SymmetricCPDecomp(object):
         self.create_loss_fn(reg_param=reg_param)
 
     def train_step(self, approx_tensor, print_every=10, validate_indices=False):
-        approx_indices, approx_values = approx_tensor
+        '''
+        `approx_tensor` is an (indices, values) pair, or an (indices, values, weights) triple.
+        '''
+        approx_indices, approx_values = approx_tensor[:2]
         if not hasattr(self, 'prev_time'):
             self.prev_time = time.time()
             self.avg_time = 0.0
@@ -420,14 +392,18 @@ class SymmetricCPDecomp(object):
             self.indices: approx_indices,
             self.values: approx_values,
         }
+        if len(approx_tensor) > 2:
+            feed_dict[self.weights] = approx_tensor[2]
         if validate_indices:
             for ix in approx_indices:
                 assert ((sorted(ix) - ix) == 0).all(), 'Indices must be fed in only in sorted order. offending ix: {}'.format(ix)
-        _, loss_summary, step = self.sess.run(
+        _, loss_summary, step, err, reg = self.sess.run(
             [
                 self.train_ops,
                 self.loss_summary,
                 self.global_step,
+                self.L,  # fetched along with the train ops, so reporting doesn't take a second pass
+                self.reg,
             ],
             feed_dict=feed_dict,
         )
@@ -441,17 +417,10 @@ class SymmetricCPDecomp(object):
                 print('Saved model checkpoint to {} (it took {} secs)'.format(path, time.time() - t))
 
         if step % print_every == 0:
-            t = time.time()
-            err, reg = self.sess.run(
-                [
-                    self.L,
-                    self.reg,
-                ],
-                feed_dict=feed_dict,
-            )
             batch_time = (time.time() - self.prev_time) / print_every
             print("Err at step {}: {:.3f}; Reg loss: {:.3f} (lambda = {:.1E}) (Avg batch time: {:.3f})".format(int(step), err, reg, self.reg_param, batch_time))
             self.prev_time = time.time()
+        return step
         
     def create_loss_fn(self, reg_param):
         """
@@ -489,6 +458,7 @@ class SymmetricCPDecomp(object):
                 errors = tf.squared_difference(X_ijks, predicted_X_ijks)  # of shape (N,) - elementwise error for each entry in X_ijk
                 if self.is_glove:
                     errors = errors * tf.minimum(1., ((tf.exp(X_ijks)) / 100.) ** 0.75)  # X.values[i] is log(X_ij)
+                errors = errors * self.weights
                 mean_loss = tf.reduce_mean(errors)  # average loss per entry in X - scalar!
                 return mean_loss
 
@@ -518,9 +488,30 @@ class SymmetricCPDecomp(object):
     def get_train_op_adam(self):
         return self.optimizer.minimize(self.loss)
 
-    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None):
+    def get_factors(self):
+        return self.sess.run(self.sparse_U if self.nonneg else self.U)
+
+    def set_factors(self, factors):
+        self.U.load(factors, self.sess)
+
+    def validate(self, validation, step):
+        '''
+        Runs the cp_evaluation.ValidationMonitor `validation` check if one is due, decaying the learning rate
+            if it asks to. Returns True if training should stop.
+        '''
+        if validation is None or int(step) % validation.evaluate_every != 0:
+            return False
+        action = validation.check(step, self.get_factors())
+        if action == 'decay':
+            learning_rate = self.sess.run(self.learning_rate) * validation.lr_decay
+            self.learning_rate.load(learning_rate, self.sess)
+            print('Decayed the learning rate to {:.2E}'.format(learning_rate))
+        return action == 'stop'
+
+    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None, validation=None):
         '''
         Assumes `expected_tensors` is a generator of sparse tensor values. 
+        `validation` is an optional cp_evaluation.ValidationMonitor, for early stopping and learning rate decay.
         '''
         self.batch_num = 0
         self.results_file = results_file
@@ -528,7 +519,8 @@ class SymmetricCPDecomp(object):
         with tf.device('/{}'.format('gpu:0' if self.gpu else 'cpu:0')):
             print('setting up variables...')
             self.global_step = tf.Variable(0.0, name='global_step', trainable=False)
-            self.optimizer = tf.train.AdamOptimizer(learning_rate=.001)
+            self.learning_rate = tf.Variable(.001, name='learning_rate', trainable=False)
+            self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
 
             self.train_ops = self.get_train_ops()
 
@@ -556,14 +548,21 @@ class SymmetricCPDecomp(object):
         with self.sess.as_default():
             print('looping through batches...')
             for expected_tensor in expected_tensors:
+                step = None
                 try:
-                    self.train_step(expected_tensor)
+                    step = self.train_step(expected_tensor)
                 except tf.errors.InvalidArgumentError as e:
                     self.batch_num -= 1
                     num_invalid_arg_exceptions += 1
                     print("INVALID ARG EXCEPTION: {}. Accidentally noninvertible matrix? There have been {} of these.".format(e, num_invalid_arg_exceptions))
                     import pdb; pdb.set_trace()
                 self.batch_num += 1
+                if step is not None and self.validate(validation, step):
+                    print('Stopping early at step {}'.format(int(step)))
+                    break
+            if validation is not None and validation.best_factors is not None:
+                print('Restoring the factors from step {} (validation RMSE {:.4f})'.format(validation.best_step, validation.best_rmse))
+                self.set_factors(validation.best_factors)
             if self.checkpoint_every is not None:
                 try:
                     path = self.saver.save(self.sess, checkpoint_dir, global_step=tf.train.global_step(self.sess, self.global_step))
@@ -584,6 +583,9 @@ class JointSymmetricCPDecomp(SymmetricCPDecomp):
         since X is supersymmetric, `size` is the length of each dimension
         
         Approximates a supersymmetric tensor whose approximations are repeatedly fed in batch format (indices always in sorted order) to `self.train`
+
+        Batches are either one part per order ([indices_2d, indices_3d, ...], [values_2d, values_3d, ...]) or already packed
+            into one padded batch (see ngram_counts.pack_joint_batch). Either way, every order goes through the same gathers.
         '''
         self.dimlist = dimlist
         self.dimweights = dimweights
@@ -593,19 +595,13 @@ class JointSymmetricCPDecomp(SymmetricCPDecomp):
         self.nonneg = nonneg
         self.reg_param = reg_param
         self.gpu = gpu
+        self.size = size
 
-        self.indices = []
-        self.values = []
-        self.X_ts = []
         with tf.device('/{}:0'.format('gpu' if self.gpu else 'cpu')):
-            # t-th batch tensor
-            for dim in dimlist:
-                indices = tf.placeholder(tf.int64, shape=[None, dim], name='X_t_indices_{}'.format(dim))
-                values = tf.placeholder(tf.float32, shape=[None], name='X_t_values_{}'.format(dim))
-                self.indices.append(indices)
-                self.values.append(values)
-                shape_sparse = np.array([size] * dim, dtype=np.int64)
-                self.X_ts.append(tf.SparseTensorValue(indices, values, dense_shape=shape_sparse))
+            # t-th batch tensor, all orders packed together. Padding slots point at row `size`, a row of ones
+            self.indices = tf.placeholder(tf.int64, shape=[None, max(dimlist)], name='X_t_indices')
+            self.values = tf.placeholder(tf.float32, shape=[None], name='X_t_values')
+            self.order_slots = tf.placeholder(tf.int32, shape=[None], name='X_t_order_slots')  # position of each entry's order in `dimlist`
             # Goal: X_ijk == sum_{r=1}^{R} U_{ir} U_{jr} U_{kr}
             mu = 15.0
             mean = ((1. / self.rank) * mu) ** (1/2)
@@ -620,21 +616,32 @@ class JointSymmetricCPDecomp(SymmetricCPDecomp):
         self.create_loss_fn(reg_param=reg_param)
 
     def train_step(self, approx_tensor, print_every=10):
+        '''
+        `approx_tensor` is an (indices, values) pair. Unlike SymmetricCPDecomp, there is no weights placeholder, so
+            weighted (indices, values, weights) batches (e.g. from batch_store.TensorSampler) are not supported.
+        '''
+        if len(approx_tensor) != 2:
+            raise ValueError('JointSymmetricCPDecomp takes (indices, values) batches; per-entry weights are not supported')
         approx_indices, approx_values = approx_tensor
         if not hasattr(self, 'prev_time'):
             self.prev_time = time.time()
             self.avg_time = 0.0
             self.total_recordings = 0
 
-        feed_dict = {}
-        for ixes, vals, i in zip(approx_indices, approx_values, range(len(self.dimlist))):
-            feed_dict[self.indices[i]] = ixes
-            feed_dict[self.values[i]] = vals
-        _, loss_summary, step = self.sess.run(
+        if isinstance(approx_indices, (list, tuple)):
+            approx_indices, approx_values = pack_joint_batch(approx_indices, approx_values, width=max(self.dimlist))
+        feed_dict = {
+            self.indices: np.where(approx_indices < 0, self.size, approx_indices),
+            self.values: approx_values,
+            self.order_slots: joint_order_slots(approx_indices, self.dimlist),
+        }
+        _, loss_summary, step, errs, reg = self.sess.run(
             [
                 self.train_ops,
                 self.loss_summary,
                 self.global_step,
+                self.Ls,  # fetched along with the train ops, so reporting doesn't take a second pass
+                self.reg,
             ],
             feed_dict=feed_dict,
         )
@@ -646,44 +653,39 @@ class JointSymmetricCPDecomp(SymmetricCPDecomp):
                 print('Saved model checkpoint to {} (it took {} secs)'.format(path, time.time() - t))
 
         if step % print_every == 0:
-            t = time.time()
-            errs, reg = self.sess.run(
-                [
-                    self.Ls,
-                    self.reg,
-                ],
-                feed_dict=feed_dict,
-            )
             batch_time = (time.time() - self.prev_time) / print_every
             # string formatting to print the errors for each dimension
             errstring = '; '.join(['{}d: {:.2f}'.format(dim, err) for dim, err in zip(self.dimlist, errs)])
             print("{}: Errs: {}; Reg loss: {:.2f} (lambda={:.1E}) (Avg time: {:.2f})".format(int(step), errstring, reg, self.reg_param, batch_time))
             self.prev_time = time.time()
             self.total_recordings += 1
+        return step
         
     def create_loss_fn(self, reg_param):
         """
         L(X; U) = .5 sum_{i,j,k where X_ijk =/= 0} (X_ijk - sum_{r=1}^{R} U_ir U_jr U_kr)^2
         L_{rho} = L(X; U) + rho * (||U||^2) where ||.|| represents some norm (L2, L1, Frobenius)
         """
-        def L(X, U, dim):
+        def Ls(U):
             """
-            X is a sparse tensor. U is dense. 
+            Mean loss of each order in the packed batch. U is dense.
             """
-            indices = tf.transpose(X.indices)  # of shape (N,3) - represents the indices of all values (in the same order as X.values)
+            indices = tf.transpose(self.indices)  # of shape (max dim, N)
             with tf.device('/{}'.format('gpu:1' if self.gpu else 'cpu:0')):
-                X_ijks = X.values  # of shape (N,) - represents all the values stored in X. 
-
-                prod_vects = tf.gather(U, tf.gather(indices, 0))
-                for i in range(1, dim):
+                U_padded = tf.concat([U, tf.ones([1, self.rank])], axis=0)  # padding slots multiply by ones
+                prod_vects = tf.gather(U_padded, tf.gather(indices, 0))
+                for i in range(1, max(self.dimlist)):
                     i_indices = tf.gather(indices, i)  # of shape (N,) - represents all the indices to get from the U matrix
-                    i_vects = tf.gather(U, i_indices)
+                    i_vects = tf.gather(U_padded, i_indices)
                     prod_vects *= i_vects
                 predicted_X_ijks = tf.reduce_sum(prod_vects, axis=1)
-               
-                errors = tf.squared_difference(X_ijks, predicted_X_ijks)  # of shape (N,) - elementwise error for each entry in X_ijk
-                mean_loss = tf.reduce_mean(errors)  # average loss per entry in X - scalar!
-                return mean_loss
+
+                errors = tf.squared_difference(self.values, predicted_X_ijks)  # of shape (N,) - elementwise error for each entry
+                num_orders = len(self.dimlist)
+                order_sums = tf.unsorted_segment_sum(errors, self.order_slots, num_orders)
+                order_sizes = tf.unsorted_segment_sum(tf.ones_like(errors), self.order_slots, num_orders)
+                mean_losses = order_sums / tf.maximum(order_sizes, 1.)  # average loss per entry of each order
+                return tf.unstack(mean_losses, num=num_orders)
 
         def reg(U):
             with tf.device('/{}'.format('gpu:1' if self.gpu else 'cpu:0')):
@@ -700,9 +702,7 @@ class JointSymmetricCPDecomp(SymmetricCPDecomp):
             self.reg = reg(U) 
         else:
             self.reg = tf.constant(0.0)
-        self.Ls = []
-        for i, dim in enumerate(self.dimlist):
-            self.Ls.append(self.dimweights[i] * L(self.X_ts[i], U, dim))
+        self.Ls = [weight * loss for weight, loss in zip(self.dimweights, Ls(U))]
         self.L = sum(self.Ls)
         self.loss = self.L + self.reg
 
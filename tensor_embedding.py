@@ -5,8 +5,10 @@ import os
 import random
 import tensorflow as tf
 from tensor_decomp import CPDecomp
+from ngram_counts import CountMinSketch, PackedCounter, SpillingCounter, bits_per_index, chunk_combinations, chunk_unigrams, count_keys, count_parallel, expand_permutations, load_arrays, pack_indices, pack_joint_batch, pad_chunks, save_arrays, sorted_unique_rows, unpack_keys, vocab_hash
 import time
 import scipy
+import scipy.sparse
 
 from joblib import Parallel, delayed
 
@@ -121,7 +123,13 @@ class PpmiSvdEmbedding(TensorEmbedding):
         super(PpmiSvdEmbedding, self).__init__(vocab_model, embedding_dim)
         self.optimizer_type = 'svd'
 
-    def learn_embedding(self, ppmi_tensor):
+    def learn_embedding(self, ppmi_tensor, power_iters=2):
+        '''
+        If `ppmi_tensor` is a scipy.sparse matrix, a randomized truncated SVD is used (gensim's stochastic_svd),
+            so only the top `embedding_dim` factors are ever computed and the matrix never gets densified.
+        '''
+        if scipy.sparse.issparse(ppmi_tensor):
+            return self.learn_embedding_sparse(ppmi_tensor, power_iters=power_iters)
         print('getting svd of ppmi_tensor (shape: {})'.format(ppmi_tensor.shape))
         U,S,V = np.linalg.svd(ppmi_tensor)
 
@@ -134,6 +142,32 @@ class PpmiSvdEmbedding(TensorEmbedding):
         predicted = np.dot(self.embedding, self.C_embedding.T)
         print("RMSE: {}".format(np.sqrt(((ppmi_tensor - predicted) ** 2).mean())))
 
+    def learn_embedding_sparse(self, ppmi_matrix, power_iters=2, chunk_size=2**20):
+        from gensim.models.lsimodel import stochastic_svd
+        print('getting randomized svd of sparse ppmi_matrix (shape: {}, nnz: {})'.format(ppmi_matrix.shape, ppmi_matrix.nnz))
+        ppmi_matrix = ppmi_matrix.tocsc()
+        U_d, S_d = stochastic_svd(ppmi_matrix, self.embedding_dim, ppmi_matrix.shape[0], power_iters=power_iters)
+        # below full rank (e.g. few articles or a high min_count), some singular values are (numerically) zero, or missing altogether
+        U = np.zeros((ppmi_matrix.shape[0], self.embedding_dim))
+        S = np.zeros(self.embedding_dim)
+        U[:, :U_d.shape[1]] = U_d
+        S[:len(S_d)] = S_d
+        nonzero = S > 1e-10 * max(S.max(), 1e-300)
+        V = np.zeros((ppmi_matrix.shape[1], self.embedding_dim))
+        V[:, nonzero] = ppmi_matrix.T.dot(U[:, nonzero]) / S[nonzero]  # right singular vectors, from A^T U = V S
+        sqrt_S = np.sqrt(np.where(nonzero, S, 0.0))
+        self.embedding = U * sqrt_S
+        self.C_embedding = V * sqrt_S
+
+        ppmi_matrix = ppmi_matrix.tocoo()
+        total_err = 0.0
+        for start in range(0, ppmi_matrix.nnz, chunk_size):
+            rows = ppmi_matrix.row[start:start + chunk_size]
+            cols = ppmi_matrix.col[start:start + chunk_size]
+            predicted = (self.embedding[rows] * self.C_embedding[cols]).sum(axis=1)
+            total_err += ((ppmi_matrix.data[start:start + chunk_size] - predicted) ** 2).sum()
+        print("RMSE (over nonzero entries): {}".format(np.sqrt(total_err / max(ppmi_matrix.nnz, 1))))
+
     def get_embedding_matrix(self):
         return self.embedding
 
@@ -235,6 +269,8 @@ class PMIGatherer(object):
         # set of indices, which are all ordered in ascending order, then we just permute everything at lookup time
         #       i.e. if indices = {(1,2,3)}, the indices gets expanded to [(1,2,3), (2,1,3), (3,2,1), ..., (1,3,2)] and the corresponding PMI vals get added
         #       This decreases computation time (and ram) for PMI. But (negligibly) increases computation time for sorting everything according to (1,2,3)
+        if isinstance(batch, tuple):  # a (matrix, lengths) batch, see corpus_store.CompiledCorpus.chunk_batches
+            batch = [row[:length].tolist() for row, length in zip(*batch)]
         if return_set: 
             indices = set()
         else:
@@ -277,6 +313,52 @@ class PMIGatherer(object):
             pass
         return indices
 
+    def gather_indices(self, batch=None):
+        '''
+        Sorted index tuples to put in the PMI tensor: the valid ones occurring in `batch`, or all counted ones if there's no batch.
+        '''
+        if batch:
+            indices = self.get_indices(batch, return_set=True)
+            indices = list(self.valid_indices.intersection(indices))
+        else:
+            indices = list(self.n_counts.keys())
+        return np.asarray(indices, dtype=np.uint16)
+
+    def gather_values(self, indices, pmi=True):
+        values = np.zeros(len(indices), dtype=np.float32) 
+        for i in range(len(indices)):
+            ix = tuple(indices[i].tolist())
+            if pmi:
+                values[i] = self.PMI(*ix)  # NOTE: if this becomes unbearably slow, you are out of ram. decrease batch size. 
+            else:
+                values[i] += self.n_counts[ix]
+        return values
+
+    def gather_entries(self, batch=None, pmi=True):
+        indices = self.gather_indices(batch)
+        return indices, self.gather_values(indices, pmi=pmi)
+
+    def is_counted(self, ix):
+        return ix in self.n_counts
+
+    def get_indices_array(self, batch, update_uni_counts=False):
+        '''
+        Vectorized `get_indices`: `batch` is a list of sent chunks, a padded int32 matrix (one chunk per row, see ngram_counts.pad_chunks)
+            or a (matrix, lengths) pair (see corpus_store.CompiledCorpus.chunk_batches).
+        Returns an (N, n) int32 array of all sorted n-tuples of each chunk. Unigram and `num_samples` accounting is the same as `get_indices`.
+        '''
+        rows, lengths = sorted_unique_rows(pad_chunks(batch))
+        indices = chunk_combinations(rows, lengths, self.n)
+        if update_uni_counts:
+            uni_counts, num_samples = chunk_unigrams(rows, lengths, self.n, self.vocab_len)
+            if isinstance(self.uni_counts, np.ndarray):
+                self.uni_counts += uni_counts
+            else:
+                for ix in np.flatnonzero(uni_counts):
+                    self.uni_counts[int(ix)] += int(uni_counts[ix])
+            self.num_samples += num_samples
+        return indices
+
     def create_pmi_tensor(self, 
         batch=None,
         positive=True,
@@ -292,20 +374,8 @@ class PMIGatherer(object):
         if log_info:
             print('Creating Sparse PMI tensor...', end='')
         t = time.time()
-        if batch:
-            indices = self.get_indices(batch, return_set=True)
-            indices = list(self.valid_indices.intersection(indices))
-        else:
-            indices = list(self.n_counts.keys())
-
-        values = np.zeros(len(indices), dtype=np.float32) 
-        for i in range(len(indices)):
-            if pmi:
-                values[i] = self.PMI(*indices[i])  # NOTE: if this becomes unbearably slow, you are out of ram. decrease batch size. 
-            else:
-                values[i] += self.n_counts[indices[i]]
+        indices, values = self.gather_entries(batch, pmi=pmi)
         shape = (self.vocab_len,) * self.n
-        indices = np.asarray(indices, dtype=np.uint16)
         if limit_large_vals:
             new_indices = []
             new_vals = []
@@ -332,7 +402,7 @@ class PMIGatherer(object):
             for _ in range(int(neg_sample_percent * len(indices))):
                 ix = np.random.randint(low=0, high=len(self.model.vocab), size=(self.n,))
                 ix = tuple(sorted(ix))
-                if ix not in self.n_counts:
+                if not self.is_counted(ix):
                     if len(ix) < self.n:
                         continue
                     new_indices.append(ix)
@@ -352,19 +422,7 @@ class PMIGatherer(object):
             #import pdb; pdb.set_trace()
             pass
         if not symmetric:
-            n_fact = int(scipy.misc.factorial(self.n))
-            indices_extended = np.zeros((n_fact*len(indices), self.n), dtype=np.int16)
-            values_extended = np.zeros((n_fact*len(indices),), dtype=np.float32)
-            for i in range(len(indices)):
-                tup = indices[i]
-                j = 0
-                for perm in itertools.permutations(range(self.n)):
-                    for k, sigma in enumerate(perm):
-                        indices_extended[n_fact*i+j][perm[k]] = tup[k]
-                        values_extended[n_fact*i+j] = values[i]
-                    j += 1
-            indices = indices_extended
-            values = values_extended
+            indices, values = expand_permutations(indices, values.astype(np.float32))
         if numpy_dense_tensor:
             ''' Probably not gonna wanna do this if you're bigger than 2 dimensions. '''
             ppmi_tensor = np.zeros(shape)
@@ -376,3 +434,312 @@ class PMIGatherer(object):
             print('took {} secs'.format(int(time.time() - t)))
         return (indices, values)
 
+
+
+class PackedPMIGatherer(PMIGatherer):
+    def __init__(self, vocab_model, n=2, buffer_size=2**24):
+        '''
+        Same interface as PMIGatherer, but the n-gram counts live in a PackedCounter (sorted uint64 keys + uint32 counts)
+            instead of a tuple-keyed defaultdict, and the unigram counts live in a numpy array.
+        '''
+        super(PackedPMIGatherer, self).__init__(vocab_model, n=n)
+        self.buffer_size = buffer_size
+
+    def P(self, x):
+        '''
+        MLE for probabilities: #(x)/|D|
+        '''
+        if isinstance(x, tuple):  # n-gram probability
+            assert len(x) == self.n
+            return self.counter.lookup(self.counter.pack([x]))[0] / self.num_samples
+        else:  # unigram probability
+            return self.uni_counts[x] / self.num_samples
+
+    def PMI(self, *args):
+        positions, found = self.counter.find(self.counter.pack([args]))
+        return float(self.pmi[positions[0]]) if found[0] else 0.0
+
+    def pmi_values(self, indices, counts=None):
+        '''
+        Vectorized PMI of an (N, n) array of sorted index tuples. Tuples seen <= 5 times get a PMI of 0 (like PMIGatherer.PMI).
+        '''
+        if counts is None:
+            counts = self.counter.lookup(self.counter.pack(indices))
+        valid = counts > 5
+        log_num = np.log2(np.maximum(counts, 1)) + (self.n - 1)*np.log2(self.num_samples)
+        log_denom = np.log2(np.maximum(self.uni_counts[indices], 1)).sum(axis=1)
+        return np.where(valid, log_num - log_denom, 0.0).astype(np.float32)
+
+    def compute_pmi(self, chunk_size=2**22):
+        '''
+        Computes the PMI of every counted n-gram once, as `self.pmi` (aligned with `self.counter.keys`),
+            so building a batch tensor is just a lookup. PPMI and shifted PMI are applied on top of it in `create_pmi_tensor`.
+        '''
+        t = time.time()
+        keys, counts = self.counter.keys, self.counter.counts
+        self.pmi = np.zeros(len(keys), dtype=np.float32)
+        for start in range(0, len(keys), chunk_size):
+            stop = start + chunk_size
+            self.pmi[start:stop] = self.pmi_values(self.counter.unpack(keys[start:stop]), counts=counts[start:stop])
+        print('Computing {} PMI values took {} secs'.format(len(self.pmi), time.time() - t))
+
+    def kill_ncounts(self, p=0.5, m=1):
+        '''
+        kills `p` percent of the things with count <= m
+        '''
+        print(len(self.counter))
+        print('killing {} of the count-{} n_counts...'.format(p, m))
+        self.counter.kill(p, m)
+        print(len(self.counter))
+
+    def populate_counts(self, batches, huge_vocab=True, min_count=1, spill_dir=None, memory_budget=2**30, processes=None,
+                        prune_strategy='threshold', max_entries=1e8, sketch_width=2**24):
+        '''
+        `batches` is a generator of sentence chunk lists (see gensim_utils.batch_generator2) or padded chunk matrices
+
+        If `spill_dir` is given, counts are built exactly out of core: sorted runs of at most `memory_budget` bytes get
+            spilled to `spill_dir` and merged into one memory-mapped count file at the end (see ngram_counts.SpillingCounter).
+            Otherwise, if `huge_vocab`, the counts get pruned down to 70% of `max_entries` whenever there are more than
+            `max_entries` of them, with `prune_strategy` 'threshold', 'top_k' or 'heavy_hitters' (see PackedCounter.shrink).
+            If not `huge_vocab`, batches are counted by `processes` worker processes (see ngram_counts.count_parallel).
+        Every prune is reported, and the reports are kept in `self.prune_reports`.
+        '''
+        print('Gathering counts...')
+        self.num_samples = 0
+        self.uni_counts = np.zeros(self.vocab_len, dtype=np.int64)
+        self.prune_reports = []
+        sketch = None
+        if spill_dir is None and huge_vocab and prune_strategy == 'heavy_hitters':
+            sketch = CountMinSketch(width=sketch_width)
+
+        print('getting counts...')
+        t = time.time()
+        if spill_dir is None and not huge_vocab:  # time is more impt than memory
+            print('Populating counts (in parallel)...')
+            self.counter, self.uni_counts, self.num_samples = count_parallel(batches, self.n, self.vocab_len, processes=processes, buffer_size=self.buffer_size)
+        else:
+            if spill_dir is not None:
+                self.counter = SpillingCounter(self.n, self.vocab_len, spill_dir, memory_budget=memory_budget, buffer_size=self.buffer_size)
+            else:
+                self.counter = PackedCounter(self.n, self.vocab_len, buffer_size=self.buffer_size)
+            for i, batch in enumerate(batches):
+                keys, counts = count_keys(self.counter.pack(self.get_indices_array(batch, update_uni_counts=True)))
+                if sketch is not None:
+                    sketch.update(keys, counts)
+                self.counter.update_keys(keys, counts)
+                if spill_dir is None and len(self.counter.keys) > max_entries:  # merged entries only, so this doesn't force a merge every batch
+                    report = self.counter.shrink(int(0.7 * max_entries), strategy=prune_strategy, sketch=sketch)
+                    print('pruned {}'.format(report))
+                    self.prune_reports.append(report)
+        print('Killing all n_counts with n < {}'.format(min_count))
+        if spill_dir is not None:
+            self.counter.finalize(min_count=min_count)
+        else:
+            report = self.counter.prune(min_count)  # kill everything with a count of `min_count` - it's gonna have low PPMI anyway (since everything has a huge mincount). 
+            print('pruned {}'.format(report))
+            self.prune_reports.append(report)
+        print('{} n_counts ({:.1f} MB)'.format(len(self.counter), self.counter.nbytes / 2**20))
+        print('Gathering counts took {} secs'.format(time.time() - t))
+        self.compute_pmi()
+
+    def save(self, dirname):
+        '''
+        Saves the counts as flat binary arrays (see ngram_counts.save_arrays) instead of pickling the whole gatherer.
+        '''
+        t = time.time()
+        header = {
+            'format': 'pmi_gatherer',
+            'n': self.n,
+            'vocab_len': self.vocab_len,
+            'num_samples': int(self.num_samples),
+            'vocab_hash': vocab_hash(self.model.index2word),
+        }
+        save_arrays(dirname, header, {
+            'keys': self.counter.keys,
+            'counts': self.counter.counts,
+            'uni_counts': self.uni_counts,
+            'pmi': self.pmi,
+        })
+        print('Saving gatherer to {} took {} secs'.format(dirname, time.time() - t))
+
+    @classmethod
+    def load(cls, dirname, vocab_model, mmap=True):
+        '''
+        Loads a gatherer saved with `save`. With `mmap`, the count arrays are memory-mapped read-only rather than read into RAM.
+        '''
+        t = time.time()
+        header, arrays = load_arrays(dirname, mmap=mmap)
+        if header['vocab_hash'] != vocab_hash(vocab_model.index2word):
+            raise ValueError('{} was gathered with a different vocab'.format(dirname))
+        gatherer = cls(vocab_model, n=header['n'])
+        gatherer.num_samples = header['num_samples']
+        gatherer.uni_counts = arrays['uni_counts']
+        gatherer.counter = PackedCounter(gatherer.n, gatherer.vocab_len, buffer_size=gatherer.buffer_size)
+        gatherer.counter.keys = arrays['keys']
+        gatherer.counter.counts = arrays['counts']
+        if 'pmi' in arrays:
+            gatherer.pmi = arrays['pmi']
+        else:
+            gatherer.compute_pmi()
+        print('Loading gatherer from {} took {} secs'.format(dirname, time.time() - t))
+        return gatherer
+
+    def gather_entries(self, batch=None, pmi=True):
+        '''
+        Looks the valid n-grams of `batch` (or all counted ones) up once, and gathers their indices and PMI (or count) values.
+        '''
+        if batch is not None:
+            keys = np.unique(self.counter.pack(self.get_indices_array(batch)))
+            positions, found = self.counter.find(keys)
+            positions = positions[found]
+            positions = positions[self.counter.counts[positions] > 5]
+        else:
+            positions = np.arange(len(self.counter.keys))
+        indices = self.counter.unpack(self.counter.keys[positions])
+        if pmi:
+            values = self.pmi[positions]
+        else:
+            values = self.counter.counts[positions].astype(np.float32)
+        return indices, values
+
+    def gather_indices(self, batch=None):
+        '''
+        The (N, n) int32 index tuples `gather_entries` would return for `batch`.
+        '''
+        return self.gather_entries(batch, pmi=False)[0]
+
+    def gather_values(self, indices, pmi=True):
+        '''
+        PMI (or count) of every sorted index tuple in `indices`, 0 for the ones that weren't counted.
+        '''
+        indices = np.asarray(indices).reshape(-1, self.n)
+        positions, found = self.counter.find(self.counter.pack(indices))
+        values = np.zeros(len(indices), dtype=np.float32)
+        if pmi:
+            values[found] = self.pmi[positions[found]]
+        else:
+            values[found] = self.counter.counts[positions[found]]
+        return values
+
+    def create_sparse_pmi_matrix(self, positive=True, shift=0.0):
+        '''
+        The (shifted, positive) PMI matrix as a symmetric scipy.sparse CSR matrix, straight from the count arrays.
+        Same values as `create_pmi_tensor(numpy_dense_tensor=True)`, without the dense |V|x|V| allocation. Only for n=2.
+        '''
+        assert self.n == 2, 'sparse PMI matrices are only for pairs'
+        t = time.time()
+        indices = self.counter.unpack(self.counter.keys)
+        values = self.pmi + shift
+        if positive:
+            keep = values > 0.0
+            indices = indices[keep]
+            values = values[keep]
+        rows = np.concatenate((indices[:, 0], indices[:, 1]))
+        cols = np.concatenate((indices[:, 1], indices[:, 0]))
+        matrix = scipy.sparse.csr_matrix(
+            (np.concatenate((values, values)), (rows, cols)),
+            shape=(self.vocab_len, self.vocab_len),
+        )
+        print('Creating sparse PMI matrix ({} nonzeros) took {} secs'.format(matrix.nnz, time.time() - t))
+        return matrix
+
+    def is_counted(self, ix):
+        return self.counter.lookup(self.counter.pack([ix]))[0] > 0
+
+
+class JointPMIGatherer(object):
+    def __init__(self, vocab_model, dimlist, offsets, keys, counts, pmi):
+        '''
+        One count store for every order in `dimlist`, for building joint batches in a single pass (see `create_pmi_batch`).
+        The packed keys (and their counts and PMI values) of all orders live in one set of arrays, one sorted block per
+            order: block i spans [offsets[i], offsets[i+1]) and holds `dimlist[i]`-tuples packed with `self.bits[i]` bits.
+        Build it from per-order PackedPMIGatherers with `from_gatherers`.
+        '''
+        self.model = vocab_model
+        self.vocab_len = len(vocab_model.vocab)
+        self.dimlist = list(dimlist)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bits = [bits_per_index(self.vocab_len, n) for n in self.dimlist]
+        self.keys = keys
+        self.counts = counts
+        self.pmi = pmi
+
+    @classmethod
+    def from_gatherers(cls, vocab_model, gatherers):
+        t = time.time()
+        offsets = np.cumsum([0] + [len(gatherer.counter.keys) for gatherer in gatherers])
+        gatherer = cls(
+            vocab_model,
+            dimlist=[gatherer.n for gatherer in gatherers],
+            offsets=offsets,
+            keys=np.concatenate([gatherer.counter.keys for gatherer in gatherers]),
+            counts=np.concatenate([gatherer.counter.counts for gatherer in gatherers]),
+            pmi=np.concatenate([gatherer.pmi for gatherer in gatherers]),
+        )
+        print('Merging {} gatherers ({} n_counts) took {} secs'.format(len(gatherers), offsets[-1], time.time() - t))
+        return gatherer
+
+    def save(self, dirname):
+        header = {
+            'format': 'joint_pmi_gatherer',
+            'dimlist': self.dimlist,
+            'offsets': [int(offset) for offset in self.offsets],
+            'vocab_hash': vocab_hash(self.model.index2word),
+        }
+        save_arrays(dirname, header, {'keys': self.keys, 'counts': self.counts, 'pmi': self.pmi})
+
+    @classmethod
+    def load(cls, dirname, vocab_model, mmap=True):
+        header, arrays = load_arrays(dirname, mmap=mmap)
+        if header['vocab_hash'] != vocab_hash(vocab_model.index2word):
+            raise ValueError('{} was gathered with a different vocab'.format(dirname))
+        return cls(vocab_model, header['dimlist'], header['offsets'], arrays['keys'], arrays['counts'], arrays['pmi'])
+
+    def find(self, slot, keys):
+        '''
+        Returns (positions, found) of the packed `dimlist[slot]`-tuple `keys` in the store.
+        '''
+        start, stop = self.offsets[slot], self.offsets[slot + 1]
+        block = self.keys[start:stop]
+        if not len(block):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(block, keys)
+        positions[positions == len(block)] = 0
+        found = block[positions] == keys
+        return positions + start, found
+
+    def negative_samples(self, slot, num_samples):
+        '''
+        `num_samples` random sorted `dimlist[slot]`-tuples, minus the ones that were counted (which get dropped, not redrawn).
+        '''
+        n = self.dimlist[slot]
+        indices = np.sort(np.random.randint(low=0, high=self.vocab_len, size=(num_samples, n)), axis=1).astype(np.int32)
+        _, found = self.find(slot, pack_indices(indices, self.bits[slot]))
+        return indices[~found]
+
+    def create_pmi_batch(self, batch, shifts, positive=True, neg_sample_percent=0.0):
+        '''
+        Joint counterpart of PMIGatherer.create_pmi_tensor(batch=batch, symmetric=True, pmi=True) for every order at once:
+            the chunks get sorted and deduplicated once, each order's combinations are looked up in its block of the
+            store, and the result is a single packed batch (see ngram_counts.pack_joint_batch) instead of one tensor per order.
+        `shifts` has one PMI shift per order.
+        '''
+        rows, lengths = sorted_unique_rows(pad_chunks(batch))
+        indices, values = [], []
+        for slot, (n, shift) in enumerate(zip(self.dimlist, shifts)):
+            keys = np.unique(pack_indices(chunk_combinations(rows, lengths, n), self.bits[slot]))
+            positions, found = self.find(slot, keys)
+            positions = positions[found]
+            positions = positions[self.counts[positions] > 5]
+            order_indices = unpack_keys(self.keys[positions], n, self.bits[slot])
+            order_values = self.pmi[positions] + shift
+            if positive:
+                keep = order_values > 0.0
+                order_indices, order_values = order_indices[keep], order_values[keep]
+            if neg_sample_percent > 0.0:
+                negatives = self.negative_samples(slot, int(neg_sample_percent * len(order_indices)))
+                order_indices = np.vstack((order_indices, negatives))
+                order_values = np.concatenate((order_values, np.zeros(len(negatives), dtype=np.float32)))
+            indices.append(order_indices)
+            values.append(order_values)
+        return pack_joint_batch(indices, values, width=max(self.dimlist))
@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import dill
 import gensim
@@ -14,12 +15,19 @@ import sys
 import time
 import tensorflow as tf
 
+from batch_store import BatchStore, TensorSampler
+from cp_evaluation import ValidationMonitor, evaluate_cp, evaluate_joint
 from embedding_evaluation import write_embedding_to_file, EmbeddingTaskEvaluator
-from gensim_utils import batch_generator, batch_generator2
+from corpus_store import CompiledCorpus
+from gensim_utils import batch_generator
+from hogwild import HogwildTrainer
+from numpy_decomp import NumpyCPDecomp, NumpySymmetricCPDecomp, NumpyJointSymmetricCPDecomp, SymmetricCPALS
 from nltk.corpus import stopwords
+from pipeline import Pipeline, Stage
 from sklearn.utils import shuffle
-from tensor_embedding import PMIGatherer, PpmiSvdEmbedding
+from tensor_embedding import JointPMIGatherer, PackedPMIGatherer, PpmiSvdEmbedding
 from tensor_decomp import CPDecomp, SymmetricCPDecomp, JointSymmetricCPDecomp
+from vocab_store import VocabCounter, Vocabulary
 
 
 stopwords = set(stopwords.words('english'))
@@ -28,12 +36,27 @@ stopwords = stopwords.union(grammar_stopwords)
 
 
 class GensimSandbox(object):
-    def __init__(self, method, embedding_dim, num_articles, min_count, gpu=True):
+    def __init__(self, method, embedding_dim, num_articles, min_count, gpu=True, backend='tf', sparse_updates=False, workers=1, pipeline_workers=0,
+                 vocab_mode='exact', vocab_max_words=None):
+        '''
+        `backend` is 'tf' (tensor_decomp) or 'numpy' (numpy_decomp, no TF session) for the online CP decompositions.
+        `sparse_updates` makes the numpy backend only update the rows of U each batch touches.
+        With more than one of `workers`, the numpy backend trains Hogwild-style in that many processes (see hogwild.py).
+        With `pipeline_workers`, the online PMI batches are built ahead of the optimizer, by that many processes (see pipeline.py).
+        `vocab_mode` and `vocab_max_words` set how the vocab gets counted (see vocab_store.VocabCounter).
+        '''
         self.method = method
         self.embedding_dim = int(embedding_dim)
         self.min_count = int(min_count)
         self.num_articles = int(num_articles)
         self.gpu = gpu
+        assert backend in ('tf', 'numpy'), 'unknown backend {}'.format(backend)
+        self.backend = backend
+        self.sparse_updates = sparse_updates
+        self.workers = workers
+        self.pipeline_workers = pipeline_workers
+        self.vocab_mode = vocab_mode
+        self.vocab_max_words = vocab_max_words
 
         # To be assigned later
         self.model = None
@@ -62,10 +85,55 @@ class GensimSandbox(object):
         print("avg article word length: {}".format(n_tokens / count))
         print("{} total tokens".format(n_tokens))
         print("num articles: {}".format(count))
-        raise StopIteration
 
-    def get_model_with_vocab(self, fname='wikimodel'):
-        fname += '_{}_{}'.format(self.num_articles, self.min_count)
+    def get_corpus(self):
+        '''
+        The first `num_articles` articles as vocab indices (see corpus_store.CompiledCorpus), compiled from the wiki dump
+            the first time they're asked for with this vocab, so later passes skip decompression, markup stripping and tokenizing.
+        '''
+        dirname = 'corpus_{}_{}'.format(self.num_articles, self.min_count)
+        if CompiledCorpus.exists(dirname):
+            corpus = CompiledCorpus(dirname)
+            if corpus.matches(self.model):
+                return corpus
+            print('{} was compiled with a different vocab, recompiling'.format(dirname))
+        return CompiledCorpus.compile(dirname, self.model, self.sentences_generator())
+
+    def chunk_batches(self, batch_size, num_articles=None):
+        '''
+        Batches of sent chunks of the compiled corpus, as (matrix, lengths) pairs (see corpus_store.CompiledCorpus.chunk_batches).
+        '''
+        return self.get_corpus().chunk_batches(self.model.window, batch_size, num_docs=num_articles)
+
+    def get_vocab(self):
+        '''
+        The vocab of the first `num_articles` articles (see vocab_store.Vocabulary), counted in one streaming pass the
+            first time it's asked for.
+        '''
+        dirname = 'vocab_{}_{}'.format(self.num_articles, self.min_count)
+        if Vocabulary.exists(dirname):
+            return Vocabulary.load(dirname)
+        fname = 'wikimodel_{}_{}'.format(self.num_articles, self.min_count)
+        if os.path.exists(fname):  # vocabs pickled with a whole Word2Vec model before vocab_store existed
+            print('depickling model...')
+            with open(fname, 'rb') as f:
+                vocab = Vocabulary.from_model(dill.load(f))
+        else:
+            print('building vocab...')
+            counter = VocabCounter(self.vocab_mode, max_words=self.vocab_max_words, shard_dir=dirname + '.shards')
+            vocab = counter.update(self.sentences_generator()).finalize(min_count=self.min_count)
+        vocab.save(dirname)
+        return vocab
+
+    def get_model_with_vocab(self):
+        '''
+        The vocab on its own, except for the gensim methods, which get a Word2Vec model built on it to train.
+        '''
+        vocab = self.get_vocab()
+        if self.method not in ['cnn', 'cbow', 'tt', 'subspace', 'sgns', 'hosg']:
+            print('Finished building vocab. length of vocab: {}'.format(len(vocab)))
+            self.model = vocab
+            return self.model
         model = gensim.models.Word2Vec(
             iter=1,
             max_vocab_size=None,
@@ -73,15 +141,7 @@ class GensimSandbox(object):
             size=self.embedding_dim,
             min_count=self.min_count,
         )
-        if not os.path.exists(fname):
-            print('building vocab...')
-            model.build_vocab(self.sentences_generator())
-            with open(fname, 'wb') as f:
-                dill.dump(model, f)
-        else:
-            print('depickling model...')
-            with open(fname, 'rb') as f:
-                model = dill.load(f)
+        vocab.seed_word2vec(model)
         model.tt = 0
         model.cbow = 0
         model.sgns = 0
@@ -138,7 +198,7 @@ class GensimSandbox(object):
 
     def train_gensim_embedding(self):
         print('training...')
-        batches = batch_generator(self.model, self.sentences_generator(), batch_size=128, stopwords=stopwords)
+        batches = batch_generator(self.model, self.get_corpus().sentences(self.model.index2word), batch_size=128, stopwords=stopwords)
         self.model.train(sentences=None, batches=batches, gpu=self.gpu)
         print('finished training!')
 
@@ -154,8 +214,11 @@ class GensimSandbox(object):
 
     def get_pmi_gatherer(self, n):
         gatherer = None
-        if os.path.exists('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n)):
-            with open('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n), 'rb') as f:
+        dirname = 'gatherer_{}_{}_{}'.format(self.num_articles, self.min_count, n)
+        if os.path.exists(os.path.join(dirname, 'header.json')):
+            gatherer = PackedPMIGatherer.load(dirname, self.model)
+        elif os.path.exists(dirname + '.pkl'):  # gatherers pickled before the binary format existed
+            with open(dirname + '.pkl', 'rb') as f:
                 t = time.time()
                 import gc; gc.disable()
                 gatherer = dill.load(f)
@@ -163,52 +226,125 @@ class GensimSandbox(object):
                 print('Loading gatherer took {} secs'.format(time.time() - t))
         else:
             # batch_size doesn't matter. But higher is probably better (in terms of threading & speed)
-            batches = batch_generator2(self.model, self.sentences_generator(num_articles=self.num_articles), batch_size=1000)
-            gatherer = PMIGatherer(self.model, n=n)
+            batches = self.chunk_batches(batch_size=1000)
+            gatherer = PackedPMIGatherer(self.model, n=n)
             if self.num_articles <= 1e4:
                 gatherer.populate_counts(batches, huge_vocab=False)
             else:
-                gatherer.populate_counts(batches, huge_vocab=True, min_count=5)
+                spill_dir = dirname + '_counts'
+                gatherer.populate_counts(batches, huge_vocab=True, min_count=5, spill_dir=spill_dir)
+                gatherer.save(dirname)
+                # the saved copy replaces the merged counts file, which would otherwise take up the same space again
+                gatherer = PackedPMIGatherer.load(dirname, self.model)
+                shutil.rmtree(spill_dir)
+                return gatherer
+            gatherer.save(dirname)
+        return gatherer
 
-            with open('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n), 'wb') as f:
-                t = time.time()
-                import gc; gc.disable()
-                dill.dump(gatherer, f)
-                gc.enable()
-                print('Dumping gatherer took {} secs'.format(time.time() - t))
+    def get_joint_gatherer(self, dimlist):
+        '''
+        One count store for all the orders of a joint decomposition (see tensor_embedding.JointPMIGatherer),
+            merged from the per-order gatherers the first time it's asked for.
+        '''
+        dirname = 'joint_gatherer_{}_{}_{}'.format(self.num_articles, self.min_count, '-'.join(map(str, dimlist)))
+        if os.path.exists(os.path.join(dirname, 'header.json')):
+            return JointPMIGatherer.load(dirname, self.model)
+        gatherer = JointPMIGatherer.from_gatherers(self.model, [self.get_pmi_gatherer(dim) for dim in dimlist])
+        gatherer.save(dirname)
         return gatherer
 
-    def train_joint_online_cp_embedding(self, dimlist: list, dimweights: list, nonneg: bool, exp_shifts=[1., 15.], neg_sample_percent=0.15,):
-        gatherers = [self.get_pmi_gatherer(dim) for dim in dimlist]
+    def get_batch_store(self, name, batches):
+        '''
+        Materializes the sparse tensor `batches` to disk the first time they're asked for (see batch_store.BatchStore),
+            so later epochs and runs with the same `name` replay them instead of re-parsing the corpus.
+        '''
+        dirname = 'batches_{}_{}_{}'.format(self.num_articles, self.min_count, name)
+        if BatchStore.exists(dirname):
+            print('Replaying batches from {}'.format(dirname))
+            return BatchStore(dirname)
+        return BatchStore.materialize(dirname, batches)
+
+    def text_batches(self, make_tensor, batch_size, num_articles=None):
+        '''
+        Sparse tensor batches `make_tensor(batch)` of the corpus, for every batch of sent chunks from `chunk_batches`.
+        With `pipeline_workers`, the PMI lookups run in the 'pmi' stage of a Pipeline (in that many processes), fed by
+            the Pipeline's 'chunker' thread, so training never waits on either unless they fall behind (the pipeline
+            report shows which one).
+        The pipeline's worker processes are forked right away, so call this before creating the TF session.
+        '''
+        if self.pipeline_workers > 0:
+            stages = [Stage.map('pmi', make_tensor, num_workers=self.pipeline_workers, use_processes=True)]
+            return Pipeline(self.chunk_batches(batch_size, num_articles=num_articles), stages, name='chunker').start()
+        return (make_tensor(batch) for batch in self.chunk_batches(batch_size, num_articles=num_articles))
+
+    def create_session(self):
+        if self.backend == 'numpy':
+            self.sess = None
+        else:
+            config = tf.ConfigProto(
+                allow_soft_placement=True,
+            )
+            self.sess = tf.Session(config=config)
+
+    def session_scope(self):
+        if self.sess is None:
+            return contextlib.nullcontext()
+        return self.sess.as_default()
+
+    def decomp_kwargs(self):
+        if self.backend == 'numpy':
+            return {'sparse_updates': self.sparse_updates}
+        return {}
+
+    def train_decomp(self, decomp_method, batches, validation=None):
+        if self.backend == 'numpy' and self.workers > 1:
+            if validation is not None:
+                raise ValueError('validation (early stopping, LR decay) is not supported with Hogwild workers; use --workers=1 or --validation_size=0')
+            HogwildTrainer(decomp_method, num_workers=self.workers, use_processes=True).train(batches)
+        elif validation is not None:
+            decomp_method.train(validation.filter_batches(batches), validation=validation)
+        else:
+            decomp_method.train(batches)
+
+    def get_factor_matrix(self, decomp_method):
+        if isinstance(decomp_method.U, np.ndarray):
+            return decomp_method.U
+        with self.session_scope():
+            return decomp_method.U.eval()
+
+    def train_joint_online_cp_embedding(self, dimlist: list, dimweights: list, nonneg: bool, exp_shifts=[1., 15.], neg_sample_percent=0.15, num_epochs=1, cache_batches=False):
+        gatherer = self.get_joint_gatherer(dimlist)
         shifts = [-np.log2(s) for s in exp_shifts]
 
         def sparse_tensor_batches(batch_size=1000):
-            batches = batch_generator2(self.model, self.sentences_generator(num_articles=self.num_articles), batch_size=batch_size)
-            for batch in batches:
-                pairlist = [
-                    gatherer.create_pmi_tensor(
-                        batch=batch,
-                        positive=True,
-                        debug=False,
-                        symmetric=True,
-                        log_info=False,
-                        neg_sample_percent=neg_sample_percent,
-                        pmi=True,
-                        shift=shift,
-                    )
-                    for (shift, gatherer) in zip(shifts, gatherers)
-                ]
-                yield ([x[0] for x in pairlist], [x[1] for x in pairlist])
+            if cache_batches or num_epochs > 1:
+                name = 'joint_{}_{}_{}_{}'.format('-'.join(map(str, dimlist)), '-'.join(map(str, exp_shifts)), neg_sample_percent, batch_size)
+                store = self.get_batch_store(name, text_tensor_batches(batch_size))
+                for batch in store.batches(num_epochs=num_epochs):
+                    yield batch
+            else:
+                for batch in text_tensor_batches(batch_size):
+                    yield batch
 
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-        )
-        self.sess = tf.Session(config=config)
-        with self.sess.as_default():
+        prestarted = []
+
+        def text_tensor_batches(batch_size):
+            if prestarted:
+                return prestarted.pop()
+            return self.text_batches(joint_pmi_tensors, batch_size)
+
+        def joint_pmi_tensors(batch):
+            return gatherer.create_pmi_batch(batch, shifts, positive=True, neg_sample_percent=neg_sample_percent)
+
+        if self.pipeline_workers > 0:  # fork the pipeline workers before the TF session (and its threads) exist
+            prestarted.append(text_tensor_batches(1000))
+        self.create_session()
+        with self.session_scope():
             reg_param = 0.
             self.to_save['reg_param'] = reg_param
             print('reg_param: {}'.format(reg_param))
-            decomp_method = JointSymmetricCPDecomp(
+            decomp_cls = NumpyJointSymmetricCPDecomp if self.backend == 'numpy' else JointSymmetricCPDecomp
+            decomp_method = decomp_cls(
                 size=len(self.model.vocab),
                 dimlist=dimlist,
                 dimweights=dimweights,
@@ -217,12 +353,12 @@ class GensimSandbox(object):
                 reg_param=reg_param,
                 nonneg=nonneg,
                 gpu=self.gpu,
+                **self.decomp_kwargs()
             )
         print('Starting JOINT CP Decomp training')
-        decomp_method.train(sparse_tensor_batches())
+        self.train_decomp(decomp_method, sparse_tensor_batches())
 
-        with self.sess.as_default():
-            U = decomp_method.U.eval()
+        U = self.get_factor_matrix(decomp_method)
         if nonneg:
             sparse_embedding = U.clip(min=0.0)
             self.embedding = sparse_embedding
@@ -237,7 +373,19 @@ class GensimSandbox(object):
                                   shift=-np.log2(15.),
                                   neg_sample_percent=0.25,
                                   reg_param=0.,
+                                  num_epochs=1,
+                                  cache_batches=False,
+                                  validation_size=0,
+                                  evaluate_every=1000,
+                                  sampling=None,
         ):
+        '''
+        With `cache_batches` (or more than one epoch), the PMI batches are materialized to disk once and replayed shuffled.
+        For symmetric tensors, `validation_size` entries of the full tensor (none, by default) can be held out of
+            training and scored every `evaluate_every` steps, for early stopping and learning rate decay.
+        With `sampling` ('uniform', 'importance' or 'stratified'), symmetric training instead draws fixed-size weighted
+            batches straight from the full tensor (see batch_store.TensorSampler), `num_epochs` times its size in all.
+        '''
         gatherer = self.get_pmi_gatherer(ndims)
         if nonneg or is_glove:
             shift = 0.
@@ -267,27 +415,40 @@ class GensimSandbox(object):
                     print('GloVe iteration number {}...'.format(i))
                     for sampled_indices, sampled_values in zip(grouper(batch_size, indices_shuffled), grouper(batch_size, values_shuffled)):
                         yield (sampled_indices, sampled_values)
+            elif cache_batches or num_epochs > 1:
+                name = '{}d_{}_{:.3f}_{}_{}'.format(ndims, 'sym' if symmetric else 'asym', shift, neg_sample_percent, batch_size)
+                store = self.get_batch_store(name, text_tensor_batches(batch_size, symmetric))
+                for sparse_ppmi_tensor_pair in store.batches(num_epochs=num_epochs):
+                    yield sparse_ppmi_tensor_pair
             else:  # not is_glove
-                batches = batch_generator2(self.model, self.sentences_generator(), batch_size=batch_size)
-                for batch in batches:
-                    sparse_ppmi_tensor_pair = gatherer.create_pmi_tensor(
-                        batch=batch,
-                        positive=True,
-                        debug=False,
-                        symmetric=symmetric,
-                        log_info=False,
-                        neg_sample_percent=neg_sample_percent,
-                        pmi=True,
-                        shift=shift,
-                    )
+                for sparse_ppmi_tensor_pair in text_tensor_batches(batch_size, symmetric):
                     yield sparse_ppmi_tensor_pair
 
+        prestarted = []
+
+        def text_tensor_batches(batch_size, symmetric):
+            if prestarted:
+                return prestarted.pop()
+
+            def pmi_tensor(batch):
+                return gatherer.create_pmi_tensor(
+                    batch=batch,
+                    positive=True,
+                    debug=False,
+                    symmetric=symmetric,
+                    log_info=False,
+                    neg_sample_percent=neg_sample_percent,
+                    pmi=True,
+                    shift=shift,
+                )
+            return self.text_batches(pmi_tensor, batch_size)
+
+        if self.pipeline_workers > 0 and not is_glove and not (sampling is not None and symmetric):
+            # fork the pipeline workers before the TF session (and its threads) exist
+            prestarted.append(text_tensor_batches(100 if ndims == 2 else 1000, symmetric))
         (all_indices, all_values) = None, None  # to be filled in later
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-        )
-        self.sess = tf.Session(config=config)
-        with self.sess.as_default():
+        self.create_session()
+        with self.session_scope():
             if symmetric:
                 print('getting full PMI tensor...')
                 (all_indices, all_values) = gatherer.create_pmi_tensor(positive=True, debug=False, symmetric=symmetric, shift=shift)
@@ -303,7 +464,8 @@ class GensimSandbox(object):
                     reg_param = 0.000005
                 self.to_save['reg_param'] = reg_param
                 print('reg_param: {}'.format(reg_param))
-                decomp_method = SymmetricCPDecomp(
+                decomp_cls = NumpySymmetricCPDecomp if self.backend == 'numpy' else SymmetricCPDecomp
+                decomp_method = decomp_cls(
                     dim=len(self.model.vocab),
                     ndims=ndims,
                     rank=self.embedding_dim,
@@ -314,9 +476,11 @@ class GensimSandbox(object):
                     gpu=self.gpu,
                     is_glove=is_glove,
                     mean_value=mean_value,
+                    **self.decomp_kwargs()
                 )
             else:
-                decomp_method = CPDecomp(
+                decomp_cls = NumpyCPDecomp if self.backend == 'numpy' else CPDecomp
+                decomp_method = decomp_cls(
                     ndims=ndims,
                     shape=(len(self.model.vocab),)*ndims,
                     rank=self.embedding_dim,
@@ -325,38 +489,73 @@ class GensimSandbox(object):
                     reg_param=reg_param,
                     is_glove=is_glove,
                     nonneg=nonneg,
+                    **self.decomp_kwargs()
                 )
+        validation = None
+        if symmetric and not is_glove and validation_size > 0:
+            validation = ValidationMonitor.sample(all_indices, all_values, len(self.model.vocab), sample_size=validation_size, evaluate_every=evaluate_every)
         print('Starting CP Decomp training')
-        if ndims == 2:
-            decomp_method.train(sparse_tensor_batches(batch_size=100))
+        if sampling is not None and symmetric and not is_glove:
+            train_indices, train_values = all_indices, all_values
+            if validation is not None:
+                keep = ~validation.is_held_out(all_indices)
+                train_indices, train_values = all_indices[keep], all_values[keep]
+            batch_size = 100 if ndims == 2 else 1000
+            sampler = TensorSampler(train_indices, train_values, len(self.model.vocab), batch_size=batch_size, strategy=sampling, neg_sample_percent=neg_sample_percent)
+            num_batches = int(np.ceil(num_epochs * len(train_values) / batch_size))
+            self.train_decomp(decomp_method, sampler.batches(num_batches), validation=validation)
+        elif ndims == 2:
+            self.train_decomp(decomp_method, sparse_tensor_batches(batch_size=100), validation=validation)
         else:
-            decomp_method.train(sparse_tensor_batches())
+            self.train_decomp(decomp_method, sparse_tensor_batches(), validation=validation)
 
-        with self.sess.as_default():
-            U = decomp_method.U.eval()
-            if nonneg:
-                sparse_embedding = U.clip(min=0.0)
-                self.embedding = sparse_embedding
-            else:
-                self.embedding = U.copy()
+        U = self.get_factor_matrix(decomp_method)
+        if nonneg:
+            sparse_embedding = U.clip(min=0.0)
+            self.embedding = sparse_embedding
+        else:
+            self.embedding = U.copy()
         if symmetric: 
-            def mse(embedding_mat):
-                total_err = 0.0
-                for ix, val in zip(all_indices, all_values):
-                    prod = embedding_mat[ix[0]].copy()
-                    for i in range(1, ndims):
-                        prod *= embedding_mat[ix[i]]
-                    pred_val = prod.sum()
-                    total_err += (pred_val - val) ** 2
-                return total_err / len(all_indices)
-
-            err = mse(self.embedding)
-            print("RMSE: {:.3f}".format(np.sqrt(err)))
-            self.to_save['RMSE'] = np.sqrt(err)
+            report = evaluate_cp(all_indices, all_values, self.embedding)
+            print("RMSE: {:.3f}".format(report.rmse))
+            print(report)
+            self.to_save['RMSE'] = report.rmse
+            self.to_save['reconstruction_report'] = report
             #self.embedding /= np.linalg.norm(self.embedding, axis=1)[:, None]  # normalize vectors to unit lengths
             self.to_save['all_indices'] = all_indices
             self.to_save['all_values'] = all_values
 
+    def train_als_cp_embedding(self, dimlist: list, dimweights: list, nonneg: bool, shifts=None, max_sweeps=50, tol=1e-4):
+        '''
+        Full-batch symmetric (or joint, with several orders in `dimlist`) CP-ALS over the complete sparse PPMI tensors.
+        '''
+        if shifts is None:
+            shifts = [0.] * len(dimlist)
+        tensors = []
+        for dim, shift in zip(dimlist, shifts):
+            gatherer = self.get_pmi_gatherer(dim)
+            print('getting full {}D PMI tensor...'.format(dim))
+            tensors.append(gatherer.create_pmi_tensor(positive=True, debug=False, symmetric=True, shift=shift))
+        mean_value = np.mean(tensors[-1][1])
+        print('mean tensor value: {}'.format(mean_value))
+        decomp_method = SymmetricCPALS(
+            dim=len(self.model.vocab),
+            rank=self.embedding_dim,
+            dimlist=dimlist,
+            dimweights=dimweights,
+            nonneg=nonneg,
+            mean_value=mean_value,
+        )
+        print('Starting CP-ALS training')
+        fit = decomp_method.fit(tensors, max_sweeps=max_sweeps, tol=tol)
+        self.to_save['fit'] = fit
+        self.to_save['fits'] = decomp_method.fits
+        self.embedding = decomp_method.U.astype(np.float32)
+        reports = evaluate_joint(tensors, self.embedding, dimlist)
+        for dim, report in zip(dimlist, reports):
+            print('{}d: {}'.format(dim, report))
+        self.to_save['RMSE'] = [report.rmse for report in reports]
+
     def train_random_embedding(self, param=0.5, gauss=True):
         if gauss:
             # Gaussian(0, param)
@@ -411,39 +610,22 @@ class GensimSandbox(object):
         embedding  = np.dot(U, np.diag(lambda_ ** (1. / 3.)))
         C1 = np.dot(V, np.diag(lambda_ ** (1. / 3.)))
         C2 = np.dot(W, np.diag(lambda_ ** (1. / 3.)))
-        def pred_xijk(i, j, k):
-            hadamard = embedding[i] * C1[j] * C2[k] 
-            return np.sum(hadamard)
-        def mse(embedding=embedding, C1=C1, C2=C2):
-            err = 0.0
-            cnt = 0.0
-            smallest_se = float('inf')  # se = squared error
-            for val, ix in zip(values, indices):
-                val = val[0]
-                if cnt > 5e6:
-                    return np.sqrt(err / cnt)
-                pred_val = pred_xijk(ix[0], ix[1], ix[2])
-                se = (val - pred_val)**2 
-                #print('|{} - {}|^2 = {}'.format(val, pred_val, se))
-                if se < smallest_se:
-                    smallest_se = se
-                err += se
-                cnt += 1
-            return err / cnt
-        print("MSE: {}".format(mse()))
+        report = evaluate_cp(indices, values, [embedding, C1, C2], processes=None)
+        print("MSE: {}".format(report.mse))
+        print(report)
         self.embedding = embedding
 
     def train_svd_embedding(self):
         gatherer = self.get_pmi_gatherer(2)
 
-        print('Making PPMI tensor for SVD...')
-        dense_ppmi_tensor = gatherer.create_pmi_tensor(positive=True, numpy_dense_tensor=True, debug=True)
+        print('Making PPMI matrix for SVD...')
+        sparse_ppmi_matrix = gatherer.create_sparse_pmi_matrix(positive=True)
         del gatherer
 
         embedding_model = PpmiSvdEmbedding(self.model, embedding_dim=self.embedding_dim)
         print("calculating SVD on {0}x{0}...".format(len(self.model.vocab)))
         t = time.time()
-        embedding_model.learn_embedding(dense_ppmi_tensor)
+        embedding_model.learn_embedding(sparse_ppmi_matrix)
         total_svd_time = time.time() - t
         print("SVD on {}x{} took {}s".format(len(self.model.vocab), len(self.model.vocab), total_svd_time))
         self.embedding = embedding_model.get_embedding_matrix()
@@ -495,6 +677,13 @@ class GensimSandbox(object):
         self.create_embedding_visualization()
 
     def train(self, experiment='', kwargs={}):
+        '''
+        `kwargs` (e.g. sampling, validation_size) go to train_online_cp_embedding, so only the cp-s and cp-sn methods take them.
+        '''
+        if kwargs and self.method not in ['cp-s', 'cp-sn']:
+            raise ValueError('{} only apply to the cp-s and cp-sn methods, not {}'.format(
+                ', '.join('--{}'.format(key) for key in sorted(kwargs)), self.method,
+            ))
         self.get_model_with_vocab()
         self.start_time = time.time()
         if experiment != '':
@@ -514,6 +703,12 @@ class GensimSandbox(object):
         elif self.method in ['cp-sn']:
             self.method += experiment
             self.train_online_cp_embedding(ndims=3, symmetric=True, nonneg=True, **kwargs)
+        elif self.method in ['cp-s-als']:  # Full-batch symmetric CP-ALS
+            self.method += experiment
+            self.train_als_cp_embedding(dimlist=[3], dimweights=[1.], nonneg=False, **kwargs)
+        elif self.method in ['jcp-s-als']:
+            self.method += experiment
+            self.train_als_cp_embedding(dimlist=[2,3], dimweights=[1., 1.], nonneg=False, **kwargs)
         elif self.method in ['jcp-s']:  # Joint Symmetric CP Decomp experiments
             self.method += experiment
             self.train_joint_online_cp_embedding(dimlist=[2,3], dimweights=[1., 1.,], nonneg=False, **kwargs)
@@ -586,6 +781,13 @@ def main():
     min_count = None
     embedding_dim = None
     gpu = False
+    backend = 'tf'
+    sparse_updates = False
+    workers = 1
+    pipeline_workers = 0
+    vocab_mode = 'exact'
+    vocab_max_words = None
+    train_kwargs = {}
     for arg in sys.argv:
         if arg.startswith('--method='):
             method = arg.split('--method=')[1]
@@ -597,6 +799,22 @@ def main():
             embedding_dim = int(arg.split('--embedding_dim=')[1])
         if arg.startswith('--gpu='):
             gpu = bool(arg.split('--gpu=')[1])
+        if arg.startswith('--backend='):
+            backend = arg.split('--backend=')[1]
+        if arg.startswith('--sparse_updates='):
+            sparse_updates = arg.split('--sparse_updates=')[1] == 'True'
+        if arg.startswith('--workers='):
+            workers = int(arg.split('--workers=')[1])
+        if arg.startswith('--pipeline_workers='):
+            pipeline_workers = int(arg.split('--pipeline_workers=')[1])
+        if arg.startswith('--sampling='):
+            train_kwargs['sampling'] = arg.split('--sampling=')[1]
+        if arg.startswith('--validation_size='):
+            train_kwargs['validation_size'] = int(arg.split('--validation_size=')[1])
+        if arg.startswith('--vocab_mode='):
+            vocab_mode = arg.split('--vocab_mode=')[1]
+        if arg.startswith('--vocab_max_words='):
+            vocab_max_words = int(arg.split('--vocab_max_words=')[1])
     assert all([method, num_articles, min_count, embedding_dim]), 'Please supply all necessary parameters'
 
     print('Creating sandbox with method {}, num_articles {} and min_count {}.'.format(method, num_articles, min_count))
@@ -607,8 +825,14 @@ def main():
         embedding_dim=embedding_dim,
         min_count=min_count,
         gpu=gpu,
+        backend=backend,
+        sparse_updates=sparse_updates,
+        workers=workers,
+        pipeline_workers=pipeline_workers,
+        vocab_mode=vocab_mode,
+        vocab_max_words=vocab_max_words,
     )
-    sandbox.train(experiment='')
+    sandbox.train(experiment='', kwargs=train_kwargs)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,214 @@
+import collections
+import numpy as np
+import os
+import shutil
+import time
+import zlib
+
+from ngram_counts import load_arrays, save_arrays, vocab_hash
+
+
+class Vocab(collections.namedtuple('Vocab', ['count', 'index'])):
+    '''
+    One word of a Vocabulary: its corpus `count`, and its `index` (by descending count), like gensim's word2vec.Vocab.
+    '''
+    __slots__ = ()
+
+
+class Vocabulary(object):
+    def __init__(self, index2word, counts, window=5, min_count=None, corpus_count=None, max_count_error=0):
+        '''
+        Everything the count pipeline used to take from a Word2Vec model, without the model: `index2word` (most
+            frequent word first), `vocab` (word -> Vocab(count, index)) and the context `window`.
+        `max_count_error` bounds how far below its true count any count can be (nonzero after approximate counting,
+            see VocabCounter).
+        '''
+        self.index2word = list(index2word)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.vocab = {word: Vocab(count, index) for index, (word, count) in enumerate(zip(self.index2word, self.counts.tolist()))}
+        self.window = window
+        self.min_count = min_count
+        self.corpus_count = corpus_count
+        self.max_count_error = max_count_error
+
+    def __len__(self):
+        return len(self.index2word)
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, 'header.json'))
+
+    @classmethod
+    def from_model(cls, model):
+        '''
+        The vocab of a gensim Word2Vec model (e.g. one pickled before this module existed), in the same order.
+        '''
+        return cls(
+            model.index2word, [model.vocab[word].count for word in model.index2word], window=model.window,
+            min_count=model.min_count, corpus_count=getattr(model, 'corpus_count', None),
+        )
+
+    def save(self, dirname):
+        '''
+        Saves the vocab as two flat arrays (see ngram_counts.save_arrays): the utf8 words joined by newlines, and the counts.
+        '''
+        header = {
+            'format': 'vocabulary',
+            'vocab_hash': vocab_hash(self.index2word),
+            'window': self.window,
+            'min_count': self.min_count,
+            'corpus_count': self.corpus_count,
+            'max_count_error': self.max_count_error,
+        }
+        words = np.frombuffer('\n'.join(self.index2word).encode('utf8'), dtype=np.uint8)
+        save_arrays(dirname, header, {'words': words, 'counts': self.counts})
+
+    @classmethod
+    def load(cls, dirname):
+        header, arrays = load_arrays(dirname, mmap=False)
+        words = arrays['words'].tobytes().decode('utf8')
+        index2word = words.split('\n') if words else []
+        return cls(
+            index2word, arrays['counts'], window=header['window'], min_count=header['min_count'],
+            corpus_count=header['corpus_count'], max_count_error=header['max_count_error'],
+        )
+
+    def seed_word2vec(self, model):
+        '''
+        Gives a fresh gensim Word2Vec this vocab, as if its `build_vocab` had scanned the corpus, so it can be trained.
+        '''
+        model.raw_vocab = collections.OrderedDict(zip(self.index2word, self.counts.tolist()))  # sort_vocab is stable, so the order holds
+        model.corpus_count = self.corpus_count
+        model.scale_vocab()
+        model.finalize_vocab()
+        return model
+
+
+def shard_of(word, num_shards):
+    return zlib.crc32(word.encode('utf8')) % num_shards  # unlike hash(), the same in every process
+
+
+class VocabCounter(object):
+    def __init__(self, mode='exact', max_words=None, shard_dir=None, num_shards=64):
+        '''
+        Counts the words of a stream of tokenized sentences for `finalize` to turn into a Vocabulary, holding at most
+            about `max_words` distinct words in memory (except in 'exact' mode, which takes no `max_words`).
+
+        'exact' keeps every distinct word (like Word2Vec.scan_vocab with max_vocab_size=None).
+        'misra_gries' is approximate: whenever it holds 2 * `max_words` words, every count drops by the
+            `max_words`-th largest one, and the words that hit zero are forgotten. Any word more frequent than
+            num_words / max_words survives, and no count ends up more than `max_count_error` (the sum of all the
+            drops) below its true count.
+        'sharded' is exact: whenever it holds `max_words` words, it appends them to `num_shards` files in `shard_dir`,
+            by a hash of the word, and `finalize` adds up one shard at a time.
+
+        Ties in count are broken by first occurrence in every mode, so 'exact' and 'sharded' give the same index2word
+            as Word2Vec.build_vocab.
+        '''
+        assert mode in ('exact', 'misra_gries', 'sharded'), 'unknown vocab counting mode {}'.format(mode)
+        assert mode == 'exact' or max_words, '{} counting needs max_words'.format(mode)
+        assert mode != 'exact' or max_words is None, "exact counting holds every word; cap it with the 'misra_gries' or 'sharded' mode"
+        assert mode != 'sharded' or shard_dir, 'sharded counting needs a shard_dir'
+        self.mode = mode
+        self.max_words = max_words
+        self.shard_dir = shard_dir
+        self.num_shards = num_shards
+        self.counts = collections.Counter()  # insertion ordered, i.e. by first occurrence since the last trim/spill
+        self.num_sentences = 0
+        self.num_words = 0
+        self.max_count_error = 0
+        self.num_spilled = 0  # words spilled so far, i.e. the first-occurrence rank of the next word seen after a spill
+        if mode == 'sharded':
+            if os.path.exists(shard_dir):
+                shutil.rmtree(shard_dir)
+            os.makedirs(shard_dir)
+
+    def shard_fname(self, shard):
+        return os.path.join(self.shard_dir, 'shard_{}.txt'.format(shard))
+
+    def update(self, sentences, print_every=10000):
+        '''
+        Counts every word of the `sentences` generator (one list of words per sentence). Returns self.
+        '''
+        t = time.time()
+        counts = self.counts
+        for sentence in sentences:
+            counts.update(sentence)
+            self.num_words += len(sentence)
+            self.num_sentences += 1
+            if self.mode == 'misra_gries' and len(counts) >= 2 * self.max_words:
+                self.trim()
+                counts = self.counts
+            elif self.mode == 'sharded' and len(counts) >= self.max_words:
+                self.spill()
+                counts = self.counts
+            if self.num_sentences % print_every == 0:
+                print('Counted {} words of {} sentences ({} distinct words held) in {:.1f} secs'.format(
+                    self.num_words, self.num_sentences, len(counts), time.time() - t,
+                ))
+        return self
+
+    def trim(self):
+        ''' One batched Misra-Gries decrement (see `__init__`). '''
+        drop = int(np.partition(np.fromiter(self.counts.values(), dtype=np.int64), -self.max_words)[-self.max_words])
+        self.counts = collections.Counter({word: count - drop for word, count in self.counts.items() if count > drop})
+        self.max_count_error += drop
+
+    def spill(self):
+        '''
+        Appends the counts held in memory to their shards, as "count first_occurrence word" lines.
+        '''
+        lines = [[] for _ in range(self.num_shards)]
+        for rank, (word, count) in enumerate(self.counts.items(), self.num_spilled):
+            lines[shard_of(word, self.num_shards)].append('{} {} {}\n'.format(count, rank, word))
+        for shard, shard_lines in enumerate(lines):
+            if shard_lines:
+                with open(self.shard_fname(shard), 'a', encoding='utf8') as f:
+                    f.writelines(shard_lines)
+        self.num_spilled += len(self.counts)
+        self.counts = collections.Counter()
+
+    def merged_shards(self, min_count):
+        '''
+        Yields (count, first_occurrence, word) for every word counted at least `min_count` times, one shard at a time.
+        '''
+        self.spill()
+        for shard in range(self.num_shards):
+            fname = self.shard_fname(shard)
+            if not os.path.exists(fname):
+                continue
+            merged = {}
+            with open(fname, encoding='utf8') as f:
+                for line in f:
+                    count, rank, word = line.rstrip('\n').split(' ', 2)
+                    if word in merged:
+                        total, first = merged[word]
+                        merged[word] = (total + int(count), min(first, int(rank)))
+                    else:
+                        merged[word] = (int(count), int(rank))
+            for word, (count, rank) in merged.items():
+                if count >= min_count:
+                    yield count, rank, word
+        shutil.rmtree(self.shard_dir)
+
+    def finalize(self, min_count=5, window=5, max_vocab=None):
+        '''
+        The Vocabulary of the words counted at least `min_count` times, most frequent first (just the first
+            `max_vocab` of them, if given).
+        '''
+        t = time.time()
+        if self.mode == 'sharded':
+            kept = list(self.merged_shards(min_count))
+        else:
+            kept = [(count, rank, word) for rank, (word, count) in enumerate(self.counts.items()) if count >= min_count]
+        kept.sort(key=lambda entry: (-entry[0], entry[1]))
+        if max_vocab is not None:
+            kept = kept[:max_vocab]
+        vocab = Vocabulary(
+            [word for _, _, word in kept], [count for count, _, _ in kept], window=window, min_count=min_count,
+            corpus_count=self.num_sentences, max_count_error=self.max_count_error,
+        )
+        print('Kept {} words counted at least {} times ({} words, {} sentences); finalizing took {:.1f} secs'.format(
+            len(vocab), min_count, self.num_words, self.num_sentences, time.time() - t,
+        ))
+        return vocab
@@ -21,6 +21,5 @@ sandbox.model = model
 pmi_gatherer_3D = sandbox.get_pmi_gatherer(3)
 
 
-import pickle
-output_file = "./3D_pmi_gatherer_min_5"
-pickle.dump(pmi_gatherer_3D, open(output_file, "wb"))
+output_dir = "./3D_pmi_gatherer_min_5"
+pmi_gatherer_3D.save(output_dir)